@@ -1,6 +1,9 @@
 #include <stdio.h>
+#include <string.h>
 #include <limits.h>
+#include <errno.h>
 #include <unistd.h>
+#include <sys/socket.h>
 
 #include <epicsTime.h>
 #include <epicsExit.h>
@@ -57,7 +60,7 @@ ADExternalPlugin::ADExternalPlugin(
         asynGenericPointerMask|asynFloat64ArrayMask,
         asynGenericPointerMask|asynFloat64ArrayMask, 0, 1,
         priority, stackSize, 1), shmName(shmName), className(className),
-        identity(identity), nextParam(0)
+        identity(identity), nextParam(0), msgBuffer(INITIAL_MSG_SIZE)
 {
     server = server_create(socketPath);
     if (!server) {
@@ -114,13 +117,13 @@ void ADExternalPlugin::shutdown()
 
 void ADExternalPlugin::_initialise_new_connection(struct server_connection *con)
 {
-    struct worker_context *context =
-        (struct worker_context *) malloc(sizeof(struct worker_context));
+    struct worker_context *context = new worker_context();
     server_connection_set_private(con, context);
     context->state = WORKER_HANDSHAKE;
     context->con = con;
     context->sock = server_connection_get_socket(con);
-    context->frame = NULL;
+    context->max_inflight = 1;
+    context->binary_frames = false;
 }
 
 
@@ -134,17 +137,83 @@ void ADExternalPlugin::_destroy_connection(struct server_connection *con)
     pthread_mutex_unlock(&workersMutex);
     this->lock();
     setIntegerParam(workersNumParam, workers.size());
-    if (context->frame) {
+    for (struct inflight_frame &inflight : context->frames) {
         getIntegerParam(NDPluginDriverDroppedArrays, &droppedArrays);
         ASYN_ERROR("%s: dropped frame %d because worker died in action\n",
-           driverName, context->frame->uniqueId);
+           driverName, inflight.frame->uniqueId);
         droppedArrays++;
         setIntegerParam(NDPluginDriverDroppedArrays, droppedArrays);
-        context->frame->release();
+        inflight.frame->release();
     }
+    context->frames.clear();
+    for (auto &output : context->outputs)
+        output.second->release();
+    context->outputs.clear();
+    for (auto &retained : context->retained)
+        retained.second->release();
+    context->retained.clear();
     callParamCallbacks();
     this->unlock();
-    free(context);
+    delete context;
+}
+
+
+// shape, type, output frame and attributes of a frame in a reply, or of one
+// of its "outputs"
+void ADExternalPlugin::_parse_frame_reply(
+    rapidjson::Value &data, struct frame_reply &reply)
+{
+    reply.push_frame = true;
+    reply.has_frame_id = false;
+    reply.frame_id = 0;
+    reply.ndims = 0;
+    reply.has_data_type = false;
+    reply.data_type = NDInt8;
+    reply.has_out_loc = false;
+    reply.out_loc = 0;
+    reply.attrs = NULL;
+    reply.outputs = NULL;
+    reply.retain = false;
+
+    rapidjson::Value::MemberIterator it = data.FindMember("frame_id");
+    if (it != data.MemberEnd() && it->value.IsInt()) {
+        reply.has_frame_id = true;
+        reply.frame_id = it->value.GetInt();
+    }
+
+    it = data.FindMember("frame_dims");
+    if (it != data.MemberEnd() && it->value.IsArray()) {
+        for (auto &dim_val : it->value.GetArray()) {
+            if (reply.ndims >= ND_ARRAY_MAX_DIMS)
+                break;
+            if (dim_val.IsInt())
+                reply.dims[reply.ndims++] = (size_t) dim_val.GetInt();
+        }
+    }
+
+    it = data.FindMember("data_type");
+    if (it != data.MemberEnd() && it->value.IsString()) {
+        reply.has_data_type = true;
+        reply.data_type = ad_data_type_from_string(it->value.GetString());
+    }
+
+    it = data.FindMember("out_loc");
+    if (it != data.MemberEnd() && it->value.IsUint64()) {
+        reply.has_out_loc = true;
+        reply.out_loc = it->value.GetUint64();
+    }
+
+    it = data.FindMember("attrs");
+    if (it != data.MemberEnd() && it->value.IsObject())
+        reply.attrs = &it->value;
+
+    it = data.FindMember("outputs");
+    if (it != data.MemberEnd() && it->value.IsArray())
+        reply.outputs = &it->value;
+
+    it = data.FindMember("retain");
+    if (it != data.MemberEnd() && it->value.IsBool())
+        reply.retain = it->value.GetBool();
 }
 
 
@@ -156,53 +225,243 @@ void ADExternalPlugin::_process_working_worker_message(
     if (it != data.MemberEnd() && it->value.IsObject())
         _update_parameters(it->value);
 
+    it = data.FindMember("release_frames");
+    if (it != data.MemberEnd() && it->value.IsArray())
+        _process_release_frames(worker, it->value);
+
+    it = data.FindMember("alloc_frame");
+    if (it != data.MemberEnd() && it->value.IsObject()) {
+        _process_alloc_frame(worker, it->value);
+        return;
+    }
+
+    it = data.FindMember("free_frame");
+    if (it != data.MemberEnd() && it->value.IsUint64()) {
+        _process_free_frame(worker, it->value.GetUint64());
+        return;
+    }
+
     it = data.FindMember("push_frame");
     if (it == data.MemberEnd() || !it->value.IsBool())
         return;
 
-    NDArray *pArray = worker->frame;
-    if (it->value.GetBool() && pArray) {
-        it = data.FindMember("frame_dims");
-        if (it != data.MemberEnd() && it->value.IsArray()) {
-            int index = 0;
-            for (auto &dim_val : it->value.GetArray()) {
-                if (dim_val.IsInt() &&
-                        (size_t) dim_val.GetInt() <= pArray->dims[index].size)
-                    pArray->dims[index++].size = (size_t) dim_val.GetInt();
-            }
+    struct frame_reply reply;
+    _parse_frame_reply(data, reply);
+    reply.push_frame = it->value.GetBool();
+    _acknowledge_frame(worker, reply);
+}
+
+
+void ADExternalPlugin::_process_binary_worker_message(
+    struct worker_context *worker, char *data, size_t nbytes)
+{
+    struct binary_reply_header header;
+    if (nbytes < sizeof(header)) {
+        ASYN_ERROR("%s: binary message too short\n", driverName);
+        server_connection_close(worker->con);
+        return;
+    }
+    memcpy(&header, data, sizeof(header));
+    size_t dims_nbytes = header.ndims * sizeof(uint64_t);
+    size_t out_loc_nbytes =
+        (header.flags & BINARY_REPLY_OUT_LOC) ? sizeof(uint64_t) : 0;
+    if (header.ndims > ND_ARRAY_MAX_DIMS ||
+            nbytes < sizeof(header) + dims_nbytes + out_loc_nbytes) {
+        ASYN_ERROR("%s: malformed binary message\n", driverName);
+        server_connection_close(worker->con);
+        return;
+    }
+    if ((header.flags & BINARY_REPLY_DATA_TYPE) &&
+            header.data_type > NDFloat64) {
+        ASYN_ERROR("%s: invalid data type %d in binary message\n",
+            driverName, header.data_type);
+        server_connection_close(worker->con);
+        return;
+    }
+
+    struct frame_reply reply;
+    reply.push_frame = header.flags & BINARY_REPLY_PUSH_FRAME;
+    reply.has_frame_id = header.flags & BINARY_REPLY_FRAME_ID;
+    reply.frame_id = header.frame_id;
+    reply.ndims = 0;
+    if (header.flags & BINARY_REPLY_FRAME_DIMS) {
+        reply.ndims = header.ndims;
+        for (int i=0; i < reply.ndims; i++) {
+            uint64_t dim;
+            memcpy(&dim, data + sizeof(header) + i * sizeof(dim), sizeof(dim));
+            reply.dims[i] = (size_t) dim;
         }
-        it = data.FindMember("data_type");
-        if (it != data.MemberEnd() && it->value.IsString()) {
-            pArray->dataType = ad_data_type_from_string(it->value.GetString());
+    }
+    reply.has_data_type = header.flags & BINARY_REPLY_DATA_TYPE;
+    reply.data_type = (NDDataType_t) header.data_type;
+    reply.has_out_loc = header.flags & BINARY_REPLY_OUT_LOC;
+    reply.out_loc = 0;
+    if (reply.has_out_loc) {
+        memcpy(&reply.out_loc, data + sizeof(header) + dims_nbytes,
+            sizeof(reply.out_loc));
+    }
+    reply.attrs = NULL;
+    reply.outputs = NULL;
+    reply.retain = header.flags & BINARY_REPLY_RETAIN;
+
+    // parameters and attributes still travel as JSON after the header
+    rapidjson::Document doc;
+    size_t json_offset = sizeof(header) + dims_nbytes + out_loc_nbytes;
+    if (nbytes > json_offset) {
+        doc.ParseInsitu(data + json_offset);
+        if (doc.HasParseError() || !doc.IsObject()) {
+            ASYN_ERROR("%s: Error parsing message\n", driverName);
+            server_connection_close(worker->con);
+            return;
         }
+        rapidjson::Value::MemberIterator it = doc.FindMember("vars");
+        if (it != doc.MemberEnd() && it->value.IsObject())
+            _update_parameters(it->value);
+
+        it = doc.FindMember("release_frames");
+        if (it != doc.MemberEnd() && it->value.IsArray())
+            _process_release_frames(worker, it->value);
 
-        it = data.FindMember("attrs");
-        if (it != data.MemberEnd() && it->value.IsObject())
-            _populate_attrs_in_frame(it->value, pArray);
+        it = doc.FindMember("attrs");
+        if (it != doc.MemberEnd() && it->value.IsObject())
+            reply.attrs = &it->value;
 
-        // Calling endProcessCallbacks(without errors) forces us to copy the
-        // frame, which we don't want to
-        doCallbacksGenericPointer(pArray, NDArrayData, 0);
+        it = doc.FindMember("outputs");
+        if (it != doc.MemberEnd() && it->value.IsArray())
+            reply.outputs = &it->value;
+    }
+
+    _acknowledge_frame(worker, reply);
+}
+
+
+void ADExternalPlugin::_acknowledge_frame(
+    struct worker_context *worker, const struct frame_reply &reply)
+{
+    // frames are acknowledged in the same order they were sent
+    struct inflight_frame inflight = {NULL, {0, 0}};
+    pthread_mutex_lock(&workersMutex);
+    if (!worker->frames.empty()) {
+        inflight = worker->frames.front();
+        worker->frames.pop_front();
+    }
+    pthread_mutex_unlock(&workersMutex);
+
+    NDArray *pArray = inflight.frame;
+    if (pArray && reply.has_frame_id && reply.frame_id != pArray->uniqueId) {
+        ASYN_WARN("%s: worker acknowledged frame %d, expected frame %d\n",
+            driverName, reply.frame_id, pArray->uniqueId);
+    }
+
+    if (reply.push_frame && pArray) {
+        if (reply.outputs) {
+            _push_outputs(worker, pArray, *reply.outputs);
+        } else {
+            NDArray *pPushed = reply.has_out_loc ?
+                _take_output(worker, pArray, reply.out_loc) : pArray;
+            if (pPushed)
+                _push_frame(pPushed, reply, pPushed != pArray);
+            if (pPushed && pPushed != pArray)
+                pPushed->release();
+        }
         callParamCallbacks();
+    } else if (reply.has_out_loc) {
+        NDArray *pOutput = _take_output(worker, pArray, reply.out_loc);
+        if (pOutput)
+            pOutput->release();
     }
-    if (pArray)
+    if (pArray && reply.retain) {
+        uint64_t frame_loc = (uint64_t) pArray->pData - (uint64_t) shmem->addr;
+        worker->retained[frame_loc] = pArray;
+    } else if (pArray) {
         pArray->release();
+    }
 
     epicsTimeStamp ts_end;
     epicsTimeGetCurrent(&ts_end);
     this->lock();
     setDoubleParam(
         procTimeParam,
-        epicsTimeDiffInSeconds(&ts_end, &worker->ts_start) * 1000);
+        epicsTimeDiffInSeconds(&ts_end, &inflight.ts_start) * 1000);
     callParamCallbacks();
     this->unlock();
     pthread_mutex_lock(&workersMutex);
-    worker->frame = NULL;
     pthread_cond_signal(&hasWorkerCond);
     pthread_mutex_unlock(&workersMutex);
 }
 
 
+// Output frame allocated for the worker at out_loc, with the ids, timestamps
+// and attributes of the input frame
+NDArray *ADExternalPlugin::_take_output(
+    struct worker_context *worker, NDArray *pArray, uint64_t out_loc)
+{
+    auto it = worker->outputs.find(out_loc);
+    if (it == worker->outputs.end()) {
+        ASYN_ERROR("%s: worker replied with unknown output %lu\n",
+            driverName, (unsigned long) out_loc);
+        return NULL;
+    }
+    NDArray *pOutput = it->second;
+    worker->outputs.erase(it);
+    if (pArray)
+        this->pNDArrayPool->copy(pArray, pOutput, false, false, false);
+    return pOutput;
+}
+
+
+void ADExternalPlugin::_push_frame(
+    NDArray *pPushed, const struct frame_reply &reply, bool is_output)
+{
+    for (int index=0; index < reply.ndims && index < pPushed->ndims;
+            index++) {
+        if (reply.dims[index] <= pPushed->dims[index].size)
+            pPushed->dims[index].size = reply.dims[index];
+    }
+    // output frames were allocated with their type
+    if (reply.has_data_type && !is_output)
+        pPushed->dataType = reply.data_type;
+
+    if (reply.attrs)
+        _populate_attrs_in_frame(*reply.attrs, pPushed);
+
+    // Calling endProcessCallbacks(without errors) forces us to copy the
+    // frame, which we don't want to
+    doCallbacksGenericPointer(pPushed, NDArrayData, 0);
+}
+
+
+// Several frames produced from the same input one, pushed in order, each
+// entry is the input frame or an output frame (with "out_loc")
+void ADExternalPlugin::_push_outputs(
+    struct worker_context *worker, NDArray *pArray, rapidjson::Value &outputs)
+{
+    std::vector<struct frame_reply> replies;
+    std::vector<NDArray *> frames;
+    for (auto &output : outputs.GetArray()) {
+        if (!output.IsObject())
+            continue;
+        struct frame_reply reply;
+        _parse_frame_reply(output, reply);
+        replies.push_back(reply);
+    }
+    // output frames take the metadata of the input one before it gets the
+    // attributes of its own entry
+    for (struct frame_reply &reply : replies) {
+        frames.push_back(reply.has_out_loc ?
+            _take_output(worker, pArray, reply.out_loc) : pArray);
+    }
+    for (size_t i=0; i < replies.size(); i++) {
+        if (frames[i])
+            _push_frame(frames[i], replies[i], frames[i] != pArray);
+    }
+    for (NDArray *frame : frames) {
+        if (frame && frame != pArray)
+            frame->release();
+    }
+}
+
+
 void ADExternalPlugin::_process_worker_message(
     struct worker_context *worker, rapidjson::Document &data)
 {
@@ -222,6 +481,32 @@ void ADExternalPlugin::_process_worker_message(
 }
 
 
+// Next message of a worker in msgBuffer, null terminated. Messages keep
+// their boundaries, the size of the next one is peeked first so the buffer
+// can grow to fit it. Messages bigger than MAX_MSG_SIZE are discarded and
+// fail with EMSGSIZE
+ssize_t ADExternalPlugin::_recv_message(int sock)
+{
+    ssize_t rc = recv(sock, msgBuffer.data(), msgBuffer.size(),
+        MSG_PEEK | MSG_TRUNC);
+    if (rc < 0)
+        return rc;
+
+    if ((size_t) rc >= msgBuffer.size()) {
+        if (rc >= MAX_MSG_SIZE) {
+            recv(sock, msgBuffer.data(), 1, 0);
+            errno = EMSGSIZE;
+            return -1;
+        }
+        msgBuffer.resize(rc + 1);
+    }
+    rc = recv(sock, msgBuffer.data(), msgBuffer.size() - 1, 0);
+    if (rc >= 0)
+        msgBuffer[rc] = 0;
+    return rc;
+}
+
+
 void ADExternalPlugin::_handle_server_events()
 {
     for (;;) {
@@ -237,11 +522,23 @@ void ADExternalPlugin::_handle_server_events()
                 _initialise_new_connection(event.connection);
                 break;
             case SCONNECTION_EVENT_IN:
-                rc = read(sock, this->msgBuffer, MAX_MSG_SIZE);
-                if (rc > 0) {
-                    msgBuffer[rc] = 0;
+                rc = _recv_message(sock);
+                if (rc > 0 && msgBuffer[0] == BINARY_REPLY_MSG) {
+                    struct worker_context *worker =
+                        (struct worker_context *)
+                            server_connection_get_private(event.connection);
+                    if (worker->state == WORKER_WORKING &&
+                            worker->binary_frames) {
+                        _process_binary_worker_message(
+                            worker, msgBuffer.data(), rc);
+                    } else {
+                        ASYN_ERROR("%s: unexpected binary message\n",
+                            driverName);
+                        server_connection_close(event.connection);
+                    }
+                } else if (rc > 0) {
                     rapidjson::Document doc;
-                    doc.ParseInsitu(this->msgBuffer);
+                    doc.ParseInsitu(msgBuffer.data());
                     if (doc.HasParseError() || !doc.IsObject()) {
                         ASYN_ERROR("%s: Error parsing message\n", driverName);
                         // gibberish! we can't rely on this worker anymore
@@ -254,6 +551,11 @@ void ADExternalPlugin::_handle_server_events()
                     }
                 } else if (rc == 0) {
                     server_connection_close(event.connection);
+                } else if (errno == EMSGSIZE) {
+                    // the rest of the conversation would be out of sync
+                    ASYN_ERROR("%s: message from worker too big\n",
+                        driverName);
+                    server_connection_close(event.connection);
                 } else {
                     ASYN_ERROR("%s: unix socket read error %ld\n",
                         driverName, rc);
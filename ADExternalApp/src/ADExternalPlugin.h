@@ -1,6 +1,14 @@
 #ifndef _AD_EXTERNAL_PLUGIN_H
 #define _AD_EXTERNAL_PLUGIN_H
 
+#include <stdint.h>
+
+#include <deque>
+#include <map>
+#include <string>
+#include <utility>
+#include <vector>
+
 #include "rapidjson/document.h"
 #include "rapidjson/writer.h"
 #include "rapidjson/stringbuffer.h"
@@ -13,7 +21,47 @@
 #define DOUBLE_PAR_LETTER 'd'
 #define STRING_PAR_LETTER 's'
 
-#define MAX_MSG_SIZE 4096
+// The buffer for messages from workers starts with INITIAL_MSG_SIZE and grows
+// to fit bigger ones, up to MAX_MSG_SIZE
+#define INITIAL_MSG_SIZE 4096
+#define MAX_MSG_SIZE (16 << 20)
+
+// Max number of frames a worker can have outstanding at the same time
+#define MAX_INFLIGHT_FRAMES 16
+
+// Per-frame messages in binary form (negotiated during the handshake), all
+// fields use host byte order as both ends live in the same host
+#define BINARY_FRAME_MSG 'F'
+#define BINARY_REPLY_MSG 'R'
+
+#define BINARY_REPLY_PUSH_FRAME 0x01
+#define BINARY_REPLY_FRAME_DIMS 0x02
+#define BINARY_REPLY_DATA_TYPE 0x04
+#define BINARY_REPLY_FRAME_ID 0x08
+#define BINARY_REPLY_OUT_LOC 0x10
+#define BINARY_REPLY_RETAIN 0x20
+
+// followed by ndims uint64_t dimensions
+struct binary_frame_header {
+    char type;
+    uint8_t ndims;
+    uint8_t data_type;
+    uint8_t reserved;
+    int32_t frame_id;
+    uint64_t frame_loc;
+    double ts;
+    uint64_t epics_ts;
+};
+
+// followed by ndims uint64_t dimensions, the uint64_t out_loc if its flag is
+// set and optionally by a JSON object containing "vars" and "attrs"
+struct binary_reply_header {
+    char type;
+    uint8_t flags;
+    uint8_t ndims;
+    uint8_t data_type;
+    int32_t frame_id;
+};
 
 // Max number of user parameters in a subclass
 #define NUSERPARAMS 100
@@ -29,12 +77,52 @@ enum worker_state {
 };
 
 
+struct inflight_frame {
+    NDArray *frame;
+    epicsTimeStamp ts_start;
+};
+
+
 struct worker_context {
     enum worker_state state;
     struct server_connection *con;
     int sock;
-    NDArray *frame;
-    epicsTimeStamp ts_start;
+    // frames sent to the worker and not acknowledged yet, oldest first
+    std::deque<struct inflight_frame> frames;
+    size_t max_inflight;
+    bool binary_frames;
+    // output frames allocated for the worker, by offset in shared memory
+    std::map<uint64_t, NDArray *> outputs;
+    // input frames kept for the worker after acknowledging them, by offset
+    // in shared memory, until it releases them
+    std::map<uint64_t, NDArray *> retained;
+    // NDAttributes the worker wants with the frames and the JSON value of
+    // each one in the last frame, only changes are sent
+    std::vector<std::string> attr_names;
+    std::map<std::string, std::string> attr_values;
+};
+
+// name of an attribute and its JSON value, "null" if the frame doesn't have it
+typedef std::vector<std::pair<const std::string *, std::string> > attr_changes;
+
+
+// What a worker told us about the oldest frame it had in flight
+struct frame_reply {
+    bool push_frame;
+    bool has_frame_id;
+    int frame_id;
+    int ndims;
+    size_t dims[ND_ARRAY_MAX_DIMS];
+    bool has_data_type;
+    NDDataType_t data_type;
+    // output frame allocated by the worker to push instead of the input one
+    bool has_out_loc;
+    uint64_t out_loc;
+    rapidjson::Value *attrs;
+    // several frames to push instead of this one, see _push_outputs
+    rapidjson::Value *outputs;
+    // the worker keeps reading the input frame after acknowledging it
+    bool retain;
 };
 
 
@@ -91,6 +179,8 @@ private:
 
     void _handle_server_events();
 
+    ssize_t _recv_message(int sock);
+
     void _initialise_new_connection(struct server_connection *con);
 
     void _destroy_connection(struct server_connection *con);
@@ -104,11 +194,44 @@ private:
     void _process_working_worker_message(
         struct worker_context *worker, rapidjson::Document &data);
 
+    void _process_binary_worker_message(
+        struct worker_context *worker, char *data, size_t nbytes);
+
+    void _parse_frame_reply(rapidjson::Value &data, struct frame_reply &reply);
+
+    void _acknowledge_frame(
+        struct worker_context *worker, const struct frame_reply &reply);
+
+    NDArray *_take_output(
+        struct worker_context *worker, NDArray *pArray, uint64_t out_loc);
+
+    void _push_frame(
+        NDArray *pPushed, const struct frame_reply &reply, bool is_output);
+
+    void _push_outputs(
+        struct worker_context *worker, NDArray *pArray,
+        rapidjson::Value &outputs);
+
+    void _process_alloc_frame(
+        struct worker_context *worker, rapidjson::Value &request);
+
+    void _process_release_frames(
+        struct worker_context *worker, rapidjson::Value &frame_locs);
+
+    void _process_free_frame(struct worker_context *worker, uint64_t out_loc);
+
+    void _send_alloc_reply(
+        struct worker_context *worker, NDArray *pArray, const char *err);
+
     void _populate_vars_in_json(
         rapidjson::Writer<rapidjson::StringBuffer> &writer);
 
+    void _collect_attr_changes(
+        struct worker_context *worker, NDArray *pArray, attr_changes &changes);
+
     void _populate_attrs_in_json(
-        rapidjson::Writer<rapidjson::StringBuffer> &writer, NDArray *pArray);
+        rapidjson::Writer<rapidjson::StringBuffer> &writer,
+        const attr_changes &changes);
 
     void _populate_attrs_in_frame(
         rapidjson::Value &attrs, NDArray *pArray);
@@ -129,6 +252,10 @@ private:
 
     bool _send_frame_to_worker(struct worker_context *worker, NDArray *pArray);
 
+    bool _send_binary_frame_to_worker(
+        struct worker_context *worker, NDArray *pArray,
+        const attr_changes &changes);
+
     bool _send_frame(NDArray *pArray);
 
     asynStatus importAdPythonModule();
@@ -142,7 +269,7 @@ private:
     pthread_mutex_t workersMutex;
     pthread_cond_t hasWorkerCond;
     std::set<struct worker_context *> workers;
-    char msgBuffer[MAX_MSG_SIZE];
+    std::vector<char> msgBuffer;
 };
 
 void endProcessingThread(void* plugin);
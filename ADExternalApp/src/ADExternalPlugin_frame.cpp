@@ -1,6 +1,8 @@
 #include <stdio.h>
+#include <string.h>
 #include <limits.h>
 #include <unistd.h>
+#include <sys/uio.h>
 
 #include <epicsTime.h>
 #include <epicsExit.h>
@@ -16,7 +18,15 @@ static const char *driverName = "ADExternalPlugin";
 bool ADExternalPlugin::_send_frame_to_worker(
     struct worker_context *worker, NDArray *pArray)
 {
-    epicsTimeGetCurrent(&worker->ts_start);
+    struct inflight_frame inflight;
+    inflight.frame = pArray;
+    epicsTimeGetCurrent(&inflight.ts_start);
+    worker->frames.push_back(inflight);
+    attr_changes changes;
+    _collect_attr_changes(worker, pArray, changes);
+    if (worker->binary_frames)
+        return _send_binary_frame_to_worker(worker, pArray, changes);
+
     rapidjson::StringBuffer string_buffer;
     rapidjson::Writer<rapidjson::StringBuffer> writer(string_buffer);
     writer.StartObject();
@@ -40,6 +50,8 @@ bool ADExternalPlugin::_send_frame_to_worker(
         pArray->epicsTS.secPastEpoch * 1000000000ul + pArray->epicsTS.nsec;
     writer.String("epics_ts");
     writer.Uint64(epics_ts_in_nsec);
+    if (!changes.empty())
+        _populate_attrs_in_json(writer, changes);
     writer.EndObject();
     ssize_t rc;
     if((rc=write(worker->sock,
@@ -52,6 +64,49 @@ bool ADExternalPlugin::_send_frame_to_worker(
 }
 
 
+bool ADExternalPlugin::_send_binary_frame_to_worker(
+    struct worker_context *worker, NDArray *pArray,
+    const attr_changes &changes)
+{
+    char buffer[sizeof(struct binary_frame_header) +
+                ND_ARRAY_MAX_DIMS * sizeof(uint64_t)];
+    struct binary_frame_header header;
+    header.type = BINARY_FRAME_MSG;
+    header.ndims = (uint8_t) pArray->ndims;
+    header.data_type = (uint8_t) pArray->dataType;
+    header.reserved = 0;
+    header.frame_id = pArray->uniqueId;
+    header.frame_loc = (uint64_t) pArray->pData - (uint64_t) shmem->addr;
+    header.ts = (double) pArray->timeStamp;
+    header.epics_ts =
+        pArray->epicsTS.secPastEpoch * 1000000000ul + pArray->epicsTS.nsec;
+    memcpy(buffer, &header, sizeof(header));
+    size_t nbytes = sizeof(header);
+    for (int i=0; i < pArray->ndims; i++) {
+        uint64_t dim = (uint64_t) pArray->dims[i].size;
+        memcpy(buffer + nbytes, &dim, sizeof(dim));
+        nbytes += sizeof(dim);
+    }
+    // changed attributes go as JSON after the dimensions
+    rapidjson::StringBuffer string_buffer;
+    struct iovec iov[2] = {{buffer, nbytes}, {NULL, 0}};
+    if (!changes.empty()) {
+        rapidjson::Writer<rapidjson::StringBuffer> writer(string_buffer);
+        writer.StartObject();
+        _populate_attrs_in_json(writer, changes);
+        writer.EndObject();
+        iov[1].iov_base = (void *) string_buffer.GetString();
+        iov[1].iov_len = string_buffer.GetSize();
+    }
+    ssize_t rc;
+    if((rc=writev(worker->sock, iov, 2)) < 0) {
+        ASYN_ERROR("%s: unix socket write error %ld\n", driverName, rc);
+        return false;
+    }
+    return true;
+}
+
+
 bool ADExternalPlugin::_send_frame(NDArray *pArray)
 {
     if (!shared_mem_is_included(shmem, pArray->pData)) {
@@ -61,17 +116,19 @@ bool ADExternalPlugin::_send_frame(NDArray *pArray)
     bool got_worker = false;
     pthread_mutex_lock(&workersMutex);
     for (;;) {
+        // pick the least loaded worker which still has room in its window
+        struct worker_context *chosen = NULL;
         for (struct worker_context *worker : this->workers) {
-            if (!worker->frame) {
-                pArray->reserve();
-                worker->frame = pArray;
-                _send_frame_to_worker(worker, pArray);
-                got_worker = true;
-                break;
-            }
+            if (worker->frames.size() < worker->max_inflight &&
+                    (!chosen || worker->frames.size() < chosen->frames.size()))
+                chosen = worker;
         }
-        if (got_worker)
+        if (chosen) {
+            pArray->reserve();
+            _send_frame_to_worker(chosen, pArray);
+            got_worker = true;
             break;
+        }
         pthread_cond_wait(&hasWorkerCond, &workersMutex);
     }
     pthread_mutex_unlock(&workersMutex);
@@ -79,12 +136,187 @@ bool ADExternalPlugin::_send_frame(NDArray *pArray)
 }
 
 
+// The worker asks for a frame to write its output to, when it doesn't fit in
+// the input one. It is an NDArray from our pool, so it lives in the shared
+// memory and can be pushed without any copy
+void ADExternalPlugin::_process_alloc_frame(
+    struct worker_context *worker, rapidjson::Value &request)
+{
+    size_t dims[ND_ARRAY_MAX_DIMS];
+    int ndims = 0;
+    rapidjson::Value::MemberIterator it = request.FindMember("frame_dims");
+    if (it != request.MemberEnd() && it->value.IsArray()) {
+        for (auto &dim_val : it->value.GetArray()) {
+            if (ndims >= ND_ARRAY_MAX_DIMS || !dim_val.IsUint64()) {
+                _send_alloc_reply(worker, NULL, "invalid frame_dims");
+                return;
+            }
+            dims[ndims++] = (size_t) dim_val.GetUint64();
+        }
+    }
+    it = request.FindMember("data_type");
+    if (ndims == 0 || it == request.MemberEnd() || !it->value.IsString()) {
+        _send_alloc_reply(worker, NULL, "frame_dims and data_type required");
+        return;
+    }
+    // an unknown type would size the frame with 1 byte per element
+    if (!ad_data_type_is_valid(it->value.GetString())) {
+        _send_alloc_reply(worker, NULL, "invalid data_type");
+        return;
+    }
+    NDDataType_t data_type = ad_data_type_from_string(it->value.GetString());
+
+    NDArray *pArray = this->pNDArrayPool->alloc(
+        ndims, dims, data_type, 0, NULL);
+    if (!pArray) {
+        _send_alloc_reply(worker, NULL, "no memory available");
+        return;
+    }
+    if (!shared_mem_is_included(shmem, pArray->pData)) {
+        pArray->release();
+        _send_alloc_reply(worker, NULL, "frame not in shared memory");
+        return;
+    }
+    uint64_t out_loc = (uint64_t) pArray->pData - (uint64_t) shmem->addr;
+    worker->outputs[out_loc] = pArray;
+    _send_alloc_reply(worker, pArray, NULL);
+}
+
+
+// input frames retained by the worker that it doesn't need anymore
+void ADExternalPlugin::_process_release_frames(
+    struct worker_context *worker, rapidjson::Value &frame_locs)
+{
+    for (auto &frame_loc : frame_locs.GetArray()) {
+        auto it = frame_loc.IsUint64() ?
+            worker->retained.find(frame_loc.GetUint64()) :
+            worker->retained.end();
+        if (it == worker->retained.end()) {
+            ASYN_ERROR("%s: worker released a frame it didn't retain\n",
+                driverName);
+            continue;
+        }
+        it->second->release();
+        worker->retained.erase(it);
+    }
+}
+
+
+// output not used after all
+void ADExternalPlugin::_process_free_frame(
+    struct worker_context *worker, uint64_t out_loc)
+{
+    auto it = worker->outputs.find(out_loc);
+    if (it == worker->outputs.end()) {
+        ASYN_ERROR("%s: worker freed unknown output %lu\n",
+            driverName, (unsigned long) out_loc);
+        return;
+    }
+    it->second->release();
+    worker->outputs.erase(it);
+}
+
+
+void ADExternalPlugin::_send_alloc_reply(
+    struct worker_context *worker, NDArray *pArray, const char *err)
+{
+    rapidjson::StringBuffer string_buffer;
+    rapidjson::Writer<rapidjson::StringBuffer> writer(string_buffer);
+    writer.StartObject();
+    writer.String("out_loc");
+    if (pArray) {
+        writer.Uint64((uint64_t) pArray->pData - (uint64_t) shmem->addr);
+    } else {
+        writer.Null();
+        writer.String("err");
+        writer.String(err);
+    }
+    writer.EndObject();
+    ssize_t rc;
+    if((rc=write(worker->sock,
+             string_buffer.GetString(),
+             string_buffer.GetSize())) < 0) {
+        ASYN_ERROR("%s: unix socket write error %ld\n", driverName, rc);
+    }
+}
+
+
+// JSON value of an attribute, false for types we don't send
+static bool attr_value_to_json(NDAttribute *pAttr, std::string &json)
+{
+    NDAttrDataType_t data_type;
+    size_t size;
+    if (pAttr->getValueInfo(&data_type, &size) != ND_SUCCESS)
+        return false;
+
+    rapidjson::StringBuffer string_buffer;
+    rapidjson::Writer<rapidjson::StringBuffer> writer(string_buffer);
+    if (data_type == NDAttrString) {
+        std::string value(size, '\0');
+        if (pAttr->getValue(data_type, &value[0], size) != ND_SUCCESS)
+            return false;
+        writer.String(value.c_str());
+    } else {
+        union {
+            int8_t i8; uint8_t u8; int16_t i16; uint16_t u16;
+            int32_t i32; uint32_t u32; int64_t i64; uint64_t u64;
+            float f32; double f64;
+        } value;
+        if (size > sizeof(value) ||
+                pAttr->getValue(data_type, &value, size) != ND_SUCCESS)
+            return false;
+        switch (data_type) {
+        case NDAttrInt8: writer.Int(value.i8); break;
+        case NDAttrUInt8: writer.Uint(value.u8); break;
+        case NDAttrInt16: writer.Int(value.i16); break;
+        case NDAttrUInt16: writer.Uint(value.u16); break;
+        case NDAttrInt32: writer.Int(value.i32); break;
+        case NDAttrUInt32: writer.Uint(value.u32); break;
+        case NDAttrInt64: writer.Int64(value.i64); break;
+        case NDAttrUInt64: writer.Uint64(value.u64); break;
+        case NDAttrFloat32: writer.Double(value.f32); break;
+        case NDAttrFloat64: writer.Double(value.f64); break;
+        default: return false;
+        }
+    }
+    json.assign(string_buffer.GetString(), string_buffer.GetSize());
+    return true;
+}
+
+
+// Attributes in the allow-list of the worker whose value is not the one
+// sent with the previous frame, the ones gone are sent as null
+void ADExternalPlugin::_collect_attr_changes(
+    struct worker_context *worker, NDArray *pArray, attr_changes &changes)
+{
+    std::string json;
+    for (const std::string &name : worker->attr_names) {
+        NDAttribute *pAttr = pArray->pAttributeList->find(name.c_str());
+        auto it = worker->attr_values.find(name);
+        if (!pAttr || !attr_value_to_json(pAttr, json)) {
+            if (it != worker->attr_values.end()) {
+                worker->attr_values.erase(it);
+                changes.push_back(std::make_pair(&name, "null"));
+            }
+        } else if (it == worker->attr_values.end() || it->second != json) {
+            worker->attr_values[name] = json;
+            changes.push_back(std::make_pair(&name, json));
+        }
+    }
+}
+
+
 void ADExternalPlugin::_populate_attrs_in_json(
-    rapidjson::Writer<rapidjson::StringBuffer> &writer, NDArray *pArray)
+    rapidjson::Writer<rapidjson::StringBuffer> &writer,
+    const attr_changes &changes)
 {
     writer.String("attrs");
     writer.StartObject();
-    // TODO: to be implemented
+    for (auto &change : changes) {
+        writer.String(change.first->c_str());
+        writer.RawValue(change.second.c_str(), change.second.size(),
+            rapidjson::kObjectType);
+    }
     writer.EndObject();
 }
 
@@ -100,7 +332,7 @@ void ADExternalPlugin::_populate_attrs_in_frame(
             int ival = it->value.GetInt();
             pArray->pAttributeList->add(name, name, NDAttrInt32, &ival);
         } else if (it->value.IsDouble()) {
-            int dval = it->value.GetDouble();
+            double dval = it->value.GetDouble();
             pArray->pAttributeList->add(name, name, NDAttrFloat64, &dval);
         } else if (it->value.IsString()) {
             const char *sval = it->value.GetString();
@@ -2,6 +2,8 @@
 #include <limits.h>
 #include <unistd.h>
 
+#include <algorithm>
+
 #include <epicsTime.h>
 #include <epicsExit.h>
 
@@ -20,6 +22,23 @@ void ADExternalPlugin::_process_handshake_worker_message(
         server_connection_close(worker->con);
         return;
     }
+    it = data.FindMember("max_inflight");
+    if (it != data.MemberEnd() && it->value.IsInt() && it->value.GetInt() > 1)
+        worker->max_inflight =
+            std::min((size_t) it->value.GetInt(), (size_t) MAX_INFLIGHT_FRAMES);
+
+    it = data.FindMember("binary_frames");
+    if (it != data.MemberEnd() && it->value.IsBool())
+        worker->binary_frames = it->value.GetBool();
+
+    it = data.FindMember("attrs");
+    if (it != data.MemberEnd() && it->value.IsArray()) {
+        for (auto &name : it->value.GetArray()) {
+            if (name.IsString())
+                worker->attr_names.push_back(name.GetString());
+        }
+    }
+
     int nWorkers = 0;
     _send_handshake_ok(worker);
     pthread_mutex_lock(&workersMutex);
@@ -44,6 +63,12 @@ void ADExternalPlugin::_send_handshake_ok(struct worker_context *worker)
     writer.Bool(true);
     writer.String("shm_name");
     writer.String(shmName.c_str());
+    writer.String("max_inflight");
+    writer.Uint((unsigned) worker->max_inflight);
+    writer.String("binary_frames");
+    writer.Bool(worker->binary_frames);
+    writer.String("identity");
+    writer.String(identity.c_str());
     _populate_vars_in_json(writer);
     writer.EndObject();
     ssize_t rc;
@@ -32,18 +32,30 @@ const char *ad_data_type_to_string(NDDataType_t t)
 }
 
 
+static const char *data_type_names[] = {"int8", "uint8", "int16", "uint16",
+                                        "int32", "uint32", "int64", "uint64",
+                                        "float32", "float64"};
+static const NDDataType_t data_types[] = {NDInt8, NDUInt8, NDInt16, NDUInt16,
+                                          NDInt32, NDUInt32, NDInt64,
+                                          NDUInt64, NDFloat32, NDFloat64};
+
+
 NDDataType_t ad_data_type_from_string(const char *t)
 {
-    const char *names[] = {"int8", "uint8", "int16", "uint16",
-                           "int32", "uint32", "int64", "uint64",
-                           "float32", "float64"};
-    NDDataType_t types[] = {NDInt8, NDUInt8, NDInt16, NDUInt16,
-                            NDInt32, NDUInt32, NDInt64, NDUInt64,
-                            NDFloat32, NDFloat64};
     for (size_t i=0; i < 10; i++) {
-        if (strcmp(t, names[i]) == 0)
-            return types[i];
+        if (strcmp(t, data_type_names[i]) == 0)
+            return data_types[i];
     }
     // there is no 'unknown' type in NDDataType_t
     return NDInt8;
 }
+
+
+bool ad_data_type_is_valid(const char *t)
+{
+    for (size_t i=0; i < 10; i++) {
+        if (strcmp(t, data_type_names[i]) == 0)
+            return true;
+    }
+    return false;
+}
@@ -7,4 +7,7 @@ const char *ad_data_type_to_string(NDDataType_t t);
 
 NDDataType_t ad_data_type_from_string(const char *t);
 
+// whether t is the name of one of the NDDataType_t types
+bool ad_data_type_is_valid(const char *t);
+
 #endif
@@ -11,9 +11,17 @@ top_dir = os.path.dirname(etc_dir)
 
 # worker type choices
 WORKER_TYPES = ['Template', 'Gaussian2DFitter', 'MedianFilter', 'AutoExposure']
+# in the order of the values of ZmqOverflowPolicy
+ZMQ_OVERFLOW_CHOICES = ['block', 'drop-oldest', 'drop-newest']
 START_WORKER_SCRIPT = """#!/usr/bin/env bash
 {python} {worker_path} {socket_path}
 """
+START_PARALLEL_WORKER_SCRIPT = """#!/usr/bin/env bash
+{python} {host_path} --lanes {lanes} --mode {mode} {socket_path} {class_name}
+"""
+START_CHAIN_WORKER_SCRIPT = """#!/usr/bin/env bash
+{python} {chain_path} {socket_path} {class_names}
+"""
 START_ZMQWORKER_SCRIPT = """#!/usr/bin/env bash
 {python} {worker_path} {options} {socket_path} {class_name} {endpoint}
 """
@@ -60,6 +68,10 @@ class AutoExposureTemplate(AutoSubstitution):
     TemplateFile = 'ADExternalAutoExposure.template'
 
 
+class ZmqForwarderTemplate(AutoSubstitution):
+    TemplateFile = 'ADExternalZmqForwarder.template'
+
+
 # Main device class
 class ADExternal(AsynPort):
 
@@ -78,7 +90,7 @@ class ADExternal(AsynPort):
     def __init__(self, PORT, P, R, CLASS_NAME, NDARRAY_PORT,
                  NDARRAY_ADDR=0, IDENTITY="", SOCKET_PATH="/tmp/ext1.sock",
                  SHM_NAME="", PYTHON="", QUEUE=5, BLOCK=1, MEMORY=0, PRIORITY=0,
-                 STACKSIZE=0, TIMEOUT=1, **args):
+                 STACKSIZE=0, TIMEOUT=1, LANES=1, LANES_MODE="thread", **args):
         self.__super.__init__(PORT)
         self.__dict__.update(locals())
         self.createWorkerScript()
@@ -91,6 +103,16 @@ class ADExternal(AsynPort):
         sock_name = os.path.splitext(os.path.basename(self.SOCKET_PATH))[0]
         self.startWorkerScript = IocDataStream(
             'worker_{}_{}.sh'.format(self.CLASS_NAME, sock_name), 0555)
+        if self.LANES > 1:
+            # one process serving several connections to the same plugin
+            host_path = "{}/worker/python/ParallelWorkerHost.py".format(
+                top_dir)
+            self.startWorkerScript.write(START_PARALLEL_WORKER_SCRIPT.format(
+                python=self.PYTHON, host_path=host_path, lanes=self.LANES,
+                mode=self.LANES_MODE, socket_path=self.SOCKET_PATH,
+                class_name=self.CLASS_NAME))
+            return
+
         worker_path = "{}/worker/python/{}.py".format(top_dir, self.CLASS_NAME)
         self.startWorkerScript.write(START_WORKER_SCRIPT.format(
             python=self.PYTHON, worker_path=worker_path,
@@ -136,6 +158,52 @@ class ADExternal(AsynPort):
         MEMORY = Simple("Memory", int),
         PRIORITY = Simple("Priority", int),
         STACKSIZE = Simple("Stack size", int),
+        TIMEOUT = Simple("Timeout", int),
+        LANES = Simple("Connections opened by a single worker process", int),
+        LANES_MODE = Choice("How lanes run", ["thread", "process"])
+        )
+
+
+# ADExternal running several worker classes on every frame through one
+# connection, see ChainPlugin, the AD plugin is configured with their names
+# joined by "+" and the template of each worker has to be loaded
+class ADExternalChain(ADExternal):
+    def __init__(self, PORT, P, R, STAGES, NDARRAY_PORT, NDARRAY_ADDR=0,
+                 IDENTITY="", SOCKET_PATH="/tmp/ext1.sock", SHM_NAME="",
+                 PYTHON="", QUEUE=5, BLOCK=1, MEMORY=0, PRIORITY=0,
+                 STACKSIZE=0, TIMEOUT=1, **args):
+        self.STAGES = STAGES.split()
+        ADExternal.__init__(self, PORT, P, R, '+'.join(self.STAGES),
+                            NDARRAY_PORT, NDARRAY_ADDR, IDENTITY, SOCKET_PATH,
+                            SHM_NAME, PYTHON, QUEUE, BLOCK, MEMORY, PRIORITY,
+                            STACKSIZE, TIMEOUT, **args)
+
+    def createWorkerScript(self):
+        sock_name = os.path.splitext(os.path.basename(self.SOCKET_PATH))[0]
+        self.startWorkerScript = IocDataStream(
+            'worker_{}_{}.sh'.format('_'.join(self.STAGES), sock_name), 0555)
+        chain_path = '{}/worker/python/ChainPlugin.py'.format(top_dir)
+        self.startWorkerScript.write(START_CHAIN_WORKER_SCRIPT.format(
+            python=self.PYTHON, chain_path=chain_path,
+            socket_path=self.SOCKET_PATH, class_names=' '.join(self.STAGES)))
+
+    ArgInfo = makeArgInfo(__init__,
+        PORT = Simple("Port name", str),
+        P = Simple("PV prefix 1", str),
+        R = Simple("PV prefix 2", str),
+        STAGES = Simple("Worker classes run in order, separated by spaces",
+                        str),
+        IDENTITY = Simple("Source identity", str),
+        NDARRAY_PORT = Ident('Input array port', AsynPort),
+        NDARRAY_ADDR = Simple('Input array port address', int),
+        SOCKET_PATH = Simple("Path to unix socket", str),
+        SHM_NAME = Simple("Shared memory name", str),
+        PYTHON = Simple("Path to python used to run the workers", str),
+        QUEUE = Simple('Input array queue size', int),
+        BLOCK = Simple('Blocking callbacks?', int),
+        MEMORY = Simple("Memory", int),
+        PRIORITY = Simple("Priority", int),
+        STACKSIZE = Simple("Stack size", int),
         TIMEOUT = Simple("Timeout", int)
         )
 
@@ -146,13 +214,22 @@ class ADExternalZmqForwarder(ADExternal):
     def __init__(self, PORT, P, R, ENDPOINT, CLASS_NAME, NDARRAY_PORT,
                  SEND_DATA=False, NDARRAY_ADDR=0, IDENTITY="",
                  SOCKET_PATH="/tmp/ext1.sock", SHM_NAME="", PYTHON="", QUEUE=5,
-                 BLOCK=1, MEMORY=0, PRIORITY=0, STACKSIZE=0, TIMEOUT=1, **args):
+                 BLOCK=1, MEMORY=0, PRIORITY=0, STACKSIZE=0, TIMEOUT=1,
+                 ZMQ_QUEUE_SIZE=16, ZMQ_OVERFLOW="drop-oldest",
+                 ZERO_COPY=False, **args):
         self.ENDPOINT = ENDPOINT
         self.SEND_DATA = SEND_DATA
+        self.ZERO_COPY = ZERO_COPY
+        self.ZMQ_QUEUE_SIZE = ZMQ_QUEUE_SIZE
+        self.ZMQ_OVERFLOW = ZMQ_OVERFLOW
         ADExternal.__init__(self, PORT, P, R, CLASS_NAME,
                             NDARRAY_PORT, NDARRAY_ADDR, IDENTITY, SOCKET_PATH,
                             SHM_NAME, PYTHON, QUEUE, BLOCK, MEMORY, PRIORITY,
                             STACKSIZE, TIMEOUT, **args)
+        ZmqForwarderTemplate(
+            PORT=PORT, ADDR=0, P=P, R=R, TIMEOUT=TIMEOUT,
+            ZMQ_QUEUE_SIZE=ZMQ_QUEUE_SIZE,
+            ZMQ_OVERFLOW_POLICY=ZMQ_OVERFLOW_CHOICES.index(ZMQ_OVERFLOW))
 
 
     def createWorkerScript(self):
@@ -160,7 +237,12 @@ class ADExternalZmqForwarder(ADExternal):
         self.startWorkerScript = IocDataStream(
             'worker_{}_{}.sh'.format(self.CLASS_NAME, sock_name), 0555)
         worker_path = '{}/worker/python/ZmqForwarder.py'.format(top_dir)
-        options = '' if not self.SEND_DATA else '--with_frame_data'
+        options = '--queue-size {} --overflow {}'.format(
+            self.ZMQ_QUEUE_SIZE, self.ZMQ_OVERFLOW)
+        if self.SEND_DATA:
+            options += ' --with-frame-data'
+        if self.ZERO_COPY:
+            options += ' --zero-copy'
         self.startWorkerScript.write(START_ZMQWORKER_SCRIPT.format(
             python=self.PYTHON, worker_path=worker_path,
             socket_path=self.SOCKET_PATH, class_name=self.CLASS_NAME,
@@ -184,5 +266,9 @@ class ADExternalZmqForwarder(ADExternal):
         MEMORY = Simple("Memory", int),
         PRIORITY = Simple("Priority", int),
         STACKSIZE = Simple("Stack size", int),
-        TIMEOUT = Simple("Timeout", int)
+        TIMEOUT = Simple("Timeout", int),
+        ZMQ_QUEUE_SIZE = Simple("Messages waiting to be sent", int),
+        ZMQ_OVERFLOW = Choice("What to do when the queue is full",
+                              ZMQ_OVERFLOW_CHOICES),
+        ZERO_COPY = Simple("Send frame data from the shared memory", bool)
         )
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import timeit
+
+import numpy
+
+from fakeserver import FakeServer, encode_binary_frame_msg
+
+from ADExternalPlugin import ADExternalPlugin, PARAMS_FIELD, \
+    decode_binary_frame_msg, encode_binary_reply_msg
+
+# Compares JSON and binary framing of the per-frame messages: cost of
+# encoding/decoding a single message and frames/sec of a worker that does no
+# processing, talking to a FakeServer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=768)
+    parser.add_argument('--data-type', default='uint8')
+    parser.add_argument('--nframes', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=100000,
+                        help='Iterations of the encode/decode microbenchmark')
+    parser.add_argument('--shm-name', default='shm_benchframing')
+    return parser.parse_args()
+
+
+def frame_msg(width, height, data_type, frame_id):
+    return {
+        'frame_dims': [width, height],
+        'identity': '',
+        'data_type': data_type,
+        'frame_id': frame_id,
+        'frame_loc': 0,
+        'ts': 41810261.4522744,
+        'epics_ts': 1041810261452274400
+    }
+
+
+def microbenchmark(args):
+    in_msg = frame_msg(args.width, args.height, args.data_type, 42)
+    out_msg = {'push_frame': True, PARAMS_FIELD: {}, 'frame_id': 42}
+    json_in = json.dumps(in_msg).encode()
+    binary_in = encode_binary_frame_msg(in_msg)
+    cases = [
+        ('json', 'decode frame', lambda: json.loads(json_in)),
+        ('json', 'encode reply', lambda: json.dumps(out_msg).encode()),
+        ('binary', 'decode frame', lambda: decode_binary_frame_msg(binary_in)),
+        ('binary', 'encode reply', lambda: encode_binary_reply_msg(out_msg)),
+    ]
+    results = []
+    for fmt, what, func in cases:
+        elapsed = min(timeit.repeat(func, number=args.repeat, repeat=3))
+        results.append({
+            'format': fmt,
+            'operation': what,
+            'ns_per_msg': elapsed / args.repeat * 1e9
+        })
+
+    return results
+
+
+def end_to_end(args, binary):
+    socket_path = '/tmp/benchframing_%d.sock' % (os.getpid(),)
+    frame = numpy.zeros((args.height, args.width), args.data_type)
+    server = FakeServer(socket_path, args.shm_name, frame.nbytes)
+    worker = ADExternalPlugin(socket_path, binary_frames=binary)
+    thread = threading.Thread(target=worker.run)
+    thread.start()
+    try:
+        server.accept(1)
+        start = time.time()
+        # frame data is left alone, only the messages are measured
+        server.run_frames([frame], args.nframes, fill=False)
+        elapsed = time.time() - start
+    finally:
+        server.close()
+        thread.join()
+
+    return {
+        'format': 'binary' if binary else 'json',
+        'frames': args.nframes,
+        'fps': args.nframes / elapsed
+    }
+
+
+def main():
+    args = parse_args()
+    results = {
+        'microbenchmark': microbenchmark(args),
+        'end_to_end': [end_to_end(args, False), end_to_end(args, True)]
+    }
+    json.dump(results, sys.stdout, indent=2)
+    sys.stdout.write('\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+import argparse
+import itertools
+import json
+import os
+import sys
+import time
+
+import numpy
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    '..', 'worker', 'python'))
+
+from MedianFilter import MedianFilter, ENGINE_NAMES, ENGINE_HISTOGRAM, \
+    HISTOGRAM_DTYPES, rank_median  # noqa: E402
+
+# Frames/sec of every MedianFilter engine for a range of kernel sizes, calling
+# process_array directly so only the filter is measured. One JSON object per
+# case is written to the output. Cases an engine can't run are skipped, they
+# would measure the scipy fallback under its name.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--engines', nargs='+', default=list(ENGINE_NAMES.values()),
+        choices=list(ENGINE_NAMES.values()))
+    parser.add_argument('--kernel-sizes', nargs='+', type=int,
+                        default=[3, 5, 7, 9])
+    parser.add_argument(
+        '--sizes', nargs='+', default=['1024x1024'],
+        help='Frame sizes as WIDTHxHEIGHT')
+    parser.add_argument('--data-types', nargs='+', default=['uint16'])
+    parser.add_argument('--threads', type=int, default=0,
+                        help='Threads of the tiled engine, 0 for all cores')
+    parser.add_argument('--nframes', type=int, default=5)
+    parser.add_argument('--output', help='File to append results to')
+    return parser.parse_args()
+
+
+# the histogram engine needs scikit-image and 2D 8 or 16 bit frames
+def engine_supported(engine, frame):
+    if engine != ENGINE_HISTOGRAM:
+        return True
+
+    return rank_median is not None and frame.ndim == 2 and \
+        frame.dtype.name in HISTOGRAM_DTYPES
+
+
+def run_case(plugin, engine, kernel_size, frame, nframes):
+    plugin['iMedianFilterEngine'] = engine
+    plugin['iMedianFilterSize'] = kernel_size
+    # warm up, creates the thread pool of the tiled engine
+    plugin.process_array(frame, {})
+    start = time.perf_counter()
+    for _ in range(nframes):
+        plugin.process_array(frame, {})
+
+    return nframes / (time.perf_counter() - start)
+
+
+def main():
+    args = parse_args()
+    engines = {name: engine for engine, name in ENGINE_NAMES.items()}
+    plugin = MedianFilter(None)
+    plugin['iMedianFilterThreads'] = args.threads
+    output = open(args.output, 'a') if args.output else sys.stdout
+    rng = numpy.random.default_rng(0)
+    for size, data_type in itertools.product(args.sizes, args.data_types):
+        width, height = (int(n) for n in size.split('x'))
+        top = min(numpy.iinfo(data_type).max, 4000) \
+            if numpy.dtype(data_type).kind in 'iu' else 4000.0
+        frame = rng.uniform(0, top, (height, width)).astype(data_type)
+        for name, kernel_size in itertools.product(
+                args.engines, args.kernel_sizes):
+            if not engine_supported(engines[name], frame):
+                sys.stderr.write('Skipping %s on %s frames, %s\n' % (
+                    name, data_type,
+                    'scikit-image not found' if rank_median is None
+                    else 'type not supported'))
+                continue
+
+            fps = run_case(
+                plugin, engines[name], kernel_size, frame, args.nframes)
+            output.write(json.dumps({
+                'engine': name,
+                'kernel_size': kernel_size,
+                'width': width,
+                'height': height,
+                'data_type': data_type,
+                'threads': plugin.executor_threads if name == 'tiled' else 1,
+                'fps': fps,
+            }) + '\n')
+            output.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+import argparse
+import itertools
+import json
+import logging
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import numpy
+
+from fakeserver import FakeServer
+
+log = logging.getLogger(__name__)
+
+WORKER_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), '..', 'worker', 'python')
+
+# Measures worker throughput without an IOC: every worker class is started as
+# a separate process, as it would be in production, and driven by a
+# FakeServer with synthetic frames. One JSON object per case is written to
+# the output, so results can be tracked over time.
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        '--classes', nargs='+', default=['Template', 'MedianFilter',
+                                         'AutoExposure', 'Gaussian2DFitter'])
+    parser.add_argument(
+        '--sizes', nargs='+', default=['512x512', '1024x1024'],
+        help='Frame sizes as WIDTHxHEIGHT')
+    parser.add_argument(
+        '--data-types', nargs='+', default=['uint8', 'uint16'])
+    parser.add_argument(
+        '--workers', nargs='+', type=int, default=[1, 2],
+        help='Number of worker processes')
+    parser.add_argument('--nframes', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument(
+        '--param', action='append', default=[],
+        help='Parameter sent to the workers, as NAME=VALUE')
+    parser.add_argument(
+        '--worker-args', default='',
+        help='Extra arguments for the worker scripts, e.g. "--max-inflight 4"')
+    parser.add_argument('--shm-name', default='shm_benchworkers')
+    parser.add_argument('--shm-size', type=int, default=256*1024*1024)
+    parser.add_argument('--output', help='File to append results to')
+    parser.add_argument('--loglevel', default='WARNING')
+    return parser.parse_args()
+
+
+def parse_param(text):
+    name, value = text.split('=', 1)
+    if name.startswith('i'):
+        return name, int(value)
+    elif name.startswith('d'):
+        return name, float(value)
+
+    return name, value
+
+
+# a gaussian spot over some noise, moving a bit on every frame, so fitters and
+# exposure controllers have something realistic to chew on
+def synthetic_frames(width, height, data_type, count=8):
+    info = numpy.iinfo(data_type) if numpy.dtype(data_type).kind in 'iu' \
+        else None
+    top = min(info.max, 4000) if info else 4000.0
+    rng = numpy.random.default_rng(0)
+    y, x = numpy.mgrid[0:height, 0:width]
+    frames = []
+    for i in range(count):
+        cx = width * (0.4 + 0.2 * i / count)
+        cy = height * (0.6 - 0.2 * i / count)
+        spot = numpy.exp(-((x - cx) ** 2 / (2 * (width / 20) ** 2) +
+                           (y - cy) ** 2 / (2 * (height / 30) ** 2)))
+        frame = 0.8 * top * spot + rng.uniform(0, 0.05 * top, spot.shape)
+        frames.append(numpy.ascontiguousarray(frame.astype(data_type)))
+
+    return frames
+
+
+# user + system time of running processes, all their threads included, from
+# /proc/<pid>/stat (utime and stime, in clock ticks, follow the command name)
+def procs_cpu_time(procs):
+    ticks = 0
+    for proc in procs:
+        with open('/proc/%d/stat' % (proc.pid,)) as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+
+        ticks += int(fields[11]) + int(fields[12])
+
+    return ticks / os.sysconf('SC_CLK_TCK')
+
+
+def accept_workers(server, procs, nworkers, timeout=30.0):
+    deadline = time.time() + timeout
+    while len(server.workers) < nworkers:
+        if any(proc.poll() is not None for proc in procs):
+            raise RuntimeError('Worker exited during start up')
+
+        if time.time() > deadline:
+            raise TimeoutError('Workers did not connect')
+
+        try:
+            server.accept(len(server.workers) + 1, timeout=1.0)
+        except socket.timeout:
+            pass
+
+
+def run_case(args, class_name, width, height, data_type, nworkers, params):
+    socket_path = '/tmp/benchworkers_%d.sock' % (os.getpid(),)
+    server = FakeServer(socket_path, args.shm_name, args.shm_size,
+                        class_name, params)
+    worker_cmd = [sys.executable, os.path.join(WORKER_DIR, class_name + '.py'),
+                  socket_path] + args.worker_args.split()
+    procs = [subprocess.Popen(worker_cmd) for _ in range(nworkers)]
+    result = {
+        'class_name': class_name,
+        'width': width,
+        'height': height,
+        'data_type': data_type,
+        'workers': nworkers,
+        'worker_args': args.worker_args,
+        'params': params,
+        'timestamp': time.time(),
+    }
+    try:
+        accept_workers(server, procs, nworkers)
+        frames = synthetic_frames(width, height, data_type)
+        server.run_frames(frames, args.warmup)
+        server.reset_counters()
+        cpu_before = procs_cpu_time(procs)
+        start = time.perf_counter()
+        server.run_frames(frames, args.nframes)
+        elapsed = time.perf_counter() - start
+        # the workers are still alive, only the timed frames are counted
+        cpu = procs_cpu_time(procs) - cpu_before
+    except Exception as e:
+        log.error('%s failed: %s', class_name, e)
+        result['error'] = str(e)
+        return result
+    finally:
+        # workers leave when the server goes away
+        server.close()
+        for proc in procs:
+            try:
+                proc.wait(10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+    latencies = numpy.array(server.latencies) * 1000
+    result.update({
+        'frames': server.released,
+        'pushed': server.pushed,
+        'out_of_order': server.out_of_order,
+        'fps': server.released / elapsed,
+        'latency_ms_p50': float(numpy.percentile(latencies, 50)),
+        'latency_ms_p90': float(numpy.percentile(latencies, 90)),
+        'latency_ms_p99': float(numpy.percentile(latencies, 99)),
+        'worker_cpu_ms_per_frame': cpu * 1000 / server.released,
+    })
+    return result
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=args.loglevel)
+    params = dict(parse_param(text) for text in args.param)
+    output = open(args.output, 'a') if args.output else sys.stdout
+    for class_name, size, data_type, nworkers in itertools.product(
+            args.classes, args.sizes, args.data_types, args.workers):
+        width, height = (int(n) for n in size.split('x'))
+        result = run_case(
+            args, class_name, width, height, data_type, nworkers, params)
+        output.write(json.dumps(result) + '\n')
+        output.flush()
+
+
+if __name__ == '__main__':
+    main()
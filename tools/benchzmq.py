@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import numpy
+
+from fakeserver import FakeServer
+
+from Template import Template, MODE_DONOTHING
+from ZmqForwarder import ZmqForwarder, OVERFLOW_BLOCK, COMPRESS_NAMES
+from ZmqReceiver import ZmqReceiver
+
+# Throughput of frames going from a worker through ZmqForwarder to a
+# ZmqReceiver in another process, over ipc://. The forwarder blocks when the
+# receiver falls behind, so every frame is received and the rate is the one
+# of the slowest side. One JSON object per case is written to the output
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--width', type=int, default=1024)
+    parser.add_argument('--height', type=int, default=1024)
+    parser.add_argument('--data-type', default='uint16')
+    parser.add_argument('--nframes', type=int, default=2000)
+    parser.add_argument(
+        '--compress', nargs='+', choices=sorted(COMPRESS_NAMES),
+        default=['none', 'zlib'])
+    parser.add_argument(
+        '--ring-sizes', nargs='+', type=int, default=[0, 8],
+        help='Ring sizes of the receiver, 0 keeps the ZMQ messages')
+    parser.add_argument('--queue-size', type=int, default=16)
+    parser.add_argument('--shm-name', default='shm_benchzmq')
+    return parser.parse_args()
+
+
+def receive(endpoint, ring_size, nframes, ready, results):
+    receiver = ZmqReceiver(endpoint, ring_size=ring_size)
+    ready.set()
+    nbytes = 0
+    received = 0
+    start = None
+    while received < nframes:
+        frame = receiver.recv(timeout=10)
+        if frame is None:
+            break
+
+        if start is None:
+            start = time.time()
+
+        # the first frame starts the clock
+        received += 1
+        if received > 1 and frame[2] is not None:
+            nbytes += frame[2].nbytes
+
+    elapsed = time.time() - start if start is not None else 0.0
+    receiver.close()
+    results.send((received, nbytes, elapsed))
+
+
+def run_case(args, frame, zero_copy, compress, ring_size):
+    endpoint = 'ipc:///tmp/benchzmq_%d.ipc' % (os.getpid(),)
+    socket_path = '/tmp/benchzmq_%d.sock' % (os.getpid(),)
+    context = multiprocessing.get_context('fork')
+    ready = context.Event()
+    results, child_results = context.Pipe(False)
+    receiver = context.Process(
+        target=receive,
+        args=(endpoint, ring_size, args.nframes, ready, child_results))
+    receiver.start()
+    ready.wait()
+
+    # room for the frames held by the forwarder and in flight
+    server = FakeServer(socket_path, args.shm_name,
+                        frame.nbytes * (2 * args.queue_size + 4))
+    target = Template(socket_path)
+    target['iInt3'] = MODE_DONOTHING
+    forwarder = ZmqForwarder(
+        target, socket_path, endpoint, True, queue_size=args.queue_size,
+        overflow=OVERFLOW_BLOCK, zero_copy=zero_copy,
+        compression=COMPRESS_NAMES[compress])
+    thread = threading.Thread(target=forwarder.run)
+    thread.start()
+    try:
+        server.accept(1)
+        server.run_frames([frame], args.nframes)
+    finally:
+        server.close()
+        thread.join()
+
+    received, nbytes, elapsed = results.recv()
+    receiver.join()
+    return {
+        'zero_copy': zero_copy,
+        'compress': compress,
+        'ring_size': ring_size,
+        'frames': received,
+        'fps': (received - 1) / elapsed if elapsed else 0.0,
+        'mb_per_sec': nbytes / elapsed / 1e6 if elapsed else 0.0
+    }
+
+
+def main():
+    args = parse_args()
+    frame = numpy.random.default_rng(0).integers(
+        0, 1000, (args.height, args.width)).astype(args.data_type)
+    for compress in args.compress:
+        for zero_copy in (False, True):
+            for ring_size in args.ring_sizes:
+                result = run_case(args, frame, zero_copy, compress, ring_size)
+                json.dump(result, sys.stdout)
+                sys.stdout.write('\n')
+                sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
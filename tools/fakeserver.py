@@ -0,0 +1,340 @@
+#!/usr/bin/env python
+import json
+import logging
+import mmap
+import os
+import selectors
+import socket
+import sys
+import time
+
+import numpy
+
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                    '..', 'worker', 'python'))
+
+from ADExternalPlugin import BINARY_FRAME_MSG, BINARY_REPLY_MSG, \
+    BINARY_REPLY_PUSH_FRAME, BINARY_REPLY_FRAME_ID, BINARY_REPLY_OUT_LOC, \
+    BINARY_REPLY_RETAIN, DATA_TYPE_CODES, DIMS_FORMATS, FRAME_HEADER, \
+    OUT_LOC_FORMAT, REPLY_HEADER, ATTRS_FIELD, PARAMS_FIELD  # noqa: E402
+
+# Stand-in for the C++ side of ADExternal, good enough to drive workers
+# without an IOC: handshake, shared memory allocation, frame dispatch with an
+# in-flight window per worker and push/release accounting
+
+MAX_INFLIGHT_FRAMES = 16
+
+
+def encode_binary_frame_msg(msg):
+    dims = msg['frame_dims']
+    return FRAME_HEADER.pack(
+        BINARY_FRAME_MSG, len(dims), DATA_TYPE_CODES[msg['data_type']],
+        msg['frame_id'], msg['frame_loc'], msg['ts'], msg['epics_ts']) + \
+        DIMS_FORMATS[len(dims)].pack(*dims) + \
+        (json.dumps({ATTRS_FIELD: msg[ATTRS_FIELD]}).encode()
+         if msg.get(ATTRS_FIELD) else b'')
+
+
+def decode_binary_reply_msg(data):
+    _, flags, ndims, _, frame_id = REPLY_HEADER.unpack_from(data)
+    msg = {'push_frame': bool(flags & BINARY_REPLY_PUSH_FRAME)}
+    if flags & BINARY_REPLY_FRAME_ID:
+        msg['frame_id'] = frame_id
+
+    if flags & BINARY_REPLY_RETAIN:
+        msg['retain'] = True
+
+    offset = REPLY_HEADER.size + DIMS_FORMATS[ndims].size
+    if flags & BINARY_REPLY_OUT_LOC:
+        msg['out_loc'], = OUT_LOC_FORMAT.unpack_from(data, offset)
+        offset += OUT_LOC_FORMAT.size
+
+    trailer = data[offset:]
+    if trailer:
+        msg.update(json.loads(trailer))
+
+    return msg
+
+
+class FakeSharedMem(object):
+    def __init__(self, shm_name, size):
+        self.shm_name = shm_name
+        self.filepath = '/dev/shm/%s' % (shm_name,)
+        self.size = size
+        self.fd = os.open(self.filepath, os.O_RDWR | os.O_CREAT)
+        os.ftruncate(self.fd, self.size)
+        self.mem = mmap.mmap(self.fd, self.size)
+        self.mem_view = numpy.frombuffer(self.mem, 'uint8')
+        self.free_list = [(0, self.size)]
+        self.occupied_size = {}
+
+    def alloc(self, size):
+        for i, (off, sz) in enumerate(self.free_list):
+            if sz >= size:
+                self.free_list[i] = (off + size, sz - size)
+                self.occupied_size[off] = size
+                return off
+
+        return None
+
+    def free(self, off):
+        size = self.occupied_size.pop(off)
+        self.free_list.append((off, size))
+        # keep the list sorted and merged so big blocks can be found again
+        self.free_list.sort()
+        merged = []
+        for off, size in self.free_list:
+            if merged and merged[-1][0] + merged[-1][1] == off:
+                merged[-1] = (merged[-1][0], merged[-1][1] + size)
+            elif size:
+                merged.append((off, size))
+
+        self.free_list = merged
+
+    def get_view(self, off):
+        return self.mem_view[off:off + self.occupied_size[off]]
+
+    def destroy(self):
+        del self.mem_view
+        self.mem.close()
+        os.close(self.fd)
+        os.unlink(self.filepath)
+
+
+class WorkerConnection(object):
+    def __init__(self, sock, max_inflight, binary_frames):
+        self.sock = sock
+        self.max_inflight = max_inflight
+        self.binary_frames = binary_frames
+        # (frame_id, offset, time sent), oldest first
+        self.inflight = []
+        # offsets of the output frames allocated for the worker
+        self.outputs = set()
+        # offsets of the input frames the worker retained
+        self.retained = set()
+        self.params = {}
+        # attributes asked for in the handshake and their last values sent
+        self.attr_names = []
+        self.attr_values = {}
+
+    # attributes that changed since the previous frame, None if gone
+    def attr_changes(self, attrs):
+        changes = {}
+        for name in self.attr_names:
+            if name in attrs and self.attr_values.get(name) != attrs[name]:
+                changes[name] = self.attr_values[name] = attrs[name]
+            elif name not in attrs and name in self.attr_values:
+                del self.attr_values[name]
+                changes[name] = None
+
+        return changes
+
+    def send_json(self, msg):
+        self.sock.send(json.dumps(msg).encode())
+
+    def recv_msg(self):
+        data = self.sock.recv(1 << 20)
+        if data == b'':
+            return None
+
+        if data[:1] == BINARY_REPLY_MSG:
+            return decode_binary_reply_msg(data)
+
+        return json.loads(data)
+
+
+class FakeServer(object):
+    def __init__(self, socket_path, shm_name, shm_size, class_name=None,
+                 params=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.socket_path = socket_path
+        self.class_name = class_name
+        self.params = {} if params is None else dict(params)
+        # NDAttributes of the frames sent, the ones asked for are sent to
+        # the workers when they change
+        self.frame_attrs = {}
+        self.shm = FakeSharedMem(shm_name, shm_size)
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET, 0)
+        self.sock.bind(socket_path)
+        self.sock.listen(16)
+        self.workers = []
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.sent = 0
+        self.pushed = 0
+        self.released = 0
+        self.out_of_order = 0
+        self.allocated = 0
+        self.outputs_pushed = 0
+        self.latencies = []
+
+    def accept(self, nworkers=1, timeout=30.0):
+        self.sock.settimeout(timeout)
+        while len(self.workers) < nworkers:
+            sock, _ = self.sock.accept()
+            sock.settimeout(timeout)
+            worker = WorkerConnection(sock, 1, False)
+            handshake = worker.recv_msg()
+            if self.class_name and \
+                    handshake.get('class_name') != self.class_name:
+                worker.send_json(
+                    {'ok': False, 'err': 'class_name not expected'})
+                sock.close()
+                continue
+
+            worker.max_inflight = max(1, min(
+                handshake.get('max_inflight', 1), MAX_INFLIGHT_FRAMES))
+            worker.binary_frames = handshake.get('binary_frames', False)
+            worker.attr_names = handshake.get(ATTRS_FIELD, [])
+            worker.send_json({
+                'ok': True,
+                'shm_name': self.shm.shm_name,
+                'max_inflight': worker.max_inflight,
+                'binary_frames': worker.binary_frames,
+                'identity': '',
+                PARAMS_FIELD: self.params
+            })
+            # parameter values forced by the worker
+            worker.params.update(worker.recv_msg().get(PARAMS_FIELD, {}))
+            self.workers.append(worker)
+
+        return self.workers
+
+    def _send_frame(self, worker, frame, frame_id, fill):
+        off = self.shm.alloc(frame.nbytes)
+        if off is None:
+            return False
+
+        if fill:
+            self.shm.get_view(off)[:] = frame.reshape(-1).view('uint8')
+
+        msg = {
+            # NDArray order of dimensions
+            'frame_dims': list(reversed(frame.shape)),
+            'identity': '',
+            'data_type': frame.dtype.name,
+            'frame_id': frame_id,
+            'frame_loc': off,
+            'ts': time.time(),
+            'epics_ts': time.time_ns()
+        }
+        changes = worker.attr_changes(self.frame_attrs)
+        if changes:
+            msg[ATTRS_FIELD] = changes
+
+        worker.inflight.append((frame_id, off, time.perf_counter()))
+        if worker.binary_frames:
+            worker.sock.send(encode_binary_frame_msg(msg))
+        else:
+            worker.send_json(msg)
+
+        self.sent += 1
+        return True
+
+    def _alloc_output(self, worker, request):
+        dtype = numpy.dtype(request['data_type'])
+        nbytes = int(numpy.prod(request['frame_dims'])) * dtype.itemsize
+        off = self.shm.alloc(nbytes)
+        if off is None:
+            worker.send_json({'out_loc': None, 'err': 'no memory available'})
+            return
+
+        worker.outputs.add(off)
+        self.allocated += 1
+        worker.send_json({'out_loc': off})
+
+    def _handle_reply(self, worker, msg):
+        worker.params.update(msg.get(PARAMS_FIELD, {}))
+        for off in msg.get('release_frames', []):
+            worker.retained.remove(off)
+            self.shm.free(off)
+
+        if 'alloc_frame' in msg:
+            self._alloc_output(worker, msg['alloc_frame'])
+            return
+
+        if 'free_frame' in msg:
+            worker.outputs.remove(msg['free_frame'])
+            self.shm.free(msg['free_frame'])
+            return
+
+        if 'push_frame' not in msg or not worker.inflight:
+            return
+
+        # output frames are released as soon as they are pushed
+        for output in [msg] + msg.get('outputs', []):
+            if 'out_loc' in output:
+                worker.outputs.remove(output['out_loc'])
+                self.shm.free(output['out_loc'])
+                self.outputs_pushed += 1
+
+        frame_id, off, ts = worker.inflight.pop(0)
+        self.latencies.append(time.perf_counter() - ts)
+        if msg.get('frame_id', frame_id) != frame_id:
+            self.out_of_order += 1
+
+        if msg['push_frame']:
+            self.pushed += 1
+
+        self.released += 1
+        if msg.get('retain'):
+            worker.retained.add(off)
+        else:
+            self.shm.free(off)
+
+    # send nframes cycling over frames, always to the least loaded worker
+    # with room in its window, and wait until all of them are acknowledged,
+    # fill=False skips copying the frame data into the shared memory
+    def run_frames(self, frames, nframes, timeout=30.0, fill=True):
+        selector = selectors.DefaultSelector()
+        for worker in self.workers:
+            selector.register(worker.sock, selectors.EVENT_READ, worker)
+
+        frame_id = 0
+        while frame_id < nframes or \
+                any(worker.inflight for worker in self.workers):
+            while frame_id < nframes:
+                ready = [worker for worker in self.workers
+                         if len(worker.inflight) < worker.max_inflight]
+                if not ready:
+                    break
+
+                worker = min(ready, key=lambda w: len(w.inflight))
+                if not self._send_frame(
+                        worker, frames[frame_id % len(frames)], frame_id,
+                        fill):
+                    break
+
+                frame_id += 1
+
+            if not any(worker.inflight for worker in self.workers):
+                raise MemoryError('Shared memory too small for a frame')
+
+            events = selector.select(timeout)
+            if not events:
+                raise TimeoutError('No reply from workers')
+
+            for key, _ in events:
+                worker = key.data
+                msg = worker.recv_msg()
+                if msg is None:
+                    raise ConnectionError('Worker disconnected')
+
+                self._handle_reply(worker, msg)
+
+        selector.close()
+
+    def send_params(self, params):
+        for worker in self.workers:
+            worker.send_json({PARAMS_FIELD: params})
+
+    def close(self):
+        for worker in self.workers:
+            worker.sock.close()
+
+        self.workers = []
+        self.sock.close()
+        os.unlink(self.socket_path)
+        self.shm.destroy()
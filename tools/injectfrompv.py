@@ -91,6 +91,7 @@ class SocketServer(object):
         self.on_client_connected = on_client_connected
         self.on_client_disconnected = on_client_disconnected
         self.request_quit = False
+        self.recv_buffer = bytearray(4096)
 
     def bind_socket(self):
         if self.asynchronous:
@@ -150,6 +151,17 @@ class SocketServer(object):
         except (BrokenPipeError, ConnectionResetError):
             self.log.error('Failed to send data')
         
+    # messages keep their boundaries, the size of the next one is peeked
+    # first so the buffer can grow to fit it
+    def _recv(self):
+        nbytes = self.client.recv_into(
+            self.recv_buffer, 0, socket.MSG_PEEK | socket.MSG_TRUNC)
+        if nbytes > len(self.recv_buffer):
+            self.recv_buffer = bytearray(nbytes)
+
+        nbytes = self.client.recv_into(self.recv_buffer, 0)
+        return bytes(memoryview(self.recv_buffer)[:nbytes])
+
     def recv_json(self):
         if self.client is None:
             self.log.debug('No client connected when trying to receive data')
@@ -158,7 +170,7 @@ class SocketServer(object):
         client_disconnected = False
         data = b''
         try:
-            data = self.client.recv(4096)
+            data = self._recv()
             client_disconnected = data == b''
         except (BrokenPipeError, ConnectionResetError):
             client_disconnected = True
@@ -253,8 +265,27 @@ def main():
                 continue
 
             log.info('Received message: %s', msg)
+            if 'alloc_frame' in msg:
+                request = msg['alloc_frame']
+                out_loc = shm.alloc(
+                    int(numpy.prod(request['frame_dims'])) *
+                    numpy.dtype(request['data_type']).itemsize)
+                socket_server.send_json({'out_loc': out_loc})
+            elif 'free_frame' in msg:
+                shm.free(msg['free_frame'])
+
+            for off in msg.get('release_frames', []):
+                shm.free(off)
+
             if 'push_frame' in msg and shm_offsets:
-                shm.free(shm_offsets.popleft())
+                # retained frames wait for release_frames
+                off = shm_offsets.popleft()
+                if not msg.get('retain'):
+                    shm.free(off)
+                # nothing downstream, output frames go away as well
+                for output in [msg] + msg.get('outputs', []):
+                    if 'out_loc' in output:
+                        shm.free(output['out_loc'])
 
     cothread.Spawn(frame_releaser)
     listener = PVListener(args.data_pv, new_data_hook)
@@ -1,10 +1,18 @@
+import collections
 import ctypes
 import json
 import logging
 import mmap
 import numpy
 import os
+import select
 import socket
+import struct
+import threading
+import time
+import types
+
+from BufferPool import BufferPool
 
 try:
     from math import prod
@@ -17,23 +25,291 @@ except ImportError:
         return res
 
 
-MAX_RECV_LEN = 4096
+# size the receive buffer starts with, it grows to fit bigger messages
+RECV_BUFFER_LEN = 4096
 PARAMS_FIELD = 'vars'
 ATTRS_FIELD = 'attrs'
+OUTPUTS_FIELD = 'outputs'
+RELEASE_FIELD = 'release_frames'
+
+# Binary form of the per-frame messages, negotiated during the handshake, see
+# PROTOCOL.md. Data types are encoded with their index in DATA_TYPES, which
+# follows NDDataType_t
+BINARY_FRAME_MSG = b'F'
+BINARY_REPLY_MSG = b'R'
+BINARY_REPLY_PUSH_FRAME = 0x01
+BINARY_REPLY_FRAME_DIMS = 0x02
+BINARY_REPLY_DATA_TYPE = 0x04
+BINARY_REPLY_FRAME_ID = 0x08
+BINARY_REPLY_OUT_LOC = 0x10
+BINARY_REPLY_RETAIN = 0x20
+DATA_TYPES = ('int8', 'uint8', 'int16', 'uint16', 'int32', 'uint32',
+              'int64', 'uint64', 'float32', 'float64')
+DATA_TYPE_CODES = {name: code for code, name in enumerate(DATA_TYPES)}
+FRAME_HEADER = struct.Struct('=cBBxiQdQ')
+REPLY_HEADER = struct.Struct('=cBBBi')
+DIMS_FORMATS = [struct.Struct('=%dQ' % (ndims,)) for ndims in range(11)]
+OUT_LOC_FORMAT = struct.Struct('=Q')
+DEFAULT_OUT_BUFFER_MB = 256
+NO_ATTRS = types.MappingProxyType({})
+
+
+def decode_binary_frame_msg(data):
+    _, ndims, data_type, frame_id, frame_loc, ts, epics_ts = \
+        FRAME_HEADER.unpack_from(data)
+    msg = {
+        'frame_dims': list(
+            DIMS_FORMATS[ndims].unpack_from(data, FRAME_HEADER.size)),
+        'data_type': DATA_TYPES[data_type],
+        'frame_id': frame_id,
+        'frame_loc': frame_loc,
+        'ts': ts,
+        'epics_ts': epics_ts
+    }
+    # attributes that changed since the previous frame
+    offset = FRAME_HEADER.size + DIMS_FORMATS[ndims].size
+    if len(data) > offset:
+        msg.update(json.loads(bytes(data[offset:])))
+
+    return msg
+
+
+def encode_binary_reply_msg(msg):
+    flags = BINARY_REPLY_PUSH_FRAME if msg['push_frame'] else 0
+    frame_id = msg.get('frame_id')
+    if frame_id is not None:
+        flags |= BINARY_REPLY_FRAME_ID
+    else:
+        frame_id = 0
+
+    data_type = msg.get('data_type')
+    if data_type is not None:
+        flags |= BINARY_REPLY_DATA_TYPE
+        data_type = DATA_TYPE_CODES[data_type]
+    else:
+        data_type = 0
+
+    dims = msg.get('frame_dims', ())
+    if dims:
+        flags |= BINARY_REPLY_FRAME_DIMS
+
+    out_loc = msg.get('out_loc')
+    if out_loc is not None:
+        flags |= BINARY_REPLY_OUT_LOC
+
+    if msg.get('retain'):
+        flags |= BINARY_REPLY_RETAIN
+
+    data = REPLY_HEADER.pack(
+        BINARY_REPLY_MSG, flags, len(dims), data_type, frame_id) + \
+        DIMS_FORMATS[len(dims)].pack(*dims)
+    if out_loc is not None:
+        data += OUT_LOC_FORMAT.pack(out_loc)
+
+    # parameters, attributes, several outputs and released frames are only
+    # sent when there is something to say
+    trailer = {key: msg[key]
+               for key in (PARAMS_FIELD, ATTRS_FIELD, OUTPUTS_FIELD,
+                           RELEASE_FIELD)
+               if msg.get(key)}
+    if trailer:
+        data += json.dumps(trailer).encode()
+
+    return data
+
+
+def add_worker_arguments(parser):
+    parser.add_argument(
+        '--max-inflight', type=int, default=1,
+        help='Max number of frames sent to us before acknowledging them')
+    parser.add_argument(
+        '--binary-frames', action='store_true',
+        help='Use binary messages instead of JSON for frames')
+    parser.add_argument(
+        '--stats', action='store_true',
+        help='Publish timing statistics as parameters (dFps, dProcTimeP99...)')
+    parser.add_argument(
+        '--stats-dump', help='File where timing statistics are written to')
+    parser.add_argument(
+        '--stats-format', choices=('prometheus', 'json'),
+        help='Format of the statistics file, guessed from its name if missing')
+    parser.add_argument(
+        '--stats-period', type=float, default=1.0,
+        help='Seconds between statistics updates')
+    parser.add_argument(
+        '--out-buffer-mb', type=int, default=DEFAULT_OUT_BUFFER_MB,
+        help='Memory kept for output buffers between frames, in MiB')
+    parser.add_argument(
+        '--max-param-rate', type=float, default=0,
+        help='Max parameter updates sent per second, 0 for no limit')
+    parser.add_argument(
+        '--input-attrs', nargs='+', default=[], metavar='NAME',
+        help='NDAttributes of the input frames to get in in_attrs')
 
 
 class ADExternalPlugin(object):
+    # whether process_array can run for several frames at once, from the
+    # lanes of ParallelWorkerHost, workers keeping state between frames
+    # leave it False and get their frames one at a time
+    thread_safe = False
+
     # init our param dict
-    def __init__(self, socket_path, initial_params=None):
+    def __init__(self, socket_path, initial_params=None, max_inflight=1,
+                 binary_frames=False):
         self.log = logging.getLogger(self.__class__.__name__)
         self.socket_path = socket_path
+        self.sock = None
         self._params = {} if initial_params is None else dict(initial_params)
         self._new_params = {}
+        # values the AD plugin has, only changes to them are sent, at most
+        # max_param_rate times per second (0 is no limit)
+        self._published_params = {}
+        # parameters can be set from several threads (see ParallelWorkerHost)
+        self._params_lock = threading.RLock()
+        self.max_param_rate = 0
+        self._last_publish_ts = 0.0
         self.post_process_hook = None
+        self.max_inflight = max_inflight
+        self.binary_frames = binary_frames
+        self.identity = ''
+        self.stats = None
+        # max frames given to process_arrays at once
+        self.batch_size = 1
+        self.buffer_pool = BufferPool(DEFAULT_OUT_BUFFER_MB << 20)
+        # messages received while waiting for something else
+        self._pending_data = collections.deque()
+        # every message is received here, see _recv_raw
+        self._recv_buffer = bytearray(RECV_BUFFER_LEN)
+        # output frames allocated by the AD plugin, data address -> offset
+        self._outputs = {}
+        # input frames being processed, data address -> offset, the ones
+        # kept after replying and the ones to release with the next reply
+        self._frame_locs = {}
+        self._retained_locs = set()
+        self._released_locs = []
+        # NDAttributes sent with the frames, the AD plugin only sends the
+        # ones that changed
+        self.input_attrs = []
+        self._in_attrs = NO_ATTRS
+        # attributes of the frames being processed, per thread so the lanes
+        # of ParallelWorkerHost can share it
+        self._frame_state = threading.local()
 
     def set_post_process_hook(self, func):
         self.post_process_hook = func
 
+    # number of frames the server can send us before we acknowledge the
+    # first one, it is negotiated during the handshake
+    def set_max_inflight(self, max_inflight):
+        self.max_inflight = max_inflight
+
+    # use binary messages instead of JSON for frames, if the server agrees
+    def set_binary_frames(self, enabled):
+        self.binary_frames = enabled
+
+    # keep timing of every stage of the frame loop, see WorkerStats
+    def enable_stats(self, window=1000, period=1.0, dump_path=None,
+                     dump_format=None):
+        from WorkerStats import WorkerStats
+        self.stats = WorkerStats(window, period, dump_path, dump_format)
+
+    # memory kept in output buffers not in use, see out_buffer
+    def set_out_buffer_limit(self, nbytes):
+        self.buffer_pool.set_max_bytes(nbytes)
+
+    # array a worker can return instead of allocating a new one, it stays
+    # valid until the reply of the frame is sent, buffers are reused for
+    # later frames of the same shape and type
+    def out_buffer(self, shape, dtype):
+        return self.buffer_pool.get(shape, dtype)
+
+    # Frame allocated by the AD plugin in the shared memory, for results that
+    # don't fit in the input frame. Returning it from process_array pushes
+    # it instead of the input frame, without any copy. Raises MemoryError if
+    # the AD plugin can't allocate it, ValueError for types NDArrays don't
+    # have (see DATA_TYPES)
+    def alloc_output(self, shape, dtype):
+        dims = self._convert_dims(shape)
+        dtype_name = numpy.dtype(dtype).name
+        if dtype_name not in DATA_TYPE_CODES:
+            raise ValueError(
+                'Output frames can\'t be of type %s' % (dtype_name,))
+
+        msg = self._request_output(
+            {'frame_dims': list(dims), 'data_type': dtype_name})
+        if msg['out_loc'] is None:
+            raise MemoryError(
+                'Output frame not allocated: %s' % (msg.get('err'),))
+
+        arr = self._get_array_from_shared_memory(
+            msg['out_loc'], dims, dtype_name)
+        self._outputs[arr.ctypes.data] = msg['out_loc']
+        return arr
+
+    # send an alloc_frame request and wait for its reply
+    def _request_output(self, request):
+        self._send_msg({'alloc_frame': request})
+        while True:
+            data = self._recv_raw()
+            if data == b'':
+                raise ConnectionError('Disconnected waiting for an output')
+
+            msg = self._decode_msg(data)
+            if 'out_loc' in msg:
+                return msg
+
+            # frames are left for the loop, parameters can't wait
+            if msg.get('frame_loc') is not None:
+                self._pending_data.append(bytes(data))
+            else:
+                self._update_from_recved_params(msg.get(PARAMS_FIELD, {}))
+
+    # Keep the input frame arr in the shared memory after replying to it,
+    # until release_frame is called with the offset returned. Only frames
+    # given to process_array(s) or to the post process hook can be retained,
+    # see ADExternalWindowPlugin
+    def retain_frame(self, arr):
+        frame_loc = self._frame_locs[arr.ctypes.data]
+        self._retained_locs.add(frame_loc)
+        return frame_loc
+
+    # the AD plugin is told with the next reply
+    def release_frame(self, frame_loc):
+        self._released_locs.append(frame_loc)
+
+    # updates are kept and coalesced until the next reply after the period
+    def set_max_param_rate(self, rate):
+        self.max_param_rate = rate
+
+    # NDAttributes of the input frames wanted in in_attrs, it has to be set
+    # before connecting
+    def set_input_attrs(self, names):
+        self.input_attrs = list(names)
+
+    # read-only attributes of the frame given to process_array, of the last
+    # one for process_arrays, see in_attrs_list
+    @property
+    def in_attrs(self):
+        return getattr(self._frame_state, 'in_attrs', NO_ATTRS)
+
+    # read-only attributes of every frame given to process_arrays
+    @property
+    def in_attrs_list(self):
+        return getattr(self._frame_state, 'in_attrs_list', [])
+
+    # apply the options added by add_worker_arguments
+    def apply_args(self, args):
+        self.set_max_inflight(args.max_inflight)
+        self.set_binary_frames(args.binary_frames)
+        self.set_out_buffer_limit(args.out_buffer_mb << 20)
+        self.set_max_param_rate(args.max_param_rate)
+        if args.input_attrs:
+            self.set_input_attrs(self.input_attrs + args.input_attrs)
+        if args.stats or args.stats_dump:
+            self.enable_stats(
+                period=args.stats_period, dump_path=args.stats_dump,
+                dump_format=args.stats_format)
+
     # get a param value
     def __getitem__(self, param):
         return self._params[param]
@@ -41,8 +317,19 @@ class ADExternalPlugin(object):
     # set a param value
     def __setitem__(self, param, value):
         assert param in self, 'Param %s not in param lib' % param
-        self._params[param] = value
-        self._new_params[param] = value
+        with self._params_lock:
+            self._params[param] = value
+            self._queue_param(param, value)
+
+    # a value the AD plugin already has is not sent again, setting it back
+    # cancels a pending update
+    def _queue_param(self, param, value):
+        with self._params_lock:
+            if param in self._published_params and \
+                    self._published_params[param] == value:
+                self._new_params.pop(param, None)
+            else:
+                self._new_params[param] = value
 
     def update_params(self, params):
         for key, val in params.items():
@@ -68,29 +355,121 @@ class ADExternalPlugin(object):
     def params_changed(self, params):
         pass
 
+    # returns the output frame, None to push nothing, or a list of frames to
+    # push several of them, each one an array or an (array, attrs) pair whose
+    # attributes are added to the ones in attrs
     def process_array(self, arr, attrs):
         return arr
 
+    # called with up to batch_size frames when several are waiting, must
+    # return one output (or None) per frame
+    def process_arrays(self, arrs, attrs_list):
+        new_arrs = []
+        for arr, attrs, in_attrs in zip(arrs, attrs_list,
+                                        self.in_attrs_list):
+            self._frame_state.in_attrs = in_attrs
+            new_arrs.append(self.process_array(arr, attrs))
+
+        return new_arrs
+
     def on_connected(self, server_params={}):
         pass
 
-    def pop_new_params(self):
-        new_params = self._new_params
-        self._new_params = {}
-        return new_params
+    # updates to send, empty while the rate limit holds them unless forced
+    def pop_new_params(self, force=False):
+        with self._params_lock:
+            if not self._new_params:
+                return {}
+
+            now = time.monotonic()
+            if not force and self.max_param_rate > 0 and \
+                    now - self._last_publish_ts < 1.0 / self.max_param_rate:
+                return {}
+
+            new_params = self._new_params
+            self._new_params = {}
+            self._published_params.update(new_params)
+            self._last_publish_ts = now
+            return new_params
+
+    # seconds without frames after which the updates held by the rate limit
+    # are sent on their own, None if they are never held
+    def _param_flush_period(self):
+        if self.max_param_rate > 0:
+            return 1.0 / self.max_param_rate
+
+        return None
+
+    # send the updates due without waiting for the reply of a frame
+    def _flush_params(self):
+        new_params = self.pop_new_params()
+        if new_params:
+            self._send_msg({PARAMS_FIELD: new_params})
 
     def _send_msg(self, msg):
         self.log.debug('Sending message: %s', msg)
-        data = json.dumps(msg).encode()
+        if self.binary_frames and 'push_frame' in msg:
+            data = encode_binary_reply_msg(msg)
+        else:
+            data = json.dumps(msg).encode()
+
         self.sock.send(data)
 
-    def _recv_msg(self):
-        data = self.sock.recv(MAX_RECV_LEN)
-        self.log.debug('Received raw message: %s', repr(data))
+    # Next message in the socket, in the receive buffer, so it is only valid
+    # until the next call. Messages keep their boundaries, the size of the
+    # next one is peeked first and the buffer grows if it doesn't fit
+    def _recv_raw(self, flags=0):
+        try:
+            nbytes = self.sock.recv_into(
+                self._recv_buffer, 0,
+                flags | socket.MSG_PEEK | socket.MSG_TRUNC)
+        except ConnectionResetError:
+            # the AD plugin closed before reading all our messages, e.g.
+            # released frames or parameters sent without a frame
+            return b''
+
+        if nbytes > len(self._recv_buffer):
+            self._recv_buffer = bytearray(
+                1 << (nbytes - 1).bit_length())
+
+        nbytes = self.sock.recv_into(self._recv_buffer, 0, flags)
+        return memoryview(self._recv_buffer)[:nbytes]
+
+    # whether a message comes in timeout seconds, None waits for it
+    def _wait_for_data(self, timeout):
+        if timeout is None or self._pending_data:
+            return True
+
+        readable, _, _ = select.select([self.sock], [], [], timeout)
+        return bool(readable)
+
+    def _recv_data(self):
+        if self._pending_data:
+            return self._pending_data.popleft()
+
+        data = self._recv_raw()
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug('Received raw message: %r', bytes(data))
+
         if data == b'':
             return None
 
-        return json.loads(data)
+        return data
+
+    def _recv_msg(self):
+        data = self._recv_data()
+        if data is None:
+            return None
+
+        return self._decode_msg(data)
+
+    def _decode_msg(self, data):
+        if data[:1] == BINARY_FRAME_MSG:
+            msg = decode_binary_frame_msg(data)
+            msg['identity'] = self.identity
+            return msg
+
+        return json.loads(bytes(data))
 
     def _mmap_shared_memory(self, shm_name):
         self.shm_name = shm_name
@@ -100,22 +479,45 @@ class ADExternalPlugin(object):
         self.mem = mmap.mmap(fd, self.shm_size)
         self.mem_view = numpy.frombuffer(self.mem, 'uint8')
 
-    def connect(self, socket_path):
+    # timeout is kept for the socket operations after connecting too
+    def connect(self, socket_path, timeout=None):
         if self.sock:
             self.sock.close()
 
         self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET, 0)
+        self.sock.settimeout(timeout)
         self.sock.connect(socket_path)
         self.socket_path = socket_path
 
+    # frames, outputs and published values belong to the connection, a new
+    # one starts from scratch
     def close(self):
         if self.sock:
             self.sock.close()
             self.sock = None
 
+        self._pending_data.clear()
+        self._outputs.clear()
+        self._frame_locs.clear()
+        self._retained_locs.clear()
+        del self._released_locs[:]
+        with self._params_lock:
+            self._published_params.clear()
+
+    # statistics parameters are published even if the worker didn't declare
+    # them, they need the records in ADExternal.template on the AD plugin
+    def _publish_stats(self):
+        with self._params_lock:
+            for key, val in self.stats.report().items():
+                self._params[key] = val
+                self._queue_param(key, val)
+
     def _update_from_recved_params(self, params):
         if params:
-            self._params.update(params)
+            with self._params_lock:
+                self._params.update(params)
+                self._published_params.update(params)
+
             self.params_changed(params)
 
     def _is_offset_inside_shmem(self, offset):
@@ -142,89 +544,329 @@ class ADExternalPlugin(object):
             .view(dtype_name) \
             .reshape(self._convert_dims(dims))
 
-    def run(self):
-        self.sock = None
-        self.connect(self.socket_path)
+    def _handshake(self):
         name = getattr(self, 'name', self.__class__.__name__)
-        self._send_msg({'class_name': name})
+        handshake = {'class_name': name,
+                     'max_inflight': self.max_inflight,
+                     'binary_frames': self.binary_frames}
+        if self.input_attrs:
+            handshake[ATTRS_FIELD] = self.input_attrs
+
+        self._in_attrs = NO_ATTRS
+        self._send_msg(handshake)
         msg = self._recv_msg()
 
         if msg is None:
             self.log.error('Connection was closed before handshake completion')
-            return
+            return False
 
         if not msg.get('ok'):
             self.log.error('Failed during handshake: %s', msg.get('err'))
-            return
-
+            return False
+
+        # server might grant a smaller window than requested
+        self.max_inflight = msg.get('max_inflight', 1)
+        self.log.debug('Frames in flight allowed: %d', self.max_inflight)
+        # older servers don't know about binary frames
+        self.binary_frames = msg.get('binary_frames', False)
+        self.identity = msg.get('identity', '')
         server_params = msg.get(PARAMS_FIELD, {})
         self._update_from_recved_params(server_params)
         self._mmap_shared_memory(msg['shm_name'])
 
-        new_params = self.pop_new_params()
+        new_params = self.pop_new_params(force=True)
 
         # make sure they receive parameters value forced by us
         self._send_msg({PARAMS_FIELD: new_params})
 
         self.on_connected(server_params)
+        return True
+
+    # frames already waiting in the socket, without blocking, parameter
+    # updates found on the way are applied straight away
+    def _recv_pending_frames(self, max_frames):
+        in_msgs = []
+        while len(in_msgs) < max_frames:
+            try:
+                data = self._pending_data.popleft() if self._pending_data \
+                    else self._recv_raw(socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                break
 
-        while True:
-            in_msg = self._recv_msg()
-            if in_msg is None:
-                self.log.debug('We were disconnected from server')
+            if data == b'':
                 break
 
+            in_msg = self._decode_msg(data)
             self._update_from_recved_params(in_msg.get(PARAMS_FIELD, {}))
-            frame_offset = in_msg.get('frame_loc')
-            if frame_offset is not None:
-                arr = self._get_array_from_shared_memory(
-                    frame_offset, in_msg.get('frame_dims'),
-                    in_msg.get('data_type'))
-                old_arr_shape = arr.shape
-                old_arr_dtype = arr.dtype.name
-                old_arr_nbytes = arr.nbytes
-                old_arr_data = arr.ctypes.data
-                self.log.debug(
-                    'Received frame with buffer in %x', old_arr_data)
-                attrs = {}
-
-                new_arr = self.process_array(arr, attrs)
+            if in_msg.get('frame_loc') is not None:
+                in_msgs.append(in_msg)
+
+        return in_msgs
+
+    # move the result of a worker into the frame in shared memory, unless it
+    # is already there, returns the frame as it is pushed. The result must
+    # fit in the frame, bigger ones go to output frames (see _output_frame)
+    def _copy_to_frame(self, arr, new_arr):
+        old_arr_data = arr.ctypes.data
+        if new_arr.ctypes.data == old_arr_data and \
+                new_arr.flags.c_contiguous:
+            return new_arr
+
+        self.log.debug(
+            'Copying array data from %x to %x nbytes=%d',
+            new_arr.ctypes.data, old_arr_data, new_arr.nbytes)
+        # copyto also copes with views not contiguous or overlapping the
+        # frame
+        dst = arr.reshape(-1).view('uint8')[:new_arr.nbytes] \
+            .view(new_arr.dtype).reshape(new_arr.shape)
+        numpy.copyto(dst, new_arr)
+        return dst
+
+    # output frame holding new_arr, allocated if needed, and its offset in
+    # the shared memory
+    def _output_frame(self, new_arr):
+        out_loc = self._outputs.get(new_arr.ctypes.data)
+        if out_loc is not None and new_arr.flags.c_contiguous:
+            del self._outputs[new_arr.ctypes.data]
+            return new_arr, out_loc
+
+        out_arr = self.alloc_output(new_arr.shape, new_arr.dtype)
+        numpy.copyto(out_arr, new_arr)
+        return out_arr, self._outputs.pop(out_arr.ctypes.data)
+
+    # reply pushing several frames produced from arr, the first one goes in
+    # the input frame unless it is an output frame already, the rest get
+    # output frames of their own. Returns the reply and the pushed arrays
+    def _build_fan_out_reply(self, arr, new_arrs, attrs, new_params):
+        outputs = []
+        pushed = []
+        first = None
+        for i, new_arr in enumerate(new_arrs):
+            out_attrs = attrs
+            if isinstance(new_arr, tuple):
+                new_arr, extra_attrs = new_arr
+                out_attrs = dict(attrs, **extra_attrs)
+
+            output = {
+                'frame_dims': self._convert_dims(new_arr.shape),
+                'data_type': new_arr.dtype.name,
+                ATTRS_FIELD: out_attrs
+            }
+            if i == 0 and new_arr.ctypes.data not in self._outputs and \
+                    new_arr.nbytes <= arr.nbytes:
+                first = new_arr
+            else:
+                try:
+                    new_arr, output['out_loc'] = self._output_frame(new_arr)
+                except MemoryError as e:
+                    self.log.error('Output %d dropped: %s', i, e)
+                    continue
+
+            outputs.append(output)
+            pushed.append(new_arr)
+
+        # last, the other outputs might be views of the input frame
+        if first is not None:
+            pushed[0] = self._copy_to_frame(arr, first)
+
+        out_msg = {
+            'push_frame': bool(outputs),
+            PARAMS_FIELD: new_params,
+            OUTPUTS_FIELD: outputs
+        }
+        return out_msg, pushed
+
+    # reply to the frame arr and the arrays pushed with it
+    def _build_reply(self, arr, new_arr, attrs, new_params):
+        if new_arr is None:
+            # we didn't produce any frame but parameter might have
+            # been updated
+            return {
+                'push_frame': False,
+                PARAMS_FIELD: new_params
+            }, []
+
+        if isinstance(new_arr, list):
+            return self._build_fan_out_reply(arr, new_arr, attrs, new_params)
+
+        out_msg = {
+            'push_frame': True,
+            PARAMS_FIELD: new_params,
+            ATTRS_FIELD: attrs
+        }
+        out_loc = self._outputs.get(new_arr.ctypes.data)
+        if (out_loc is not None and new_arr.flags.c_contiguous) or \
+                new_arr.nbytes > arr.nbytes:
+            # the AD plugin pushes the output frame, with the shape and type
+            # it has now, results not fitting in the input frame are copied
+            # to a new one
+            try:
+                new_arr, out_loc = self._output_frame(new_arr)
+            except MemoryError as e:
+                self.log.error('Frame dropped: %s', e)
+                return {
+                    'push_frame': False,
+                    PARAMS_FIELD: new_params
+                }, []
+
+            out_msg['out_loc'] = out_loc
+            out_msg['frame_dims'] = self._convert_dims(new_arr.shape)
+            out_msg['data_type'] = new_arr.dtype.name
+            return out_msg, [new_arr]
+
+        self._copy_to_frame(arr, new_arr)
+        if arr.shape != new_arr.shape:
+            out_msg['frame_dims'] = self._convert_dims(new_arr.shape)
+
+        if arr.dtype.name != new_arr.dtype.name:
+            out_msg['data_type'] = new_arr.dtype.name
+
+        return out_msg, [arr]
+
+    # once per pushed frame, several outputs are given as separate replies
+    def _call_post_process_hook(self, arr, pushed, in_msg, out_msg):
+        if OUTPUTS_FIELD not in out_msg:
+            self.post_process_hook(
+                pushed[0] if pushed else arr, in_msg, out_msg)
+            return
 
-                new_params = self.pop_new_params()
-                if new_arr is None:
-                    # we didn't produce any frame but parameter might have
-                    # been updated
-                    out_msg = {
-                        'push_frame': False,
-                        PARAMS_FIELD: new_params
-                    }
+        for pushed_arr, output in zip(pushed, out_msg[OUTPUTS_FIELD]):
+            msg = {key: value for key, value in out_msg.items()
+                   if key != OUTPUTS_FIELD}
+            msg.update(output)
+            self.post_process_hook(pushed_arr, in_msg, msg)
+
+    # attributes of a frame, from the ones of the previous frame and the
+    # changes sent with it (None for attributes gone). Mappings given out
+    # are never modified
+    def _update_in_attrs(self, changes):
+        if changes:
+            in_attrs = dict(self._in_attrs)
+            for name, value in changes.items():
+                if value is None:
+                    in_attrs.pop(name, None)
                 else:
-                    if new_arr.ctypes.data != old_arr_data:
-                        nbytes = min(old_arr_nbytes, new_arr.nbytes)
-                        self.log.debug(
-                            'Copying array data from %x to %x nbytes=%d',
-                            new_arr.ctypes.data, old_arr_data, nbytes)
-                        ctypes.memmove(
-                            old_arr_data,
-                            new_arr.ctypes.data,
-                            nbytes
-                        )
-
-                    out_msg = {
-                        'push_frame': True,
-                        PARAMS_FIELD: new_params,
-                        ATTRS_FIELD: attrs
-                    }
-                    if old_arr_shape != new_arr.shape:
-                        out_msg['frame_dims'] = \
-                            self._convert_dims(new_arr.shape)
-
-                    if old_arr_dtype != new_arr.dtype.name:
-                        out_msg['data_type'] = new_arr.dtype.name
-
-                if self.post_process_hook:
-                    self.post_process_hook(arr, in_msg, out_msg)
-
-                self._send_msg(out_msg)
+                    in_attrs[name] = value
+
+            self._in_attrs = types.MappingProxyType(in_attrs)
+
+        return self._in_attrs
+
+    # timestamps has the start of the receive wait and decoding stages, see
+    # WorkerStats.STAGES
+    def _process_frames(self, in_msgs, timestamps):
+        arrs = []
+        in_attrs_list = []
+        for in_msg in in_msgs:
+            in_attrs_list.append(
+                self._update_in_attrs(in_msg.get(ATTRS_FIELD)))
+            arr = self._get_array_from_shared_memory(
+                in_msg['frame_loc'], in_msg.get('frame_dims'),
+                in_msg.get('data_type'))
+            self.log.debug(
+                'Received frame with buffer in %x', arr.ctypes.data)
+            arrs.append(arr)
+            self._frame_locs[arr.ctypes.data] = in_msg['frame_loc']
+
+        attrs_list = [{} for _ in arrs]
+        self._frame_state.in_attrs_list = in_attrs_list
+        self._frame_state.in_attrs = in_attrs_list[-1]
+
+        timestamps.append(time.perf_counter())
+        new_arrs = self.process_arrays(arrs, attrs_list)
+        timestamps.append(time.perf_counter())
+
+        # parameters go with the last reply of the batch
+        new_params = {}
+        out_msgs = []
+        pushed_arrs = []
+        for i, in_msg in enumerate(in_msgs):
+            if i == len(in_msgs) - 1:
+                new_params = self.pop_new_params()
+
+            out_msg, pushed = self._build_reply(
+                arrs[i], new_arrs[i], attrs_list[i], new_params)
+            # frames are acknowledged in order, the id lets the server
+            # verify it when several frames are in flight
+            if 'frame_id' in in_msg:
+                out_msg['frame_id'] = in_msg['frame_id']
+
+            out_msgs.append(out_msg)
+            pushed_arrs.append(pushed)
+
+        if self._released_locs:
+            out_msgs[0][RELEASE_FIELD] = self._released_locs
+            self._released_locs = []
+
+        # results are in the frames now
+        self.buffer_pool.release()
+
+        # forwarding done by the hook is accounted as sending
+        timestamps.append(time.perf_counter())
+        for i, (in_msg, out_msg) in enumerate(zip(in_msgs, out_msgs)):
+            if self.post_process_hook:
+                self._call_post_process_hook(
+                    arrs[i], pushed_arrs[i], in_msg, out_msg)
+
+            # the hook can retain the frame too
+            if in_msg['frame_loc'] in self._retained_locs:
+                out_msg['retain'] = True
+
+            self._send_msg(out_msg)
+
+        self._frame_locs.clear()
+        self._retained_locs.clear()
+
+        # outputs allocated and not returned
+        for out_loc in self._outputs.values():
+            self._send_msg({'free_frame': out_loc})
+
+        self._outputs.clear()
+
+        timestamps.append(time.perf_counter())
+        if self.stats is not None:
+            self._record_stats(timestamps, len(in_msgs))
+
+    def _record_stats(self, timestamps, nframes):
+        self.stats.record(timestamps, nframes)
+        # they will go with the next reply
+        if self.stats.due():
+            self._publish_stats()
+
+    def run(self):
+        self.sock = None
+        self.connect(self.socket_path)
+        if not self._handshake():
+            return
+
+        while True:
+            # time at the start of every stage of the frame loop and at the
+            # end of the last one, see WorkerStats.STAGES
+            timestamps = [time.perf_counter()]
+            if not self._wait_for_data(self._param_flush_period()):
+                # frames stopped, the last updates must not wait for them
+                self._flush_params()
+                continue
+
+            data = self._recv_data()
+            if data is None:
+                self.log.debug('We were disconnected from server')
+                break
+
+            timestamps.append(time.perf_counter())
+            in_msg = self._decode_msg(data)
+            self._update_from_recved_params(in_msg.get(PARAMS_FIELD, {}))
+            if in_msg.get('frame_loc') is None:
+                self._flush_params()
+                continue
+
+            # with several frames in flight, the ones already queued can be
+            # processed together by workers supporting batches
+            in_msgs = [in_msg]
+            batch_size = min(self.batch_size, self.max_inflight)
+            if batch_size > 1:
+                in_msgs += self._recv_pending_frames(batch_size - 1)
+
+            self._process_frames(in_msgs, timestamps)
 
         self.close()
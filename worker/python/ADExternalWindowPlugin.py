@@ -0,0 +1,108 @@
+import collections
+
+import numpy
+
+from ADExternalPlugin import ADExternalPlugin
+
+DEFAULT_WINDOW_SIZE = 8
+DEFAULT_WINDOW_MB = 256
+
+
+def add_window_arguments(parser):
+    parser.add_argument(
+        '--window-size', type=int, default=DEFAULT_WINDOW_SIZE,
+        help='Number of input frames kept in the window')
+    parser.add_argument(
+        '--window-mb', type=int, default=DEFAULT_WINDOW_MB,
+        help='Memory the frames in the window can take, in MiB')
+
+
+# Base class of workers producing one frame out of the last N input frames
+# (rolling averages, sum of N, background subtraction...). Input frames are
+# not copied, they are retained by the AD plugin in the shared memory while
+# they are in the window, which works as a ring buffer: the oldest frame is
+# released when a new one comes in and the window is full or takes more than
+# the memory cap.
+# Every frame in the window is read-only and the output always goes to an
+# output frame allocated by the AD plugin, as the input one can't be
+# modified. Frames are expected in order, so this is meant to be run with
+# one connection to the AD plugin (not from ParallelWorkerHost)
+class ADExternalWindowPlugin(ADExternalPlugin):
+    def __init__(self, socket_path, initial_params=None,
+                 window_size=DEFAULT_WINDOW_SIZE,
+                 max_window_bytes=DEFAULT_WINDOW_MB << 20, **kwargs):
+        ADExternalPlugin.__init__(self, socket_path, initial_params, **kwargs)
+        self.window_size = window_size
+        self.max_window_bytes = max_window_bytes
+        # (frame_loc, arr) of the frames retained, oldest first
+        self.window = collections.deque()
+        self.window_bytes = 0
+
+    def set_window_size(self, window_size):
+        self.window_size = max(window_size, 1)
+        self._trim_window()
+
+    def set_max_window_bytes(self, nbytes):
+        self.max_window_bytes = nbytes
+        self._trim_window()
+
+    def apply_args(self, args):
+        ADExternalPlugin.apply_args(self, args)
+        self.set_window_size(args.window_size)
+        self.set_max_window_bytes(args.window_mb << 20)
+
+    # release every frame, e.g. when the processing parameters change
+    def reset_window(self):
+        while self.window:
+            self._pop_oldest()
+
+    # the frames of the window went away with the connection
+    def close(self):
+        ADExternalPlugin.close(self)
+        self.window.clear()
+        self.window_bytes = 0
+
+    def _pop_oldest(self):
+        frame_loc, arr = self.window.popleft()
+        self.window_bytes -= arr.nbytes
+        self.release_frame(frame_loc)
+
+    # the newest frame is always kept, even if alone it is over the cap
+    def _trim_window(self):
+        while len(self.window) > self.window_size or \
+                (len(self.window) > 1 and
+                 self.window_bytes > self.max_window_bytes):
+            self._pop_oldest()
+
+    # frames in the window, oldest first, the last one is the frame just
+    # received, which is the one attrs belong to. It is called for every
+    # frame, also before the window is full, returning None pushes nothing.
+    # By default the frame just received is pushed as it is
+    def process_window(self, frames, attrs):
+        return frames[-1]
+
+    def process_array(self, arr, attrs):
+        # a frame of another shape or type starts a new window
+        if self.window and (self.window[-1][1].shape != arr.shape or
+                            self.window[-1][1].dtype != arr.dtype):
+            self.reset_window()
+
+        arr.flags.writeable = False
+        self.window.append((self.retain_frame(arr), arr))
+        self.window_bytes += arr.nbytes
+        self._trim_window()
+
+        result = self.process_window([frame for _, frame in self.window],
+                                     attrs)
+        if result is None or result.ctypes.data in self._outputs:
+            return result
+
+        # the input frame itself (or its leading part) is pushed without a
+        # copy, other views of it would be copied over the retained frame
+        if result.ctypes.data == arr.ctypes.data and \
+                result.flags.c_contiguous:
+            return result
+
+        out_arr = self.alloc_output(result.shape, result.dtype)
+        numpy.copyto(out_arr, result)
+        return out_arr
@@ -0,0 +1,173 @@
+#!/usr/bin/env python
+
+import argparse
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import socket
+import time
+
+from importlib import import_module
+
+from ADExternalPlugin import ADExternalPlugin, PARAMS_FIELD, \
+    add_worker_arguments
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'socket_path', help='Path to unix socket to talk to AD plugin')
+    parser.add_argument(
+        'class_name', help='Worker class we will run on the event loop')
+    add_worker_arguments(parser)
+    parser.add_argument('--debug', action='store_true')
+    return parser.parse_args()
+
+
+# Worker runtime on asyncio: the socket to the AD plugin is watched by the
+# event loop, which applies parameter updates as soon as they arrive, while
+# frames are processed in order in an executor thread (with the same
+# process_array/process_arrays as ADExternalPlugin). The loop is free for
+# other sockets or servers, started from on_loop_started.
+# params_changed runs in the loop thread, so it can be called while
+# process_array runs in the executor.
+# It is meant to be mixed with an existing worker class, see async_variant
+class AsyncADExternalPlugin(ADExternalPlugin):
+    # called in the loop once connected, before the first frame
+    async def on_loop_started(self):
+        pass
+
+    def run(self):
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        self.sock = None
+        self.connect(self.socket_path)
+        # blocking, nothing else to do before it completes
+        if not self._handshake():
+            self.close()
+            return
+
+        self.loop = asyncio.get_running_loop()
+        # None tells the frame loop we were disconnected
+        self._frames = asyncio.Queue()
+        # replies to alloc_frame requests, in the order they were sent
+        self._alloc_replies = collections.deque()
+        # one thread, so frames are processed and acknowledged in order
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix='process')
+        self.loop.add_reader(self.sock, self._on_readable)
+        self._flush_timer = None
+        self._schedule_param_flush()
+        try:
+            await self.on_loop_started()
+            await self._frame_loop()
+        finally:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+
+            self.loop.remove_reader(self.sock)
+            self.executor.shutdown()
+            for future in self._alloc_replies:
+                future.set_exception(
+                    ConnectionError('Disconnected waiting for an output'))
+
+            self.close()
+
+    # the socket stays blocking for the executor thread sending replies,
+    # reads from the loop don't wait
+    def _on_readable(self):
+        while True:
+            try:
+                data = self._recv_raw(socket.MSG_DONTWAIT)
+            except BlockingIOError:
+                return
+
+            if data == b'':
+                self.log.debug('We were disconnected from server')
+                self.loop.remove_reader(self.sock)
+                self._frames.put_nowait(None)
+                return
+
+            msg = self._decode_msg(data)
+            if 'out_loc' in msg:
+                if not self._alloc_replies:
+                    self.log.warning('Output frame not asked for: %s', msg)
+                    continue
+
+                self._alloc_replies.popleft().set_result(msg)
+                continue
+
+            self._update_from_recved_params(msg.get(PARAMS_FIELD, {}))
+            if msg.get('frame_loc') is not None:
+                self._frames.put_nowait(msg)
+            else:
+                self._flush_params()
+
+    # updates held by the rate limit are sent even if no frame comes, the
+    # ones due when a reply is sent go with it
+    def _schedule_param_flush(self):
+        period = self._param_flush_period()
+        if period is not None:
+            self._flush_timer = self.loop.call_later(
+                period, self._on_param_flush)
+
+    def _on_param_flush(self):
+        self._flush_params()
+        self._schedule_param_flush()
+
+    async def _frame_loop(self):
+        while True:
+            # see WorkerStats.STAGES, messages are decoded as they arrive
+            timestamps = [time.perf_counter()]
+            in_msg = await self._frames.get()
+            if in_msg is None:
+                break
+
+            timestamps.append(time.perf_counter())
+            in_msgs = [in_msg]
+            batch_size = min(self.batch_size, self.max_inflight)
+            while len(in_msgs) < batch_size and not self._frames.empty():
+                in_msg = self._frames.get_nowait()
+                if in_msg is None:
+                    # after the frames already received
+                    self._frames.put_nowait(None)
+                    break
+
+                in_msgs.append(in_msg)
+
+            await self.loop.run_in_executor(
+                self.executor, self._process_frames, in_msgs, timestamps)
+
+    # called from the executor thread, the reply is received by the loop
+    def _request_output(self, request):
+        future = concurrent.futures.Future()
+        self.loop.call_soon_threadsafe(
+            self._send_alloc_request, request, future)
+        return future.result()
+
+    # queued before sending so the reply always finds it
+    def _send_alloc_request(self, request, future):
+        self._alloc_replies.append(future)
+        self._send_msg({'alloc_frame': request})
+
+
+# class running the worker plugin_class on the event loop, it keeps the name
+# of plugin_class for the handshake
+def async_variant(plugin_class):
+    return type('Async' + plugin_class.__name__,
+                (AsyncADExternalPlugin, plugin_class),
+                {'name': plugin_class.__name__})
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    target_module = import_module(args.class_name)
+    target_class = getattr(target_module, args.class_name)
+    plugin = async_variant(target_class)(args.socket_path)
+    plugin.apply_args(args)
+    plugin.run()
@@ -4,17 +4,24 @@ import argparse
 import logging
 import time
 
-from ADExternalPlugin import ADExternalPlugin
+import numpy
+
+from ADExternalPlugin import ADExternalPlugin, add_worker_arguments
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'socket_path', help='Path to unix socket to talk to AD plugin')
+    add_worker_arguments(parser)
     parser.add_argument('--debug', action='store_true')
     return parser.parse_args()
 
 
+CONTROL_STEP = 0
+CONTROL_PROPORTIONAL = 1
+
+
 def restrict(val, min_val, max_val):
     if val < min_val:
         return min_val
@@ -53,6 +60,85 @@ class StepControl(object):
         return new_value
 
 
+# exposure proportional to how far the measured level is from the target,
+# gain is the fraction of the correction applied, in log scale, so 1 jumps
+# straight to the exposure that would hit the target on a linear detector
+class ProportionalControl(object):
+    # limit of the correction in one adjustment, the measure might be
+    # saturated or dark
+    MAX_FACTOR = 10.0
+
+    def __init__(self, gain, min_val, max_val):
+        self.set_parameters(gain, min_val, max_val)
+
+    def set_parameters(self, gain, min_val, max_val):
+        self.gain = gain
+        self.min_val = min_val
+        self.max_val = max_val
+
+    def updated_value(self, current, measured, target):
+        if measured <= 0:
+            factor = self.MAX_FACTOR
+        else:
+            factor = restrict((float(target) / measured) ** self.gain,
+                              1 / self.MAX_FACTOR, self.MAX_FACTOR)
+
+        return restrict(float(current * factor), self.min_val, self.max_val)
+
+
+# histogram of the frames measured since the last reset, integer pixels of up
+# to 16 bits get one bin per value, signed ones starting from the dtype
+# minimum, anything else a fixed number of bins up to top, values above it are
+# counted in the last bin
+class StreamingHistogram(object):
+    MAX_BINCOUNT_BITS = 16
+
+    def __init__(self, nbins=1024):
+        self.nbins = nbins
+        self.reset()
+
+    def reset(self):
+        self.counts = None
+        self.bin_width = 1.0
+        # value of the first bin
+        self.origin = 0
+
+    def add(self, arr, top):
+        bits = arr.itemsize * 8
+        origin = 0
+        if arr.dtype.kind == 'i' and bits <= self.MAX_BINCOUNT_BITS:
+            # flipping the sign bit of the unsigned view is value - minimum
+            arr = arr.view('u%d' % (arr.itemsize,)) ^ (1 << (bits - 1))
+            origin = -(1 << (bits - 1))
+
+        if arr.dtype.kind == 'u' and bits <= self.MAX_BINCOUNT_BITS:
+            counts = numpy.bincount(arr.reshape(-1), minlength=1 << bits)
+            bin_width = 1.0
+        else:
+            top = max(float(top), 1e-12)
+            counts, _ = numpy.histogram(arr, self.nbins, (0, top))
+            counts[0] += numpy.count_nonzero(arr < 0)
+            counts[-1] += numpy.count_nonzero(arr > top)
+            bin_width = top / self.nbins
+
+        if self.counts is None or len(self.counts) != len(counts) \
+                or self.bin_width != bin_width or self.origin != origin:
+            self.counts = counts
+            self.bin_width = bin_width
+            self.origin = origin
+        else:
+            self.counts += counts
+
+    def percentile(self, q):
+        if self.counts is None:
+            return 0
+
+        cumulative = self.counts.cumsum()
+        index = numpy.searchsorted(cumulative, cumulative[-1] * q / 100.0)
+        return self.origin + min(index, len(self.counts) - 1) * \
+            self.bin_width
+
+
 class AutoExposure(ADExternalPlugin):
     def __init__(self, socket_path):
         # default values if server doesn't send us updated ones
@@ -65,11 +151,22 @@ class AutoExposure(ADExternalPlugin):
                       iMaxPixelMax=254,
                       iMaxPixelMin=210,
                       dAdjustPeriod=2.0,
-                      iMaxPixelValue=0)
+                      iMaxPixelValue=0,
+                      iStatsStride=1,
+                      dStatsPercentile=100.0,
+                      iStatsSkip=0,
+                      iControlMode=CONTROL_STEP,
+                      dControlGain=1.0)
         self.step_control = StepControl(
                 params['dInitialStep'], params['dMinExposure'],
                 params['dMaxExposure'])
+        self.proportional_control = ProportionalControl(
+                params['dControlGain'], params['dMinExposure'],
+                params['dMaxExposure'])
+        self.histogram = StreamingHistogram()
         self.last_adjust_ts = time.time()
+        self.last_stats_ts = 0.0
+        self.last_histogram_reset_ts = time.time()
         self.last_exp_sp = 0.0
         ADExternalPlugin.__init__(self, socket_path, params)
 
@@ -77,27 +174,66 @@ class AutoExposure(ADExternalPlugin):
         init_step = params.get('dInitialStep', self['dInitialStep'])
         min_val = params.get('dMinExposure', self['dMinExposure'])
         max_val = params.get('dMaxExposure', self['dMaxExposure'])
+        gain = params.get('dControlGain', self['dControlGain'])
         self.step_control.set_parameters(init_step, min_val, max_val)
+        self.proportional_control.set_parameters(gain, min_val, max_val)
 
     def params_changed(self, params):
-        for key in ('dInitialStep', 'dMinExposure', 'dMaxExposure'):
+        for key in ('dInitialStep', 'dMinExposure', 'dMaxExposure',
+                    'dControlGain'):
             if key in params:
                 self.on_connected(params)
                 return
 
+    # brightest pixel, or the given percentile, of one row every
+    # iStatsStride, whole rows are kept because reducing contiguous memory
+    # is several times faster than picking pixels across it
+    def pixel_statistic(self, arr):
+        stride = max(1, self['iStatsStride'])
+        if stride > 1:
+            arr = arr[::stride]
+
+        # a percentile ignores hot pixels, it is taken over every frame
+        # measured in the current dAdjustPeriod
+        percentile = self['dStatsPercentile']
+        if 0 <= percentile < 100:
+            self.histogram.add(arr, 2 * self['iMaxPixelMax'])
+            return self.histogram.percentile(percentile)
+
+        return arr.max()
+
     def process_array(self, arr, attr):
-        max_pixel = arr.max()
-        self['iMaxPixelValue'] = int(max_pixel)
+        now = time.time()
         # 0 disabled, 1 enabled
-        if self['iEnableAutoExposure'] \
-                and self.last_adjust_ts + self['dAdjustPeriod'] <= time.time():
-            self.last_adjust_ts = time.time()
+        adjust_due = self['iEnableAutoExposure'] \
+            and self.last_adjust_ts + self['dAdjustPeriod'] <= now
+        # in skip mode, frames not used for an adjustment are only measured
+        # once per period to keep iMaxPixelValue alive, the rest leave the
+        # last value published
+        if self['iStatsSkip'] and not adjust_due \
+                and self.last_stats_ts + self['dAdjustPeriod'] > now:
+            return arr
+
+        self.last_stats_ts = now
+        max_pixel = self.pixel_statistic(arr)
+        self['iMaxPixelValue'] = int(max_pixel)
+        if adjust_due:
+            self.last_adjust_ts = now
             direction = \
                 1 if max_pixel < self['iMaxPixelMin'] else \
                 -1 if max_pixel > self['iMaxPixelMax'] else \
                 0
-            exp_sp = self.step_control.updated_value(self['dExposure'],
-                                                     direction)
+            # nothing to scale from an exposure of 0, steps get it going
+            if self['iControlMode'] == CONTROL_PROPORTIONAL \
+                    and self['dExposure'] > 0:
+                target = (self['iMaxPixelMin'] + self['iMaxPixelMax']) / 2.0
+                exp_sp = self.proportional_control.updated_value(
+                    self['dExposure'], max_pixel, target) \
+                    if direction != 0 else self['dExposure']
+            else:
+                exp_sp = self.step_control.updated_value(self['dExposure'],
+                                                         direction)
+
             self.log.debug(
                 'AutoExposure: max_pixel=%d, direction=%d, setpoint=%f',
                 max_pixel, direction, exp_sp)
@@ -105,6 +241,13 @@ class AutoExposure(ADExternalPlugin):
                 self['dExposureSp'] = exp_sp
                 self.last_exp_sp = exp_sp
 
+        # frames of the last period (or taken with the old exposure) don't
+        # count any more, also when auto exposure is disabled
+        if adjust_due or \
+                self.last_histogram_reset_ts + self['dAdjustPeriod'] <= now:
+            self.histogram.reset()
+            self.last_histogram_reset_ts = now
+
         return arr
 
 
@@ -113,4 +256,6 @@ if __name__ == "__main__":
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
 
-    AutoExposure(args.socket_path).run()
+    plugin = AutoExposure(args.socket_path)
+    plugin.apply_args(args)
+    plugin.run()
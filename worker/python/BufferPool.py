@@ -0,0 +1,62 @@
+import threading
+
+from collections import OrderedDict
+
+import numpy
+
+
+# Frame sized arrays kept between frames, so workers returning new arrays
+# don't allocate one per frame. Buffers handed out belong to the thread that
+# asked for them until it releases them, once its replies are sent. Free
+# buffers of the least recently used shapes are dropped to stay under
+# max_bytes.
+class BufferPool(object):
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # (shape, dtype) -> free buffers, least recently used first
+        self.free = OrderedDict()
+        # thread id -> buffers in use
+        self.used = {}
+        self.nbytes = 0
+
+    def get(self, shape, dtype):
+        dtype = numpy.dtype(dtype)
+        key = (tuple(shape), dtype.str)
+        with self.lock:
+            buffers = self.free.get(key)
+            if buffers:
+                buf = buffers.pop()
+                self.free.move_to_end(key)
+            else:
+                buf = numpy.empty(key[0], dtype)
+                self.nbytes += buf.nbytes
+                self._evict()
+
+            self.used.setdefault(threading.get_ident(), []).append(buf)
+
+        return buf
+
+    # give back every buffer the calling thread got
+    def release(self):
+        with self.lock:
+            for buf in self.used.pop(threading.get_ident(), []):
+                key = (buf.shape, buf.dtype.str)
+                self.free.setdefault(key, []).append(buf)
+                self.free.move_to_end(key)
+
+            self._evict()
+
+    def set_max_bytes(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes and self.free:
+            key, buffers = next(iter(self.free.items()))
+            if buffers:
+                self.nbytes -= buffers.pop().nbytes
+
+            if not buffers:
+                del self.free[key]
@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+
+from importlib import import_module
+
+import numpy
+
+from ADExternalPlugin import ADExternalPlugin, add_worker_arguments
+
+# between the class names of the stages in the name of the chain
+CHAIN_SEPARATOR = '+'
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'socket_path', help='Path to unix socket to talk to AD plugin')
+    parser.add_argument(
+        'class_names', nargs='+',
+        help='Worker classes run on every frame, in this order')
+    add_worker_arguments(parser)
+    parser.add_argument('--debug', action='store_true')
+    return parser.parse_args()
+
+
+# class name the AD plugin has to be configured with to run the chain
+def chain_name(plugin_classes):
+    return CHAIN_SEPARATOR.join(cls.__name__ for cls in plugin_classes)
+
+
+# Runs several workers on every frame through a single connection, as
+# "MedianFilter+AutoExposure", so the frame goes through one AD plugin
+# instead of one per worker. Every stage gets the array returned by the
+# previous one, which stays in the shared memory when it is processed in
+# place. A stage returning None ends the chain for that frame, nothing is
+# pushed; the stages after one returning several frames run on each of them.
+# The attributes of all the stages go in the same reply and so do their
+# parameters, the AD plugin needs the records of every stage (the template
+# of each worker loaded with the same port). Each stage keeps its
+# parameters, the ones received are given to the stages declaring them
+class ChainPlugin(ADExternalPlugin):
+    def __init__(self, socket_path, plugin_classes):
+        ADExternalPlugin.__init__(self, socket_path)
+        self.name = chain_name(plugin_classes)
+        self.stages = [cls(socket_path) for cls in plugin_classes]
+        self.thread_safe = all(stage.thread_safe for stage in self.stages)
+        owners = {}
+        for stage in self.stages:
+            self._adopt(stage)
+            for param in stage:
+                if param in owners:
+                    self.log.warning('%s and %s share parameter %s',
+                                     owners[param], stage.name, param)
+                owners[param] = stage.name
+
+        self.input_attrs = sorted(
+            {name for stage in self.stages for name in stage.input_attrs})
+        self.batch_size = max(stage.batch_size for stage in self.stages)
+
+    # the stage has no connection, it works through ours
+    def _adopt(self, stage):
+        stage.name = stage.__class__.__name__
+        stage.buffer_pool = self.buffer_pool
+        stage._frame_state = self._frame_state
+        stage._outputs = self._outputs
+        stage._frame_locs = self._frame_locs
+        stage._retained_locs = self._retained_locs
+        stage.alloc_output = self.alloc_output
+        stage.release_frame = self.release_frame
+
+    def set_max_param_rate(self, rate):
+        ADExternalPlugin.set_max_param_rate(self, rate)
+        for stage in self.stages:
+            stage.set_max_param_rate(rate)
+
+    def set_input_attrs(self, names):
+        ADExternalPlugin.set_input_attrs(self, names)
+        for stage in self.stages:
+            stage.input_attrs = self.input_attrs
+
+    def __getitem__(self, param):
+        for stage in self.stages:
+            if param in stage:
+                return stage[param]
+
+        return ADExternalPlugin.__getitem__(self, param)
+
+    def __setitem__(self, param, value):
+        for stage in self.stages:
+            if param in stage:
+                stage[param] = value
+                return
+
+        ADExternalPlugin.__setitem__(self, param, value)
+
+    def __contains__(self, param):
+        return any(param in stage for stage in self.stages) or \
+            ADExternalPlugin.__contains__(self, param)
+
+    def close(self):
+        ADExternalPlugin.close(self)
+        for stage in self.stages:
+            stage.close()
+
+    def on_connected(self, params):
+        for stage in self.stages:
+            stage.on_connected(params)
+
+        self.batch_size = max(stage.batch_size for stage in self.stages)
+
+    def _update_from_recved_params(self, params):
+        ADExternalPlugin._update_from_recved_params(self, params)
+        for stage in self.stages:
+            stage_params = {key: value for key, value in params.items()
+                            if key in stage}
+            if stage_params:
+                stage._update_from_recved_params(stage_params)
+
+        self.batch_size = max(stage.batch_size for stage in self.stages)
+
+    # the updates of every stage, and the statistics of the chain
+    def pop_new_params(self, force=False):
+        new_params = {}
+        for stage in self.stages:
+            new_params.update(stage.pop_new_params(force))
+
+        new_params.update(ADExternalPlugin.pop_new_params(self, force))
+        return new_params
+
+    # the input frames still going through the chain are given to the stage
+    # together, frames split in several by a previous stage one by one
+    def process_arrays(self, arrs, attrs_list):
+        in_attrs_list = self.in_attrs_list
+        results = list(arrs)
+        for stage in self.stages:
+            for i, result in enumerate(results):
+                if isinstance(result, list):
+                    self._frame_state.in_attrs = in_attrs_list[i]
+                    results[i] = self._process_outputs(
+                        stage, result, attrs_list[i])
+
+            batch = [i for i, result in enumerate(results)
+                     if isinstance(result, numpy.ndarray)]
+            if not batch:
+                break
+
+            self._frame_state.in_attrs_list = \
+                [in_attrs_list[i] for i in batch]
+            self._frame_state.in_attrs = in_attrs_list[batch[-1]]
+            new_arrs = stage.process_arrays(
+                [results[i] for i in batch], [attrs_list[i] for i in batch])
+            for i, new_arr in zip(batch, new_arrs):
+                results[i] = new_arr
+
+        self._frame_state.in_attrs_list = in_attrs_list
+        self._frame_state.in_attrs = in_attrs_list[-1]
+        return results
+
+    # outputs of a frame after going through stage, each one an array or an
+    # (array, attrs) pair, see ADExternalPlugin.process_array
+    def _process_outputs(self, stage, outputs, attrs):
+        new_outputs = []
+        for output in outputs:
+            arr, extra_attrs = output if isinstance(output, tuple) \
+                else (output, None)
+            new_arr = stage.process_array(arr, attrs)
+            if new_arr is None:
+                continue
+
+            for new_output in new_arr if isinstance(new_arr, list) \
+                    else [new_arr]:
+                if extra_attrs:
+                    if isinstance(new_output, tuple):
+                        new_output = (new_output[0],
+                                      dict(extra_attrs, **new_output[1]))
+                    else:
+                        new_output = (new_output, extra_attrs)
+
+                new_outputs.append(new_output)
+
+        return new_outputs or None
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    plugin_classes = [getattr(import_module(name), name)
+                      for name in args.class_names]
+    plugin = ChainPlugin(args.socket_path, plugin_classes)
+    plugin.apply_args(args)
+    plugin.run()
@@ -5,17 +5,118 @@ import logging
 
 import numpy
 
+from scipy import ndimage
+
 from fit_lib import fit_lib
 from fit_lib.fit_lib import doFit2dGaussian, doFit2dGaussian_0, convert_abc
 from fit_lib.levmar import FitError
 
-from ADExternalPlugin import ADExternalPlugin
+from ADExternalPlugin import ADExternalPlugin, add_worker_arguments
+
+
+# parameters of the batched fit, in fit_lib order, the model is
+# g0 + K * exp(-0.5 * (A*dx^2 + 2*B*dx*dy + C*dy^2)) with dx, dy the distance
+# to the origin (x0, y0), x being the first array axis
+NPARAMS = 7
+LAMBDA_START = 1e-3
+LAMBDA_MAX = 1e10
+# relative decrease of the squared residuals under which a fit is done
+CONVERGENCE = 1e-6
+
+
+def _gaussian_and_jacobian(params, xs, ys):
+    g0, K, x0, y0, A, B, C = (
+        params[:, i, None, None] for i in range(NPARAMS))
+    dx = xs - x0
+    dy = ys - y0
+    e = numpy.exp(-0.5 * (A * dx * dx + 2 * B * dx * dy + C * dy * dy))
+    Ke = K * e
+    jac = numpy.stack([
+        numpy.ones_like(e), e,
+        Ke * (A * dx + B * dy), Ke * (B * dx + C * dy),
+        -0.5 * Ke * dx * dx, -Ke * dx * dy, -0.5 * Ke * dy * dy
+    ], axis=-1)
+    n = len(params)
+    return (g0 + Ke).reshape(n, -1), jac.reshape(n, -1, NPARAMS)
+
+
+# starting point from the moments of the pixels well above the background,
+# on frames median filtered over window_size pixels (iFitWindowSize of the
+# per-frame fit) so isolated hot pixels don't move it
+def _initial_guess(stack, xs, ys, window_size):
+    if window_size > 1:
+        stack = ndimage.median_filter(
+            stack, size=(1, window_size, window_size))
+
+    base = stack.min(axis=(1, 2))
+    height = stack.max(axis=(1, 2)) - base
+    weights = stack - (base + 0.2 * height)[:, None, None]
+    numpy.maximum(weights, 0, out=weights)
+    total = weights.sum(axis=(1, 2))
+    total[total == 0] = 1
+    x0 = (weights * xs).sum(axis=(1, 2)) / total
+    y0 = (weights * ys).sum(axis=(1, 2)) / total
+    dx = xs - x0[:, None, None]
+    dy = ys - y0[:, None, None]
+    cov = numpy.empty((len(stack), 2, 2))
+    cov[:, 0, 0] = (weights * dx * dx).sum(axis=(1, 2)) / total + 1
+    cov[:, 0, 1] = cov[:, 1, 0] = (weights * dx * dy).sum(axis=(1, 2)) / total
+    cov[:, 1, 1] = (weights * dy * dy).sum(axis=(1, 2)) / total + 1
+    inv = numpy.linalg.inv(cov)
+    return numpy.stack([base, height, x0, y0, inv[:, 0, 0], inv[:, 0, 1],
+                        inv[:, 1, 1]], axis=1)
+
+
+# Levenberg-Marquardt over a stack of frames with the same shape, every step
+# solves all the normal equations at once, each frame keeps its own damping.
+# Returns the parameters, the RMS of the residuals and whether the fit of
+# each frame is usable
+def batch_fit_2d_gaussian(stack, maxiter=20, window_size=3):
+    xs = numpy.arange(stack.shape[1], dtype=numpy.float64)[None, :, None]
+    ys = numpy.arange(stack.shape[2], dtype=numpy.float64)[None, None, :]
+    data = stack.reshape(len(stack), -1)
+    params = _initial_guess(stack, xs, ys, window_size)
+    lam = numpy.full(len(stack), LAMBDA_START)
+    model, jac = _gaussian_and_jacobian(params, xs, ys)
+    residual = data - model
+    chi2 = (residual * residual).sum(axis=1)
+    eye = numpy.eye(NPARAMS)
+    # frames still iterating, converged ones are left out of the next steps
+    active = numpy.arange(len(stack))
+    for _ in range(maxiter):
+        act_jac = jac[active]
+        jac_t = act_jac.transpose(0, 2, 1)
+        jtj = numpy.matmul(jac_t, act_jac)
+        jtr = numpy.matmul(jac_t, residual[active, :, None])
+        damped = jtj + lam[active, None, None] * jtj * eye + 1e-12 * eye
+        new_params = params[active] + numpy.linalg.solve(damped, jtr)[:, :, 0]
+        new_model, new_jac = _gaussian_and_jacobian(new_params, xs, ys)
+        new_residual = data[active] - new_model
+        new_chi2 = (new_residual * new_residual).sum(axis=1)
+        better = new_chi2 < chi2[active]
+        converged = better & \
+            (chi2[active] - new_chi2 < CONVERGENCE * chi2[active])
+        accepted = active[better]
+        params[accepted] = new_params[better]
+        jac[accepted] = new_jac[better]
+        residual[accepted] = new_residual[better]
+        chi2[accepted] = new_chi2[better]
+        lam[active] = numpy.where(better, lam[active] / 10, lam[active] * 10)
+        active = active[~converged & (lam[active] < LAMBDA_MAX)]
+        if len(active) == 0:
+            break
+
+    ok = numpy.isfinite(params).all(axis=1) & (params[:, 1] > 0) & \
+        (params[:, 4] > 0) & (params[:, 6] > 0) & \
+        (params[:, 4] * params[:, 6] > params[:, 5] * params[:, 5])
+    return params, numpy.sqrt(chi2 / data.shape[1]), ok
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'socket_path', help='Path to unix socket to talk to AD plugin')
+    add_worker_arguments(parser)
     parser.add_argument('--debug', action='store_true')
     return parser.parse_args()
 
@@ -42,17 +143,29 @@ class Gaussian2DFitter(ADExternalPlugin):
                       iFit0Enabled=0,
                       dA=0.0,
                       dB=0.0,
-                      dC=0.0)
+                      dC=0.0,
+                      iTrackingEnabled=0,
+                      dTrackWindowSigmas=4.0,
+                      iRoiX=0,
+                      iRoiY=0,
+                      iRoiWidth=0,
+                      iRoiHeight=0,
+                      iTrackHits=0,
+                      iTrackMisses=0,
+                      iBatchSize=1)
         self.fitting_function = doFit2dGaussian
+        # (origin x, origin y, biggest sigma) of the last good fit
+        self.last_fit = None
         ADExternalPlugin.__init__(self, socket_path, params)
 
     def on_connected(self, params):
         fit0enabled = params.get('iFit0Enabled', self['iFit0Enabled'])
         self.fitting_function = \
             doFit2dGaussian_0 if fit0enabled else doFit2dGaussian
+        self.batch_size = max(1, params.get('iBatchSize', self['iBatchSize']))
 
     def params_changed(self, params):
-        for key in ('iFit0Enabled',):
+        for key in ('iFit0Enabled', 'iBatchSize'):
             if key in params:
                 self.on_connected(params)
                 return
@@ -68,12 +181,119 @@ class Gaussian2DFitter(ADExternalPlugin):
         self['dAngle'] = 0.0
         self['dError'] = 0.0
 
-    def do_fit(self, arr):
+    # fit only the pixels the thinning would keep, converted to float here
+    # so the rest of the frame is never copied, results are mapped back to
+    # frame coordinates
+    def fit_thinned(self, arr, thinning, roi=None):
+        x0, x1, y0, y1 = roi if roi else (0, arr.shape[0], 0, arr.shape[1])
+        thinned = arr[x0:x1:thinning, y0:y1:thinning].astype(numpy.float64)
+        fit, error = self.fitting_function(
+            thinned, thinning=(1, 1),
+            window_size=self['iFitWindowSize'], maxiter=self['iMaxiter'],
+            ROI=None, gamma=None, extra_data=False)
+        fit = list(fit)
+        fit[2] = x0 + fit[2] * thinning
+        fit[3] = y0 + fit[3] * thinning
+        # A, B and C multiply squared coordinates
+        for i in (4, 5, 6):
+            fit[i] /= thinning * thinning
+
+        return fit, error
+
+    # window around the last fitted beam, sized from its sigmas, or None if
+    # there is nothing to track
+    def tracking_roi(self, shape):
+        if not self['iTrackingEnabled'] or self.last_fit is None:
+            return None
+
+        x, y, sigma = self.last_fit
+        half = max(int(self['dTrackWindowSigmas'] * sigma),
+                   2 * max(1, self['iFitThinning']))
+        roi = (max(0, x - half), min(shape[0], x + half + 1),
+               max(0, y - half), min(shape[1], y + half + 1))
+        if roi[0] >= roi[1] or roi[2] >= roi[3]:
+            return None
+
+        return roi
+
+    # fit inside the tracking window, falling back to the whole frame
+    def fit_tracking(self, arr, thinning):
+        roi = self.tracking_roi(arr.shape)
+        if roi is not None:
+            try:
+                fit, error = self.fit_thinned(arr, thinning, roi)
+                if not (roi[0] <= fit[2] < roi[1] and
+                        roi[2] <= fit[3] < roi[3]):
+                    raise FitError('Beam left the tracking window')
+
+                self['iTrackHits'] += 1
+                return fit, error, roi
+            except Exception as e:
+                self.log.debug('Tracking fit failed: %s', e)
+                self['iTrackMisses'] += 1
+
+        roi = (0, arr.shape[0], 0, arr.shape[1])
+        fit, error = self.fit_thinned(arr, thinning)
+        return fit, error, roi
+
+    # fit all the frames that can go in the same stack in one go, returns
+    # (fit, error, roi) or a FitError for each of them, None for the frames
+    # left to the per-frame fit
+    def fit_batch(self, arrs, max_pixel_vals):
+        results = [None] * len(arrs)
+        if self['iTrackingEnabled']:
+            # every window depends on the fit of the previous frame
+            return results
+
+        if self['iFit0Enabled']:
+            # the batched model always fits the baseline
+            return results
+
+        thinning = max(1, self['iFitThinning'])
+        shape = None
+        indexes = []
+        for i, arr in enumerate(arrs):
+            if max_pixel_vals[i] < self['dMinPixelLevel']:
+                continue
+
+            if shape is None:
+                shape = arr.shape
+
+            if arr.ndim == 2 and arr.shape == shape:
+                indexes.append(i)
+
+        if len(indexes) < 2:
+            return results
+
+        stack = numpy.stack([arrs[i][::thinning, ::thinning]
+                             for i in indexes]).astype(numpy.float64)
+        fits, errors, oks = batch_fit_2d_gaussian(
+            stack, self['iMaxiter'], self['iFitWindowSize'])
+        roi = (0, shape[0], 0, shape[1])
+        for i, fit, error, ok in zip(indexes, fits, errors, oks):
+            if not ok:
+                results[i] = FitError('Batch fit did not converge')
+                continue
+
+            fit = list(fit)
+            fit[2] *= thinning
+            fit[3] *= thinning
+            for j in (4, 5, 6):
+                fit[j] /= thinning * thinning
+
+            results[i] = (fit, error, roi)
+
+        return results
+
+    def do_fit(self, arr, batch_result=None):
         try:
-            fit, error = self.fitting_function(
-                arr, thinning=(self['iFitThinning'], self['iFitThinning']),
-                window_size=self['iFitWindowSize'], maxiter=self['iMaxiter'],
-                ROI=None, gamma=None, extra_data=False)
+            if batch_result is None:
+                fit, error, roi = self.fit_tracking(
+                    arr, max(1, self['iFitThinning']))
+            elif isinstance(batch_result, Exception):
+                raise batch_result
+            else:
+                fit, error, roi = batch_result
 
             # fit outputs in terms of ABC we want sigma x, sigma y and angle.
             s_x, s_y, th = convert_abc(*fit[4:7])
@@ -81,6 +301,12 @@ class Gaussian2DFitter(ADExternalPlugin):
                     or fit[i+2] > 2*arr.shape[i] for i in [0, 1]]):
                 raise FitError('Fit out of range')
 
+            self['iRoiX'] = int(roi[0])
+            self['iRoiY'] = int(roi[2])
+            self['iRoiWidth'] = int(roi[1] - roi[0])
+            self['iRoiHeight'] = int(roi[3] - roi[2])
+            self.last_fit = (int(fit[2]), int(fit[3]), max(s_x, s_y))
+
             self['sFitStatus'] = 'Gaussian Fit OK'
             self['iFitType'] = 0
             self['dBaseline'] = float(fit[0])
@@ -98,23 +324,35 @@ class Gaussian2DFitter(ADExternalPlugin):
             self['sFitStatus'] = 'Fit error: %s' % (e,)
             self['iFitType'] = -1
             self.reset_results()
+            self.last_fit = None
         except Exception as e:
             self['sFitStatus'] = 'Unexpected error: %s' % (e,)
             self['iFitType'] = -1
             self.reset_results()
+            self.last_fit = None
+
+    # frames already waiting are fitted together, results are still applied
+    # and attached frame by frame, in order
+    def process_arrays(self, arrs, attrs_list):
+        max_pixel_vals = [arr.max() for arr in arrs]
+        results = self.fit_batch(arrs, max_pixel_vals)
+        return [self._process(arr, attr, max_pixel_val, result)
+                for arr, attr, max_pixel_val, result
+                in zip(arrs, attrs_list, max_pixel_vals, results)]
 
     def process_array(self, arr, attr):
-        # Convert the array to a float so that we do not overflow during
-        # processing.
-        arr2 = numpy.float_(arr)
-        max_pixel_val = arr2.max()
+        # max can't overflow, so it is done in the native type, only the
+        # pixels used by the fit are converted to float
+        return self._process(arr, attr, arr.max())
 
+    def _process(self, arr, attr, max_pixel_val, batch_result=None):
         if max_pixel_val >= self['dMinPixelLevel']:
-            self.do_fit(arr2)
+            self.do_fit(arr, batch_result)
         else:
             self['sFitStatus'] = 'Error: image too dim'
             self['iFitType'] = -1
             self.reset_results()
+            self.last_fit = None
 
         # Write the attibute array which will be attached to the output array.
         # Note that we convert from the numpy
@@ -142,4 +380,6 @@ if __name__ == '__main__':
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
 
-    Gaussian2DFitter(args.socket_path).run()
+    plugin = Gaussian2DFitter(args.socket_path)
+    plugin.apply_args(args)
+    plugin.run()
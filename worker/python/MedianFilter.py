@@ -2,38 +2,187 @@
 
 import argparse
 import logging
+import os
+import threading
 
-from ADExternalPlugin import ADExternalPlugin
+import numpy
+
+from concurrent.futures import ThreadPoolExecutor
+
+from ADExternalPlugin import ADExternalPlugin, add_worker_arguments
 import scipy.ndimage
 
+try:
+    from skimage.filters.rank import median as rank_median
+except ImportError:
+    rank_median = None
+
+ENGINE_SCIPY = 0
+# histogram median from scikit-image, cost doesn't grow with the kernel area
+ENGINE_HISTOGRAM = 1
+# scipy on horizontal bands in a thread pool, the bands overlap by half a
+# kernel so the result is the same as filtering the whole frame
+ENGINE_TILED = 2
+# median of the row medians, an approximation much cheaper for big kernels
+ENGINE_SEPARABLE = 3
+ENGINE_NAMES = {
+    ENGINE_SCIPY: 'scipy',
+    ENGINE_HISTOGRAM: 'histogram',
+    ENGINE_TILED: 'tiled',
+    ENGINE_SEPARABLE: 'separable',
+}
+HISTOGRAM_DTYPES = ('uint8', 'uint16')
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'socket_path', help='Path to unix socket to talk to AD plugin')
+    add_worker_arguments(parser)
     parser.add_argument('--debug', action='store_true')
     return parser.parse_args()
 
 
 class MedianFilter(ADExternalPlugin):
     tempCounter = 0
+    thread_safe = True
 
     def __init__(self, socket_path):
         # default values if server doesn't send us updated ones
-        params = dict(iMedianFilterSize=0)
+        params = dict(iMedianFilterSize=0,
+                      iMedianFilterEngine=ENGINE_SCIPY,
+                      iMedianFilterThreads=0)
+        # scratch buffers and thread pool of every thread calling
+        # process_array, lanes of ParallelWorkerHost share this instance
+        self._local = threading.local()
         ADExternalPlugin.__init__(self, socket_path, params)
 
+    # buffers of the calling thread
+    @property
+    def scratch_buffers(self):
+        buffers = getattr(self._local, 'scratch_buffers', None)
+        if buffers is None:
+            buffers = self._local.scratch_buffers = {}
+
+        return buffers
+
+    # buffers kept between frames, reallocated only when the frames change
+    def scratch(self, key, shape, dtype):
+        buf = self.scratch_buffers.get(key)
+        if buf is None or buf.shape != shape or buf.dtype != dtype:
+            buf = numpy.empty(shape, dtype)
+            self.scratch_buffers[key] = buf
+
+        return buf
+
+    # The engines filter arr in place: the result is written to a scratch
+    # buffer and copied back once, or straight into arr when the input of
+    # the last pass is a scratch buffer. arr is the frame in shared memory,
+    # so the plugin loop has nothing left to copy
+
+    def median_scipy(self, arr, size):
+        out = self.scratch('out', arr.shape, arr.dtype)
+        scipy.ndimage.median_filter(arr, size=size, output=out)
+        numpy.copyto(arr, out)
+
+    def median_histogram(self, arr, size):
+        if rank_median is None or arr.ndim != 2 \
+                or arr.dtype.name not in HISTOGRAM_DTYPES:
+            self.log.debug('Histogram median not available, using scipy')
+            return self.median_scipy(arr, size)
+
+        out = self.scratch('out', arr.shape, arr.dtype)
+        rank_median(arr, footprint=numpy.ones((size, size), bool), out=out)
+        numpy.copyto(arr, out)
+
+    # threads in the pool of the calling thread, 0 before it filtered with
+    # the tiled engine
+    @property
+    def executor_threads(self):
+        return getattr(self._local, 'executor_threads', 0)
+
+    # pool of the calling thread, resized when iMedianFilterThreads changes
+    def _get_executor(self):
+        threads = self['iMedianFilterThreads'] or os.cpu_count() or 1
+        executor = getattr(self._local, 'executor', None)
+        if executor is None or self.executor_threads != threads:
+            if executor is not None:
+                executor.shutdown()
+
+            executor = self._local.executor = ThreadPoolExecutor(threads)
+            self._local.executor_threads = threads
+
+        return executor
+
+    # scipy releases the GIL while filtering, so bands run in parallel, every
+    # band is filtered with its halo into its own buffer, arr is only written
+    # once all of them are done as the halos are read from it
+    def median_tiled(self, arr, size):
+        executor = self._get_executor()
+        rows = arr.shape[0]
+        band = -(-rows // self.executor_threads)
+        halo = size // 2
+        if band <= halo:
+            return self.median_scipy(arr, size)
+
+        bands = []
+        for i, start in enumerate(range(0, rows, band)):
+            end = min(rows, start + band)
+            halo_start = max(0, start - halo)
+            halo_end = min(rows, end + halo)
+            out = self.scratch(('band', i),
+                               (halo_end - halo_start,) + arr.shape[1:],
+                               arr.dtype)
+            bands.append((start, end, halo_start, halo_end, out))
+
+        def filter_band(halo_start, halo_end, out):
+            scipy.ndimage.median_filter(
+                arr[halo_start:halo_end], size=size, output=out)
+
+        for future in [executor.submit(filter_band, *band_info[2:])
+                       for band_info in bands]:
+            future.result()
+
+        for start, end, halo_start, _, out in bands:
+            arr[start:end] = out[start - halo_start:end - halo_start]
+
+    # passes alternate between arr and the scratch buffer, for 2D frames the
+    # last one writes straight into arr
+    def median_separable(self, arr, size):
+        out = self.scratch('out', arr.shape, arr.dtype)
+        src, dst = arr, out
+        for axis in range(arr.ndim):
+            sizes = [1] * arr.ndim
+            sizes[axis] = size
+            scipy.ndimage.median_filter(src, size=sizes, output=dst)
+            src, dst = dst, src
+
+        if src is not arr:
+            numpy.copyto(arr, src)
+
     def process_array(self, arr, attr):
-        if self['iMedianFilterSize']:
-            return scipy.ndimage.median_filter(
-                arr, size=self['iMedianFilterSize'])
-        else:
+        size = self['iMedianFilterSize']
+        if not size:
             return arr
 
+        engine = self['iMedianFilterEngine']
+        if engine == ENGINE_HISTOGRAM:
+            self.median_histogram(arr, size)
+        elif engine == ENGINE_TILED:
+            self.median_tiled(arr, size)
+        elif engine == ENGINE_SEPARABLE:
+            self.median_separable(arr, size)
+        else:
+            self.median_scipy(arr, size)
+
+        return arr
+
 
 if __name__ == "__main__":
     args = parse_args()
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
 
-    MedianFilter(args.socket_path).run()
+    plugin = MedianFilter(args.socket_path)
+    plugin.apply_args(args)
+    plugin.run()
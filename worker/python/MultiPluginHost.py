@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+
+import argparse
+import json
+import logging
+import mmap
+import os
+import selectors
+import socket
+import time
+
+from importlib import import_module
+
+import numpy
+
+from ADExternalPlugin import PARAMS_FIELD, add_worker_arguments
+
+# seconds between attempts to connect to a socket nobody is listening on
+RECONNECT_PERIOD = 5.0
+# seconds a plugin has to accept the connection and answer the handshake
+HANDSHAKE_TIMEOUT = 1.0
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'plugins', nargs='*', metavar='SOCKET_PATH:CLASS_NAME',
+        help='Unix socket of an AD plugin and the worker class serving it')
+    parser.add_argument(
+        '--config',
+        help='JSON file with a list of {"socket_path": ..., "class_name": '
+             '...} objects, served together with the ones given above')
+    add_worker_arguments(parser)
+    parser.add_argument('--debug', action='store_true')
+    return parser.parse_args()
+
+
+# (socket_path, class_name) pairs from the arguments
+def plugin_specs(args):
+    specs = []
+    for spec in args.plugins:
+        socket_path, _, class_name = spec.rpartition(':')
+        specs.append((socket_path, class_name))
+
+    if args.config:
+        with open(args.config) as f:
+            specs += [(plugin['socket_path'], plugin['class_name'])
+                      for plugin in json.load(f)]
+
+    return specs
+
+
+# One process serving several AD plugins, each one with its own worker
+# instance, so the interpreter, the modules and their memory are paid once
+# instead of once per worker process. The sockets are multiplexed with a
+# selector in a single thread: frames are processed in turns, one batch per
+# plugin, so a slow worker delays the others and the host suits plugins
+# that are light or not busy at the same time. Workers of the same IOC map
+# its shared memory only once. A plugin whose IOC goes away is connected
+# again when it comes back
+class MultiPluginHost(object):
+    def __init__(self, plugins):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.plugins = list(plugins)
+        self.selector = selectors.DefaultSelector()
+        # shm_name -> (inode, mmap, uint8 view, size)
+        self.shared_mems = {}
+        # plugins not connected, and when to try again
+        self.reconnect_at = {plugin: 0.0 for plugin in self.plugins}
+        for plugin in self.plugins:
+            plugin.sock = None
+            plugin._mmap_shared_memory = \
+                lambda shm_name, plugin=plugin: self._map(plugin, shm_name)
+
+    def apply_args(self, args):
+        for plugin in self.plugins:
+            plugin.apply_args(args)
+
+    # every worker of the same shared memory gets the same mapping, a
+    # restarted IOC creates its shared memory again under the same name
+    def _map(self, plugin, shm_name):
+        path = '/dev/shm/%s' % (shm_name,)
+        inode = os.stat(path).st_ino
+        if self.shared_mems.get(shm_name, (None,))[0] != inode:
+            fd = os.open(path, os.O_RDWR)
+            size = os.fstat(fd).st_size
+            mem = mmap.mmap(fd, size)
+            os.close(fd)
+            self.shared_mems[shm_name] = \
+                (inode, mem, numpy.frombuffer(mem, 'uint8'), size)
+
+        plugin.shm_name = shm_name
+        _, plugin.mem, plugin.mem_view, plugin.shm_size = \
+            self.shared_mems[shm_name]
+
+    def _connect(self, plugin):
+        # a server accepting and never answering must not hold the others
+        try:
+            plugin.connect(plugin.socket_path, HANDSHAKE_TIMEOUT)
+        except (FileNotFoundError, ConnectionRefusedError):
+            plugin.close()
+            return False
+        except OSError as e:
+            self.log.error('%s failed connecting to %s: %s',
+                           plugin.__class__.__name__, plugin.socket_path, e)
+            plugin.close()
+            return False
+
+        try:
+            connected = plugin._handshake()
+        except OSError as e:
+            self.log.error('%s failed connecting to %s: %s',
+                           plugin.__class__.__name__, plugin.socket_path, e)
+            connected = False
+
+        if not connected:
+            plugin.close()
+            return False
+
+        plugin.sock.settimeout(None)
+
+        self.log.info('%s connected to %s', plugin.__class__.__name__,
+                      plugin.socket_path)
+        self.selector.register(plugin.sock, selectors.EVENT_READ, plugin)
+        return True
+
+    def _disconnect(self, plugin):
+        self.log.info('%s disconnected from %s', plugin.__class__.__name__,
+                      plugin.socket_path)
+        self.selector.unregister(plugin.sock)
+        plugin.close()
+        self.reconnect_at[plugin] = time.monotonic()
+
+    def _reconnect_due(self):
+        now = time.monotonic()
+        for plugin, reconnect_at in list(self.reconnect_at.items()):
+            if reconnect_at <= now:
+                if self._connect(plugin):
+                    del self.reconnect_at[plugin]
+                else:
+                    self.reconnect_at[plugin] = now + RECONNECT_PERIOD
+
+    # seconds until the next connection attempt or parameter flush, None to
+    # wait for frames
+    def _select_timeout(self):
+        timeouts = [plugin._param_flush_period() for plugin in self.plugins
+                    if plugin.sock is not None]
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        if self.reconnect_at:
+            timeouts.append(max(
+                0.0, min(self.reconnect_at.values()) - time.monotonic()))
+
+        return min(timeouts) if timeouts else None
+
+    # one batch of frames of the plugin, parameter updates on the way are
+    # applied, the rest is left for the next turn
+    def _serve(self, plugin):
+        # see WorkerStats.STAGES, the wait is the time since the last turn
+        timestamps = [time.perf_counter()]
+        in_msgs = []
+        batch_size = min(plugin.batch_size, plugin.max_inflight)
+        while len(in_msgs) < batch_size:
+            if plugin._pending_data:
+                data = plugin._pending_data.popleft()
+            else:
+                try:
+                    data = plugin._recv_raw(socket.MSG_DONTWAIT)
+                except BlockingIOError:
+                    break
+
+                if data == b'':
+                    self._disconnect(plugin)
+                    return
+
+            msg = plugin._decode_msg(data)
+            plugin._update_from_recved_params(msg.get(PARAMS_FIELD, {}))
+            if msg.get('frame_loc') is not None:
+                in_msgs.append(msg)
+
+        if in_msgs:
+            timestamps.append(time.perf_counter())
+            plugin._process_frames(in_msgs, timestamps)
+
+    def run(self):
+        while self.plugins:
+            self._reconnect_due()
+            for key, _ in self.selector.select(self._select_timeout()):
+                self._serve_safely(key.data)
+
+            # frames received while waiting for an output frame
+            for plugin in self.plugins:
+                if plugin._pending_data and plugin.sock is not None:
+                    self._serve_safely(plugin)
+
+            # updates held by the rate limit while frames stopped
+            for plugin in self.plugins:
+                if plugin.sock is not None:
+                    self._flush_safely(plugin)
+
+    # a worker failing starts again with a new connection, as it would in
+    # its own process, the others carry on
+    def _serve_safely(self, plugin):
+        try:
+            self._serve(plugin)
+        except Exception:
+            self.log.exception('%s failed serving %s',
+                               plugin.__class__.__name__, plugin.socket_path)
+            if plugin.sock is not None:
+                self._disconnect(plugin)
+
+    def _flush_safely(self, plugin):
+        try:
+            plugin._flush_params()
+        except OSError:
+            self.log.exception('%s failed sending parameters to %s',
+                               plugin.__class__.__name__, plugin.socket_path)
+            self._disconnect(plugin)
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    plugins = []
+    for socket_path, class_name in plugin_specs(args):
+        plugin_class = getattr(import_module(class_name), class_name)
+        plugins.append(plugin_class(socket_path))
+
+    host = MultiPluginHost(plugins)
+    host.apply_args(args)
+    host.run()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python
+
+import argparse
+import logging
+import multiprocessing
+import os
+import threading
+
+from importlib import import_module
+
+from ADExternalPlugin import ADExternalPlugin, add_worker_arguments
+
+MODE_THREAD = 'thread'
+MODE_PROCESS = 'process'
+
+# lane serving the frame in every thread
+_current_lane = threading.local()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'socket_path', help='Path to unix socket to talk to AD plugin')
+    parser.add_argument(
+        'class_name', help='Worker class we will run in every lane')
+    parser.add_argument(
+        '--lanes', type=int, default=2,
+        help='Number of connections opened to the AD plugin')
+    parser.add_argument(
+        '--mode', choices=(MODE_THREAD, MODE_PROCESS), default=MODE_THREAD,
+        help='Run lanes as threads sharing one worker instance or as forked '
+             'processes with one instance each')
+    add_worker_arguments(parser)
+    parser.add_argument('--debug', action='store_true')
+    return parser.parse_args()
+
+
+# A lane is one connection to the AD plugin, it impersonates the target plugin
+# and forwards everything to it, the parameter state lives only in the target
+# so all the lanes see the same values. Frames of a target that isn't
+# thread_safe are processed one at a time under process_lock
+class _Lane(ADExternalPlugin):
+    def __init__(self, target_plugin, socket_path, lock, process_lock):
+        ADExternalPlugin.__init__(
+            self, socket_path, max_inflight=target_plugin.max_inflight,
+            binary_frames=target_plugin.binary_frames)
+        self.target_plugin = target_plugin
+        self.lock = lock
+        self.process_lock = process_lock
+        # the target hands out the buffers, the lane releases them
+        self.buffer_pool = target_plugin.buffer_pool
+        # the target sees the attributes of the frame of the calling lane
+        self._frame_state = target_plugin._frame_state
+        self.input_attrs = target_plugin.input_attrs
+        # the statistics are the ones of all the lanes together
+        self.stats = target_plugin.stats
+        self.name = getattr(
+            target_plugin, 'name', target_plugin.__class__.__name__)
+
+    def __getitem__(self, param):
+        return self.target_plugin[param]
+
+    def __setitem__(self, param, value):
+        self.target_plugin[param] = value
+
+    def __contains__(self, param):
+        return param in self.target_plugin
+
+    def on_connected(self, params):
+        with self.lock:
+            self.target_plugin.on_connected(params)
+            self.batch_size = self.target_plugin.batch_size
+
+    # the AD plugin broadcasts parameter updates to every lane, applying them
+    # more than once is harmless
+    def _update_from_recved_params(self, params):
+        with self.lock:
+            self.target_plugin._update_from_recved_params(params)
+            self.batch_size = self.target_plugin.batch_size
+
+    def pop_new_params(self, force=False):
+        with self.lock:
+            return self.target_plugin.pop_new_params(force)
+
+    def _param_flush_period(self):
+        return self.target_plugin._param_flush_period()
+
+    def _record_stats(self, timestamps, nframes):
+        with self.lock:
+            self.target_plugin._record_stats(timestamps, nframes)
+
+    # not serialised for thread_safe targets, the point is to run several
+    # frames at the same time, numpy and scipy release the GIL during most of
+    # the heavy work. Parameters set meanwhile are guarded by the target
+    def process_array(self, arr, attrs):
+        _current_lane.lane = self
+        if self.target_plugin.thread_safe:
+            return self.target_plugin.process_array(arr, attrs)
+
+        with self.process_lock:
+            return self.target_plugin.process_array(arr, attrs)
+
+    def process_arrays(self, arrs, attrs_list):
+        _current_lane.lane = self
+        if self.target_plugin.thread_safe:
+            return self.target_plugin.process_arrays(arrs, attrs_list)
+
+        with self.process_lock:
+            return self.target_plugin.process_arrays(arrs, attrs_list)
+
+
+# the target has no connection, output frames are asked for by the lane
+# processing the frame
+def _lane_alloc_output(shape, dtype):
+    return ADExternalPlugin.alloc_output(_current_lane.lane, shape, dtype)
+
+
+def _run_process_lane(plugin_class, socket_path, max_inflight, binary_frames,
+                      args):
+    plugin = plugin_class(socket_path)
+    plugin.set_max_inflight(max_inflight)
+    plugin.set_binary_frames(binary_frames)
+    if args is not None:
+        plugin.apply_args(args)
+
+    plugin.run()
+
+
+class ParallelWorkerHost(object):
+    def __init__(self, plugin_class, socket_path, lanes=2, mode=MODE_THREAD,
+                 max_inflight=1, binary_frames=False):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.plugin_class = plugin_class
+        self.socket_path = socket_path
+        self.lanes = lanes
+        self.mode = mode
+        self.max_inflight = max_inflight
+        self.binary_frames = binary_frames
+        # options of add_worker_arguments, applied to every worker instance
+        self.args = None
+
+    def apply_args(self, args):
+        self.max_inflight = args.max_inflight
+        self.binary_frames = args.binary_frames
+        self.args = args
+
+    # options of a process lane, each one writes its statistics to its own
+    # file
+    def _lane_args(self, index):
+        if self.args is None or not self.args.stats_dump:
+            return self.args
+
+        args = argparse.Namespace(**vars(self.args))
+        base, ext = os.path.splitext(args.stats_dump)
+        args.stats_dump = '%s.lane%d%s' % (base, index, ext)
+        return args
+
+    def _run_threads(self):
+        target_plugin = self.plugin_class(self.socket_path)
+        target_plugin.set_max_inflight(self.max_inflight)
+        target_plugin.set_binary_frames(self.binary_frames)
+        if self.args is not None:
+            target_plugin.apply_args(self.args)
+
+        target_plugin.alloc_output = _lane_alloc_output
+        if not target_plugin.thread_safe:
+            self.log.warning('%s is not thread safe, its frames are '
+                             'processed one at a time, see --mode',
+                             self.plugin_class.__name__)
+
+        lock = threading.RLock()
+        process_lock = threading.Lock()
+        threads = []
+        for i in range(self.lanes):
+            lane = _Lane(target_plugin, self.socket_path, lock, process_lock)
+            thread = threading.Thread(
+                target=lane.run, name='lane%d' % (i,), daemon=True)
+            thread.start()
+            threads.append(thread)
+
+        return threads
+
+    # lanes are forked after the worker module was imported, so they share
+    # the interpreter and library pages, each one maps the shared memory
+    # during its handshake and gets parameter updates from the AD plugin
+    def _run_processes(self):
+        context = multiprocessing.get_context('fork')
+        processes = []
+        for i in range(self.lanes):
+            process = context.Process(
+                target=_run_process_lane, name='lane%d' % (i,),
+                args=(self.plugin_class, self.socket_path, self.max_inflight,
+                      self.binary_frames, self._lane_args(i)),
+                daemon=True)
+            process.start()
+            processes.append(process)
+
+        return processes
+
+    def run(self):
+        self.log.debug('Starting %d %s lanes of %s', self.lanes, self.mode,
+                       self.plugin_class.__name__)
+        if self.mode == MODE_PROCESS:
+            lanes = self._run_processes()
+        else:
+            lanes = self._run_threads()
+
+        # the AD plugin going away closes every lane
+        for lane in lanes:
+            lane.join()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.debug:
+        logging.basicConfig(level=logging.DEBUG)
+
+    target_module = import_module(args.class_name)
+    target_class = getattr(target_module, args.class_name)
+    host = ParallelWorkerHost(
+        target_class, args.socket_path, args.lanes, args.mode)
+    host.apply_args(args)
+    host.run()
@@ -5,7 +5,7 @@ import logging
 
 from numpy import add
 
-from ADExternalPlugin import ADExternalPlugin
+from ADExternalPlugin import ADExternalPlugin, add_worker_arguments
 
 MODE_NOCOPY = 0
 MODE_COPY = 1
@@ -16,11 +16,14 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         'socket_path', help='Path to unix socket to talk to AD plugin')
+    add_worker_arguments(parser)
     parser.add_argument('--debug', action='store_true')
     return parser.parse_args()
 
 
 class Template(ADExternalPlugin):
+    thread_safe = True
+
     def __init__(self, socket_path):
         # values used before getting updated ones from server
         params = {
@@ -47,7 +50,8 @@ class Template(ADExternalPlugin):
         if self['iInt3'] == MODE_NOCOPY:
             arr += self['iInt1']
         else:  # MODE_COPY
-            arr = add(arr, self['iInt1'])
+            arr = add(arr, self['iInt1'],
+                      out=self.out_buffer(arr.shape, arr.dtype))
 
         # doubles and strings in the C code for now
         attr['sum'] = int(arr.sum())
@@ -63,4 +67,6 @@ if __name__ == '__main__':
     if args.debug:
         logging.basicConfig(level=logging.DEBUG)
 
-    Template(args.socket_path).run()
+    plugin = Template(args.socket_path)
+    plugin.apply_args(args)
+    plugin.run()
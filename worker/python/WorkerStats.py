@@ -0,0 +1,160 @@
+import json
+import os
+import time
+
+import numpy
+
+# stages of a frame in the worker loop, in order, with the prefix of the
+# parameters used to publish them
+STAGES = (
+    ('recv_wait', 'dRecvWait'),
+    ('decode', 'dDecodeTime'),
+    ('process', 'dProcTime'),
+    ('copy', 'dCopyTime'),
+    ('send', 'dSendTime'),
+)
+STAGE_NAMES = tuple(stage for stage, _ in STAGES)
+FPS_PARAM = 'dFps'
+PUBLISHED_PERCENTILES = (50, 99)
+# upper bounds of the histogram buckets in the dump, in seconds
+BUCKETS = (1e-5, 5e-5, 1e-4, 5e-4, 1e-3, 5e-3, 1e-2, 5e-2, 0.1, 0.5, 1.0)
+FORMAT_PROMETHEUS = 'prometheus'
+FORMAT_JSON = 'json'
+
+
+class RollingHistogram(object):
+    # keeps the last `size` samples, old ones are overwritten
+    def __init__(self, size):
+        self.samples = numpy.zeros(size)
+        self.count = 0
+
+    def add(self, value):
+        self.samples[self.count % len(self.samples)] = value
+        self.count += 1
+
+    def _valid_samples(self):
+        return self.samples[:min(self.count, len(self.samples))]
+
+    def percentile(self, q):
+        samples = self._valid_samples()
+        if len(samples) == 0:
+            return 0.0
+
+        return float(numpy.percentile(samples, q))
+
+    # cumulative count of samples below each of the bounds
+    def buckets(self, bounds):
+        samples = numpy.sort(self._valid_samples())
+        return [int(n) for n in numpy.searchsorted(samples, bounds, 'right')]
+
+    def total(self):
+        return float(self._valid_samples().sum())
+
+    def __len__(self):
+        return min(self.count, len(self.samples))
+
+
+class WorkerStats(object):
+    def __init__(self, window=1000, period=1.0, dump_path=None,
+                 dump_format=None):
+        self.histograms = {
+            stage: RollingHistogram(window) for stage in STAGE_NAMES}
+        self.period = period
+        self.dump_path = dump_path
+        if dump_format is None:
+            dump_format = FORMAT_JSON \
+                if dump_path and dump_path.endswith('.json') \
+                else FORMAT_PROMETHEUS
+
+        self.dump_format = dump_format
+        self.frames = 0
+        self.fps = 0.0
+        self.last_report_ts = time.time()
+        self.last_report_frames = 0
+
+    # timestamps taken by the worker loop, one more than the stages, for a
+    # batch of nframes frames processed together
+    def record(self, timestamps, nframes=1):
+        for i, stage in enumerate(STAGE_NAMES):
+            self.histograms[stage].add(
+                (timestamps[i + 1] - timestamps[i]) / nframes)
+
+        self.frames += nframes
+
+    def due(self):
+        return time.time() - self.last_report_ts >= self.period
+
+    # compute the frame rate since the last report and return the values to
+    # publish as parameters, times are in milliseconds
+    def report(self):
+        now = time.time()
+        elapsed = now - self.last_report_ts
+        if elapsed > 0:
+            self.fps = (self.frames - self.last_report_frames) / elapsed
+
+        self.last_report_ts = now
+        self.last_report_frames = self.frames
+        params = {FPS_PARAM: self.fps}
+        for stage, prefix in STAGES:
+            for q in PUBLISHED_PERCENTILES:
+                params['%sP%d' % (prefix, q)] = \
+                    self.histograms[stage].percentile(q) * 1000
+
+        if self.dump_path:
+            self.dump()
+
+        return params
+
+    def to_dict(self):
+        return {
+            'frames': self.frames,
+            'fps': self.fps,
+            'stages': {
+                stage: {
+                    'samples': len(hist),
+                    'p50': hist.percentile(50),
+                    'p90': hist.percentile(90),
+                    'p99': hist.percentile(99),
+                    'max': hist.percentile(100),
+                } for stage, hist in self.histograms.items()
+            }
+        }
+
+    def to_prometheus(self):
+        lines = [
+            '# TYPE adexternal_worker_frames_total counter',
+            'adexternal_worker_frames_total %d' % (self.frames,),
+            '# TYPE adexternal_worker_fps gauge',
+            'adexternal_worker_fps %f' % (self.fps,),
+            '# TYPE adexternal_worker_stage_seconds histogram',
+        ]
+        for stage, hist in self.histograms.items():
+            for bound, count in zip(BUCKETS, hist.buckets(BUCKETS)):
+                lines.append(
+                    'adexternal_worker_stage_seconds_bucket'
+                    '{stage="%s",le="%g"} %d' % (stage, bound, count))
+
+            lines.append(
+                'adexternal_worker_stage_seconds_bucket'
+                '{stage="%s",le="+Inf"} %d' % (stage, len(hist)))
+            lines.append(
+                'adexternal_worker_stage_seconds_sum{stage="%s"} %f' %
+                (stage, hist.total()))
+            lines.append(
+                'adexternal_worker_stage_seconds_count{stage="%s"} %d' %
+                (stage, len(hist)))
+
+        return '\n'.join(lines) + '\n'
+
+    # written to a temporary file first so readers never see half a dump
+    def dump(self):
+        if self.dump_format == FORMAT_JSON:
+            data = json.dumps(self.to_dict(), indent=2)
+        else:
+            data = self.to_prometheus()
+
+        tmp_path = self.dump_path + '.tmp'
+        with open(tmp_path, 'w') as fhandle:
+            fhandle.write(data)
+
+        os.replace(tmp_path, self.dump_path)
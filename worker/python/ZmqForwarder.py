@@ -1,13 +1,52 @@
 #!/usr/bin/env python
 
 import argparse
-import json
+import collections
 import logging
+import threading
+import zlib
 import zmq
 
 from importlib import import_module
 
-from ADExternalPlugin import ADExternalPlugin, ATTRS_FIELD, PARAMS_FIELD
+from ADExternalPlugin import ADExternalPlugin, RELEASE_FIELD, \
+    add_worker_arguments
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+OVERFLOW_BLOCK = 0
+OVERFLOW_DROP_OLDEST = 1
+OVERFLOW_DROP_NEWEST = 2
+OVERFLOW_NAMES = {
+    'block': OVERFLOW_BLOCK,
+    'drop-oldest': OVERFLOW_DROP_OLDEST,
+    'drop-newest': OVERFLOW_DROP_NEWEST,
+}
+DEFAULT_QUEUE_SIZE = 16
+# seconds between checks for frames ZMQ is done with while no frame comes
+RELEASE_PERIOD = 0.1
+
+# codecs of the frame data, the name goes in the output metadata
+COMPRESS_NONE = 0
+COMPRESS_ZLIB = 1
+COMPRESS_LZ4 = 2
+COMPRESS_BLOSC = 3
+COMPRESS_NAMES = {
+    'none': COMPRESS_NONE,
+    'zlib': COMPRESS_ZLIB,
+    'lz4': COMPRESS_LZ4,
+    'blosc': COMPRESS_BLOSC,
+}
+CODEC_NAMES = {code: name for name, code in COMPRESS_NAMES.items()}
+DEFAULT_COMPRESS_LEVEL = 1
 
 
 def parse_args():
@@ -20,48 +59,354 @@ def parse_args():
         'endpoint', help='ZMQ endpoint to send frame information')
     parser.add_argument(
         '--with-frame-data', action='store_true', help='Send frame data too')
+    parser.add_argument(
+        '--queue-size', type=int, default=DEFAULT_QUEUE_SIZE,
+        help='Messages waiting to be sent before the overflow policy applies')
+    parser.add_argument(
+        '--overflow', choices=sorted(OVERFLOW_NAMES), default='drop-oldest',
+        help='What to do with a new message when the queue is full')
+    parser.add_argument(
+        '--zero-copy', action='store_true',
+        help='Send the frame data from the shared memory, the frame is '
+             'retained until it is sent')
+    parser.add_argument(
+        '--compress', choices=sorted(COMPRESS_NAMES), default='none',
+        help='Codec of the frame data, lz4 and blosc need their modules')
+    parser.add_argument(
+        '--compress-level', type=int, default=DEFAULT_COMPRESS_LEVEL,
+        help='Compression level of the codec')
+    parser.add_argument(
+        '--compress-threads', type=int, default=0,
+        help='Threads blosc compresses every frame with, 0 for all cores')
+    parser.add_argument(
+        '--decimation', type=int, default=1,
+        help='Forward one frame out of this many')
+    parser.add_argument(
+        '--binning', type=int, default=1,
+        help='Forward frames binned by this factor in both axes')
+    add_worker_arguments(parser)
     parser.add_argument('--debug', action='store_true')
     return parser.parse_args()
 
 
+# Messages waiting for the sender thread, when it is full a new message
+# either waits for room, replaces the oldest one or is dropped
+class SendQueue(object):
+    def __init__(self, maxsize, policy):
+        self.maxsize = max(maxsize, 1)
+        self.policy = policy
+        self.items = collections.deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.closed = False
+
+    # returns the items dropped to make room, item itself if it was dropped
+    def put(self, item):
+        dropped = []
+        with self.cond:
+            if self.policy == OVERFLOW_BLOCK:
+                while len(self.items) >= self.maxsize and not self.closed:
+                    self.cond.wait()
+            elif len(self.items) >= self.maxsize:
+                if self.policy == OVERFLOW_DROP_NEWEST:
+                    self.dropped += 1
+                    return [item]
+
+                # the queue might have shrunk
+                while len(self.items) >= self.maxsize:
+                    dropped.append(self.items.popleft())
+
+                self.dropped += len(dropped)
+
+            self.items.append(item)
+            self.cond.notify_all()
+            return dropped
+
+    # None once closed and empty
+    def get(self):
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+
+            if not self.items:
+                return None
+
+            item = self.items.popleft()
+            self.cond.notify_all()
+            return item
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+# mean of binning x binning blocks in the first two axes (y and x), the
+# rows and columns left over are dropped
+def bin_frame(arr, binning):
+    if binning <= 1 or arr.ndim < 2:
+        return arr
+
+    ny, nx = arr.shape[0] // binning, arr.shape[1] // binning
+    blocks = arr[:ny * binning, :nx * binning].reshape(
+        (ny, binning, nx, binning) + arr.shape[2:])
+    return blocks.mean(axis=(1, 3)).astype(arr.dtype)
+
+
+def codec_available(codec):
+    return codec in (COMPRESS_NONE, COMPRESS_ZLIB) or \
+        (codec == COMPRESS_LZ4 and lz4 is not None) or \
+        (codec == COMPRESS_BLOSC and blosc is not None)
+
+
+# None if the module of the codec is missing
+def compress(data, codec, level, itemsize):
+    if codec == COMPRESS_ZLIB:
+        return zlib.compress(data, level)
+    if codec == COMPRESS_LZ4 and lz4 is not None:
+        return lz4.frame.compress(data, compression_level=level)
+    if codec == COMPRESS_BLOSC and blosc is not None:
+        return blosc.compress(data, typesize=itemsize, clevel=level)
+
+    return None
+
+
 # this plugin forwards the frame information in a ZMQ multipart message,
 # first part contains the metada of the input frame,
 # second part contains the metadata of the output frame and
-# third part can be empty or contain the frame data
+# third part can be empty or contain the frame data.
+# Messages are sent by a background thread from a bounded queue, so a slow or
+# missing consumer never holds the frames, the counters of messages
+# forwarded and dropped are published as parameters.
+# The frame data is copied unless zero_copy is set, then the input frame is
+# retained and sent from the shared memory, it is released once ZMQ is done
+# with it, with the next reply or on its own if frames stop (frames pushed as
+# output frames are still copied). Frames can be decimated, binned and
+# compressed, "compression" in the output metadata has the codec and
+# "frame_dims" the binned dimensions
 class ZmqForwarder(ADExternalPlugin):
     def __init__(self, target_plugin, socket_path, endpoint, forward_data=True,
-                 initial_params={}):
-        ADExternalPlugin.__init__(self, socket_path, initial_params)
+                 initial_params={}, queue_size=DEFAULT_QUEUE_SIZE,
+                 overflow=OVERFLOW_DROP_OLDEST, zero_copy=False,
+                 compression=COMPRESS_NONE,
+                 compress_level=DEFAULT_COMPRESS_LEVEL, decimation=1,
+                 binning=1):
+        params = {
+            'iZmqQueueSize': queue_size,
+            'iZmqOverflowPolicy': overflow,
+            'iZmqForwarded': 0,
+            'iZmqDropped': 0,
+            'iZmqQueued': 0,
+            'iZmqCompression': compression,
+            'iZmqCompressLevel': compress_level,
+            'iZmqDecimation': decimation,
+            'iZmqBinning': binning,
+        }
+        params.update(initial_params)
+        ADExternalPlugin.__init__(self, socket_path, params)
+        self.update_params(params)
         self.target_plugin = target_plugin
         self.endpoint = endpoint
         self.forward_data = forward_data
+        self.zero_copy = zero_copy
         self.context = zmq.Context()
         self.socket = self.context.socket(zmq.PUSH)
+        # messages wait in our queue, where the overflow policy applies, the
+        # sender follows changes of its size
+        self.hwm = queue_size
+        self.socket.set_hwm(queue_size)
         self.socket.connect(self.endpoint)
         self.set_post_process_hook(self.post_process)
         # we are impersonating that plugin
         self.name = target_plugin.__class__.__name__
+        # the target has no connection, it works through ours
+        self.buffer_pool = target_plugin.buffer_pool
+        self._frame_state = target_plugin._frame_state
+        self.input_attrs = target_plugin.input_attrs
+        target_plugin.alloc_output = self.alloc_output
+        self.queue = SendQueue(queue_size, overflow)
+        self.forwarded = 0
+        self.frame_count = 0
+        # (tracker, frame_loc) of the frames sent from the shared memory, in
+        # the order they were sent, the tracker is None once compressed
+        self.sent_frames = collections.deque()
+        # frames retained for the sender, queued or sent, not released yet
+        self.frames_out = 0
+        self.sender = threading.Thread(
+            target=self._send_loop, name='zmq-sender', daemon=True)
+        self.sender.start()
+        self.params_changed(params)
+
+    def set_zero_copy(self, enabled):
+        self.zero_copy = enabled
+
+    # threads blosc uses for every frame
+    def set_compress_threads(self, threads):
+        if blosc is not None:
+            blosc.set_nthreads(threads or blosc.ncores)
 
     def on_connected(self, params):
-        target_plugin.on_connected(params)
+        self.target_plugin.on_connected(params)
+        self.batch_size = self.target_plugin.batch_size
+
+    def _update_from_recved_params(self, params):
+        ADExternalPlugin._update_from_recved_params(self, params)
+        self.target_plugin._update_from_recved_params(params)
+        self.batch_size = self.target_plugin.batch_size
 
     def params_changed(self, params):
-        target_plugin.params_changed(params)
+        if 'iZmqQueueSize' in params:
+            self.queue.maxsize = max(self['iZmqQueueSize'], 1)
+            self.hwm = self.queue.maxsize
+
+        if 'iZmqOverflowPolicy' in params:
+            self.queue.policy = self['iZmqOverflowPolicy']
+
+        if 'iZmqCompression' in params:
+            codec = self['iZmqCompression']
+            if not codec_available(codec):
+                self.log.warning(
+                    'Module for %s not found, frames are not compressed',
+                    CODEC_NAMES.get(codec, codec))
+
+    # the socket is only used from this thread
+    def _send_loop(self):
+        hwm = self.hwm
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            if hwm != self.hwm:
+                hwm = self.hwm
+                self.socket.set_hwm(hwm)
+
+            in_msg, out_msg, data, frame_loc, codec, level = item
+            if codec != COMPRESS_NONE and data:
+                compressed = compress(data, codec, level, data.itemsize)
+                if compressed is not None:
+                    out_msg['compression'] = CODEC_NAMES[codec]
+                    data = compressed
+
+            self.socket.send_json(in_msg, flags=zmq.SNDMORE)
+            self.socket.send_json(out_msg, flags=zmq.SNDMORE)
+            if frame_loc is None:
+                self.socket.send(data)
+            elif 'compression' in out_msg:
+                self.socket.send(data)
+                self.sent_frames.append((None, frame_loc))
+            else:
+                tracker = self.socket.send(data, copy=False, track=True)
+                self.sent_frames.append((tracker, frame_loc))
+
+            self.forwarded += 1
+
+        self.socket.close()
+
+    # frames ZMQ is done with go back to the AD plugin with the next reply,
+    # so after the reply retaining them
+    def _release_sent_frames(self):
+        while self.sent_frames:
+            tracker, frame_loc = self.sent_frames[0]
+            if tracker is not None and not tracker.done:
+                break
+
+            self.sent_frames.popleft()
+            self.frames_out -= 1
+            self.release_frame(frame_loc)
+
+    # while frames are out with ZMQ, the loop wakes up to release them even
+    # if no frame comes, from the frame thread so always after the reply
+    # retaining them
+    def _param_flush_period(self):
+        period = ADExternalPlugin._param_flush_period(self)
+        if not self.frames_out:
+            return period
+
+        return RELEASE_PERIOD if period is None \
+            else min(period, RELEASE_PERIOD)
+
+    def _flush_params(self):
+        self._release_sent_frames()
+        if self._released_locs:
+            self._send_msg({RELEASE_FIELD: self._released_locs})
+            self._released_locs = []
+
+        ADExternalPlugin._flush_params(self)
+
+    # data to send and the input frame it points to, if it is retained
+    def _frame_data(self, arr, out_msg):
+        binning = self['iZmqBinning']
+        if binning > 1 and arr.ndim >= 2:
+            arr = bin_frame(arr, binning)
+            out_msg['frame_dims'] = self._convert_dims(arr.shape)
+            out_msg['data_type'] = arr.dtype.name
+            out_msg['binning'] = binning
+            return memoryview(arr), None
+
+        # output frames go away with the reply
+        if self.zero_copy and 'out_loc' not in out_msg and \
+                arr.flags.c_contiguous:
+            try:
+                frame_loc = self.retain_frame(arr)
+            except KeyError:
+                pass
+            else:
+                return memoryview(arr), frame_loc
+
+        return memoryview(arr.tobytes()).cast(arr.dtype.char), None
 
     def post_process(self, arr, in_msg, out_msg):
-        self.socket.send_json(in_msg, flags=zmq.SNDMORE)
-        self.socket.send_json(out_msg, flags=zmq.SNDMORE)
+        self._release_sent_frames()
+        self.frame_count += 1
+        if (self.frame_count - 1) % max(self['iZmqDecimation'], 1):
+            return
+
+        # the sender adds to it and the AD plugin gets it too
+        out_msg = dict(out_msg)
+        data, frame_loc = b'', None
         if self.forward_data:
-            self.socket.send(memoryview(arr))
-        else:
-            self.socket.send(b'')
+            data, frame_loc = self._frame_data(arr, out_msg)
+
+        if frame_loc is not None:
+            self.frames_out += 1
+
+        dropped = self.queue.put((
+            in_msg, out_msg, data, frame_loc, self['iZmqCompression'],
+            self['iZmqCompressLevel']))
+        for item in dropped:
+            if item[3] is not None:
+                self.frames_out -= 1
+                self.release_frame(item[3])
+
+        self['iZmqForwarded'] = self.forwarded
+        self['iZmqDropped'] = self.queue.dropped
+        self['iZmqQueued'] = len(self.queue)
 
-    def pop_new_params(self):
-        return target_plugin.pop_new_params()
+    def apply_args(self, args):
+        ADExternalPlugin.apply_args(self, args)
+        self.target_plugin.set_max_param_rate(args.max_param_rate)
+
+    # ours go with the ones of the target
+    def pop_new_params(self, force=False):
+        new_params = self.target_plugin.pop_new_params(force)
+        new_params.update(ADExternalPlugin.pop_new_params(self, force))
+        return new_params
 
     def process_array(self, arr, attrs):
-        out_arr = target_plugin.process_array(arr, attrs)
-        return out_arr
+        return self.target_plugin.process_array(arr, attrs)
+
+    def process_arrays(self, arrs, attrs_list):
+        return self.target_plugin.process_arrays(arrs, attrs_list)
+
+    # pending messages are sent before leaving
+    def close(self):
+        ADExternalPlugin.close(self)
+        self.queue.close()
+        self.sender.join()
 
 
 if __name__ == '__main__':
@@ -72,5 +417,13 @@ if __name__ == '__main__':
     target_module = import_module(args.class_name)
     target_class = getattr(target_module, args.class_name)
     target_plugin = target_class(args.socket_path)
-    ZmqForwarder(target_plugin, args.socket_path, args.endpoint,
-                 args.with_frame_data).run()
+    forwarder = ZmqForwarder(
+        target_plugin, args.socket_path, args.endpoint,
+        args.with_frame_data, queue_size=args.queue_size,
+        overflow=OVERFLOW_NAMES[args.overflow], zero_copy=args.zero_copy,
+        compression=COMPRESS_NAMES[args.compress],
+        compress_level=args.compress_level, decimation=args.decimation,
+        binning=args.binning)
+    forwarder.set_compress_threads(args.compress_threads)
+    forwarder.apply_args(args)
+    forwarder.run()
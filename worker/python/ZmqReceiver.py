@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+
+import argparse
+import collections
+import concurrent.futures
+import logging
+import multiprocessing
+import zlib
+import zmq
+
+from multiprocessing import shared_memory
+
+import numpy
+
+from ADExternalPlugin import ADExternalPlugin, prod
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        'endpoint', help='ZMQ endpoint the forwarder sends frames to')
+    parser.add_argument(
+        '--connect', action='store_true',
+        help='Connect to the endpoint instead of binding it')
+    parser.add_argument(
+        '--ring-size', type=int, default=0,
+        help='Frames received into preallocated arrays, 0 to keep the '
+             'ZMQ messages instead')
+    parser.add_argument('--debug', action='store_true')
+    return parser.parse_args()
+
+
+# data of a frame compressed by ZmqForwarder, see "compression" in the output
+# metadata
+def decompress(data, codec):
+    if codec == 'zlib':
+        return zlib.decompress(data)
+    if codec == 'lz4' and lz4 is not None:
+        return lz4.frame.decompress(data)
+    if codec == 'blosc' and blosc is not None:
+        return blosc.decompress(data)
+
+    raise ValueError('Codec %s not available' % (codec,))
+
+
+# Preallocated buffers the frame data is received into, in turns, a frame
+# stays valid until size more frames are received. A buffer is replaced by a
+# bigger one when a frame doesn't fit. With shared, buffers are in shared
+# memory so other processes can read the frames, see ProcessFanOut
+class FrameRing(object):
+    def __init__(self, size, shared=False):
+        self.size = size
+        self.shared = shared
+        self.buffers = [None] * size
+        self.shms = [None] * size
+        self.next_index = 0
+
+    # index and buffer (uint8 array) of the next slot, with room for nbytes
+    def take(self, nbytes):
+        index = self.next_index
+        self.next_index = (index + 1) % self.size
+        buf = self.buffers[index]
+        if buf is None or buf.nbytes < nbytes:
+            buf = self._alloc(index, nbytes)
+
+        return index, buf
+
+    # name of the shared memory of a slot
+    def shm_name(self, index):
+        return self.shms[index].name
+
+    def _alloc(self, index, nbytes):
+        self.buffers[index] = None
+        if not self.shared:
+            self.buffers[index] = numpy.empty(nbytes, 'uint8')
+            return self.buffers[index]
+
+        self._free_shm(index)
+        shm = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+        self.shms[index] = shm
+        self.buffers[index] = numpy.ndarray(nbytes, 'uint8', buffer=shm.buf)
+        return self.buffers[index]
+
+    def _free_shm(self, index):
+        shm = self.shms[index]
+        if shm is None:
+            return
+
+        self.shms[index] = None
+        shm.unlink()
+        try:
+            shm.close()
+        except BufferError:
+            # arrays given out still use it, it goes away with them
+            pass
+
+    def close(self):
+        self.buffers = [None] * self.size
+        for index in range(self.size):
+            self._free_shm(index)
+
+
+# Receives the messages of ZmqForwarder as (in_msg, out_msg, arr), arr is the
+# frame data in a NumPy array (None if the forwarder doesn't send it) with
+# the shape and type of the output frame, "frame_dims" and "data_type" of the
+# input frame are used if the output ones are missing.
+# Without a ring, arr is a read-only view of the ZMQ message, which lives as
+# long as arr. With ring_size, the data is received straight into the
+# buffers of a FrameRing, without allocating any memory per frame.
+# The forwarder connects to the endpoint, so it is bound by default
+class ZmqReceiver(object):
+    def __init__(self, endpoint, ring_size=0, bind=True, shared=False,
+                 context=None):
+        self.log = logging.getLogger(self.__class__.__name__)
+        self.endpoint = endpoint
+        self.context = context or zmq.Context.instance()
+        self.socket = self.context.socket(zmq.PULL)
+        if bind:
+            self.socket.bind(endpoint)
+        else:
+            self.socket.connect(endpoint)
+
+        self.ring = FrameRing(ring_size, shared) if ring_size else None
+        self.received = 0
+
+    # next frame, None if nothing came in timeout seconds
+    def recv(self, timeout=None):
+        frame = self._recv_slot(timeout)
+        return frame[:3] if frame is not None else None
+
+    # up to max_frames frames, waiting only for the first one. With a ring,
+    # max_frames can't be more than its size, as the arrays of the batch
+    # would be overwritten
+    def recv_batch(self, max_frames, timeout=None):
+        return [frame[:3] for frame in
+                self._recv_slots(max_frames, timeout)]
+
+    def _recv_slots(self, max_frames, timeout):
+        if self.ring is not None and max_frames > self.ring.size:
+            raise ValueError('Batch of %d frames bigger than the ring (%d)'
+                             % (max_frames, self.ring.size))
+
+        frame = self._recv_slot(timeout)
+        if frame is None:
+            return []
+
+        frames = [frame]
+        while len(frames) < max_frames:
+            try:
+                frames.append(self._recv_frame(zmq.NOBLOCK))
+            except zmq.Again:
+                break
+
+        return frames
+
+    def _recv_slot(self, timeout):
+        if timeout is not None and not self.socket.poll(timeout * 1000):
+            return None
+
+        return self._recv_frame(0)
+
+    # (in_msg, out_msg, arr, ring index or None)
+    def _recv_frame(self, flags):
+        # the rest of a multipart message is there once the first part is
+        in_msg = self.socket.recv_json(flags)
+        out_msg = self.socket.recv_json()
+        shape = ADExternalPlugin._convert_dims(
+            out_msg.get('frame_dims') or in_msg['frame_dims'])
+        dtype = numpy.dtype(out_msg.get('data_type') or in_msg['data_type'])
+        nbytes = prod(shape) * dtype.itemsize
+        self.received += 1
+        codec = out_msg.get('compression')
+        if self.ring is None:
+            data = self.socket.recv(copy=False).buffer
+            if codec and len(data):
+                data = decompress(data, codec)
+
+            return in_msg, out_msg, \
+                self._as_array(data, len(data), nbytes, shape, dtype), None
+
+        index, buf = self.ring.take(nbytes)
+        if codec:
+            data = self.socket.recv(copy=False).buffer
+            if len(data):
+                data = decompress(data, codec)
+
+            received = len(data)
+            if received == nbytes:
+                buf[:nbytes] = numpy.frombuffer(data, 'uint8')
+        else:
+            # the size of the message, even if it didn't fit
+            received = self.socket.recv_into(buf)
+
+        return in_msg, out_msg, \
+            self._as_array(buf, received, nbytes, shape, dtype), index
+
+    def _as_array(self, data, received, nbytes, shape, dtype):
+        if received == 0:
+            return None
+
+        if received != nbytes:
+            self.log.error('Frame of %d bytes, %d expected from %s %s',
+                           received, nbytes, shape, dtype.name)
+            return None
+
+        return numpy.frombuffer(data[:nbytes], dtype).reshape(shape)
+
+    def close(self):
+        self.socket.close()
+        if self.ring is not None:
+            self.ring.close()
+
+
+# shared memory of the ring slots, attached once per process, ring index ->
+# SharedMemory
+_attached_shms = {}
+
+
+# a slot given a bigger buffer has a new shared memory, the old one is
+# closed so it goes away once the ring unlinked it
+def _attach(index, shm_name):
+    shm = _attached_shms.get(index)
+    if shm is not None and shm.name != shm_name:
+        del _attached_shms[index]
+        try:
+            shm.close()
+        except BufferError:
+            # an array of func still uses it, it goes away with it
+            pass
+
+        shm = None
+
+    if shm is None:
+        shm = shared_memory.SharedMemory(shm_name)
+        _attached_shms[index] = shm
+
+    return shm
+
+
+def _run_in_process(func, index, shm_name, shape, dtype_name, in_msg,
+                    out_msg):
+    arr = None
+    if shm_name is not None:
+        shm = _attach(index, shm_name)
+
+        arr = numpy.ndarray(shape, dtype_name, buffer=shm.buf)
+        arr.flags.writeable = False
+
+    return func(in_msg, out_msg, arr)
+
+
+# Runs func(in_msg, out_msg, arr) on the frames of receiver in a pool of
+# processes, results come back in the order of the frames. The receiver needs
+# a shared ring, processes read the frames from it without any copy, so
+# there are never more frames in the pool than slots in the ring. func must
+# be a module level function (it is pickled) and must not keep arr
+class ProcessFanOut(object):
+    def __init__(self, receiver, func, processes=None):
+        if receiver.ring is None or not receiver.ring.shared:
+            raise ValueError('ProcessFanOut needs a receiver with a shared '
+                             'ring')
+
+        self.receiver = receiver
+        self.func = func
+        self.executor = concurrent.futures.ProcessPoolExecutor(
+            processes, mp_context=multiprocessing.get_context('fork'))
+        # (in_msg, out_msg, future) in the order of the frames
+        self.pending = collections.deque()
+
+    # yields (in_msg, out_msg, result) until no frame comes in timeout
+    # seconds and every result is given
+    def results(self, timeout=None):
+        ring = self.receiver.ring
+        while True:
+            # the next frame goes in the slot of the oldest one
+            while len(self.pending) >= ring.size:
+                yield self._pop_result()
+
+            frames = self.receiver._recv_slots(
+                ring.size - len(self.pending), timeout)
+            if not frames:
+                break
+
+            for in_msg, out_msg, arr, index in frames:
+                shm_name = ring.shm_name(index) if arr is not None else None
+                shape = arr.shape if arr is not None else None
+                dtype_name = arr.dtype.name if arr is not None else None
+                future = self.executor.submit(
+                    _run_in_process, self.func, index, shm_name, shape,
+                    dtype_name, in_msg, out_msg)
+                self.pending.append((in_msg, out_msg, future))
+
+        while self.pending:
+            yield self._pop_result()
+
+    def _pop_result(self):
+        in_msg, out_msg, future = self.pending.popleft()
+        return in_msg, out_msg, future.result()
+
+    def close(self):
+        self.executor.shutdown()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.debug else logging.INFO)
+
+    receiver = ZmqReceiver(
+        args.endpoint, ring_size=args.ring_size, bind=not args.connect)
+    log = logging.getLogger('ZmqReceiver')
+    while True:
+        in_msg, out_msg, arr = receiver.recv()
+        log.info('Frame %s: %s %s', in_msg.get('frame_id'),
+                 None if arr is None else arr.shape,
+                 None if arr is None else arr.dtype.name)
@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+import json
+import os
+import socket
+import sys
+import threading
+
+import numpy
+
+# workers import each other as top level modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ADExternalPlugin import ADExternalPlugin, RECV_BUFFER_LEN, \
+    FRAME_HEADER, REPLY_HEADER, OUT_LOC_FORMAT, DATA_TYPES, BINARY_FRAME_MSG, \
+    BINARY_REPLY_MSG, BINARY_REPLY_PUSH_FRAME, \
+    BINARY_REPLY_FRAME_DIMS, BINARY_REPLY_DATA_TYPE, BINARY_REPLY_FRAME_ID, \
+    BINARY_REPLY_OUT_LOC, BINARY_REPLY_RETAIN, decode_binary_frame_msg, \
+    encode_binary_reply_msg  # noqa: E402
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'tools'))
+from fakeserver import FakeServer  # noqa: E402
+
+
+# frame message as the AD plugin builds it, see ADExternalPlugin_frame.cpp
+def make_frame_msg(dims, data_type, frame_id, frame_loc, ts, epics_ts,
+                   trailer=None):
+    data = FRAME_HEADER.pack(
+        BINARY_FRAME_MSG, len(dims), DATA_TYPES.index(data_type), frame_id,
+        frame_loc, ts, epics_ts)
+    for dim in dims:
+        data += dim.to_bytes(8, sys.byteorder)
+
+    if trailer is not None:
+        data += json.dumps(trailer).encode()
+
+    return data
+
+
+# (header fields, dims, out_loc, trailer) of a reply
+def split_reply(data):
+    msg_type, flags, ndims, data_type, frame_id = \
+        REPLY_HEADER.unpack_from(data)
+    offset = REPLY_HEADER.size
+    dims = [int.from_bytes(data[offset + 8 * i:offset + 8 * (i + 1)],
+                           sys.byteorder) for i in range(ndims)]
+    offset += 8 * ndims
+    out_loc = None
+    if flags & BINARY_REPLY_OUT_LOC:
+        out_loc, = OUT_LOC_FORMAT.unpack_from(data, offset)
+        offset += OUT_LOC_FORMAT.size
+
+    trailer = json.loads(data[offset:]) if len(data) > offset else None
+    return (msg_type, flags, data_type, frame_id), dims, out_loc, trailer
+
+
+def test_frame_header_layout():
+    # char, ndims, data type, pad, frame id, offset, ts, epics ts
+    assert FRAME_HEADER.size == 1 + 1 + 1 + 1 + 4 + 8 + 8 + 8
+    assert REPLY_HEADER.size == 1 + 1 + 1 + 1 + 4
+
+
+def test_decode_frame():
+    data = make_frame_msg([640, 480, 3], 'uint16', 42, 1 << 33, 1.5,
+                          (7 << 32) | 9)
+    msg = decode_binary_frame_msg(data)
+    assert msg == {
+        'frame_dims': [640, 480, 3],
+        'data_type': 'uint16',
+        'frame_id': 42,
+        'frame_loc': 1 << 33,
+        'ts': 1.5,
+        'epics_ts': (7 << 32) | 9
+    }
+
+
+def test_decode_frame_trailer():
+    attrs = {'Gain': 2, 'Name': 'x'}
+    data = make_frame_msg([8], 'float64', 1, 0, 0.0, 0, {'attrs': attrs})
+    msg = decode_binary_frame_msg(memoryview(data))
+    assert msg['frame_dims'] == [8]
+    assert msg['data_type'] == 'float64'
+    assert msg['attrs'] == attrs
+
+
+def test_decode_every_data_type():
+    for data_type in DATA_TYPES:
+        msg = decode_binary_frame_msg(
+            make_frame_msg([2, 2], data_type, 0, 0, 0.0, 0))
+        assert msg['data_type'] == data_type
+
+
+def test_encode_reply_minimal():
+    data = encode_binary_reply_msg({'push_frame': False})
+    assert len(data) == REPLY_HEADER.size
+    header, dims, out_loc, trailer = split_reply(data)
+    assert header == (BINARY_REPLY_MSG, 0, 0, 0)
+    assert dims == []
+    assert out_loc is None
+    assert trailer is None
+
+
+def test_encode_reply_every_field():
+    msg = {
+        'push_frame': True,
+        'frame_id': 7,
+        'frame_dims': [100, 200],
+        'data_type': 'float32',
+        'out_loc': 1 << 40,
+        'retain': True,
+        'vars': {'iInt2': 5},
+        'attrs': {'sum': 3},
+        'outputs': [{'out_loc': 64}],
+        'release_frames': [0, 4096]
+    }
+    header, dims, out_loc, trailer = split_reply(encode_binary_reply_msg(msg))
+    flags = BINARY_REPLY_PUSH_FRAME | BINARY_REPLY_FRAME_DIMS | \
+        BINARY_REPLY_DATA_TYPE | BINARY_REPLY_FRAME_ID | \
+        BINARY_REPLY_OUT_LOC | BINARY_REPLY_RETAIN
+    assert header == (BINARY_REPLY_MSG, flags, DATA_TYPES.index('float32'), 7)
+    assert dims == [100, 200]
+    assert out_loc == 1 << 40
+    assert trailer == {
+        'vars': {'iInt2': 5},
+        'attrs': {'sum': 3},
+        'outputs': [{'out_loc': 64}],
+        'release_frames': [0, 4096]
+    }
+
+
+def test_encode_reply_empty_trailer():
+    # empty fields are left out, no trailer at all if nothing is left
+    msg = {'push_frame': True, 'frame_id': 3, 'vars': {}, 'attrs': {},
+           'release_frames': []}
+    header, dims, out_loc, trailer = split_reply(encode_binary_reply_msg(msg))
+    assert header == (BINARY_REPLY_MSG,
+                      BINARY_REPLY_PUSH_FRAME | BINARY_REPLY_FRAME_ID, 0, 3)
+    assert trailer is None
+
+
+# plugin reading from one end of a socket pair like the AD plugin's one
+def make_connected_plugin():
+    ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    plugin = ADExternalPlugin(None)
+    plugin.sock = ours
+    return plugin, theirs
+
+
+def test_recv_bigger_than_initial_buffer():
+    plugin, server = make_connected_plugin()
+    try:
+        small = b'a' * 100
+        big = bytes(range(256)) * (RECV_BUFFER_LEN // 256 + 4)
+        server.send(small)
+        server.send(big)
+        server.send(small)
+        assert bytes(plugin._recv_raw()) == small
+        assert bytes(plugin._recv_raw()) == big
+        assert len(plugin._recv_buffer) >= len(big)
+        # messages keep their boundaries after growing
+        assert bytes(plugin._recv_raw()) == small
+    finally:
+        plugin.close()
+        server.close()
+
+
+def test_recv_bigger_than_grown_buffer():
+    plugin, server = make_connected_plugin()
+    try:
+        first = b'x' * (RECV_BUFFER_LEN + 1)
+        server.send(first)
+        assert bytes(plugin._recv_raw()) == first
+        grown = len(plugin._recv_buffer)
+        second = os.urandom(grown * 3 + 7)
+        server.send(second)
+        assert bytes(plugin._recv_raw()) == second
+        assert len(plugin._recv_buffer) > grown
+        # nothing left behind, the buffer doesn't shrink
+        server.send(b'end')
+        assert bytes(plugin._recv_raw()) == b'end'
+        assert len(plugin._recv_buffer) > grown
+    finally:
+        plugin.close()
+        server.close()
+
+
+def test_recv_disconnected():
+    plugin, server = make_connected_plugin()
+    server.close()
+    try:
+        assert plugin._recv_raw() == b''
+    finally:
+        plugin.close()
+
+
+# keeps the bytes of the output frames pushed, they are freed right after
+class RecordingServer(FakeServer):
+    def _handle_reply(self, worker, msg):
+        if 'push_frame' in msg and 'out_loc' in msg:
+            self.pushed_frames.append(
+                (msg['frame_dims'], msg['data_type'],
+                 bytes(self.shm.get_view(msg['out_loc']))))
+
+        FakeServer._handle_reply(self, worker, msg)
+
+
+class UpcastPlugin(ADExternalPlugin):
+    def process_array(self, arr, attrs):
+        return arr.astype('float32') * 0.5
+
+
+def test_upcast_result_pushed_whole():
+    socket_path = '/tmp/test_upcast_%d.sock' % os.getpid()
+    server = RecordingServer(socket_path, 'test_upcast_%d' % os.getpid(),
+                             1 << 16)
+    server.pushed_frames = []
+    plugin = UpcastPlugin(socket_path)
+    thread = threading.Thread(target=plugin.run)
+    thread.start()
+    try:
+        server.accept(1, timeout=5.0)
+        frame = numpy.arange(60, dtype='uint8').reshape(6, 10)
+        server.run_frames([frame], 2, timeout=5.0)
+    finally:
+        server.close()
+        thread.join(5.0)
+
+    # 4 times the input frame, in an output frame instead of truncated
+    expected = (frame.astype('float32') * 0.5).tobytes()
+    assert server.outputs_pushed == 2
+    assert server.pushed_frames == [([10, 6], 'float32', expected)] * 2
@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+import os
+import sys
+import threading
+import tracemalloc
+
+import numpy
+import scipy.ndimage
+
+# workers import each other as top level modules
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from MedianFilter import MedianFilter, ENGINE_SCIPY, ENGINE_TILED, \
+    ENGINE_SEPARABLE  # noqa: E402
+
+SHAPE = (256, 320)
+
+
+def make_plugin(engine, size=5):
+    plugin = MedianFilter(None)
+    plugin['iMedianFilterEngine'] = engine
+    plugin['iMedianFilterSize'] = size
+    plugin['iMedianFilterThreads'] = 3
+    return plugin
+
+
+def make_frame(dtype='uint16'):
+    rng = numpy.random.default_rng(0)
+    return rng.integers(0, 4000, SHAPE).astype(dtype)
+
+
+# bytes allocated and still alive at the peak while filtering nframes
+# frames, after a warm up frame
+def filtering_peak(plugin, frame, nframes=5):
+    plugin.process_array(frame.copy(), {})
+    frames = [frame.copy() for _ in range(nframes)]
+    tracemalloc.start()
+    try:
+        for arr in frames:
+            plugin.process_array(arr, {})
+
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def test_filters_in_place():
+    frame = make_frame()
+    expected = scipy.ndimage.median_filter(frame, size=5)
+    for engine in (ENGINE_SCIPY, ENGINE_TILED):
+        plugin = make_plugin(engine)
+        arr = frame.copy()
+        assert plugin.process_array(arr, {}) is arr
+        assert (arr == expected).all()
+
+
+def test_separable_in_place():
+    frame = make_frame()
+    expected = scipy.ndimage.median_filter(
+        scipy.ndimage.median_filter(frame, size=(5, 1)), size=(1, 5))
+    arr = frame.copy()
+    assert make_plugin(ENGINE_SEPARABLE).process_array(arr, {}) is arr
+    assert (arr == expected).all()
+
+
+def test_no_frame_allocations():
+    frame = make_frame()
+    for engine in (ENGINE_SCIPY, ENGINE_TILED, ENGINE_SEPARABLE):
+        peak = filtering_peak(make_plugin(engine), frame)
+        # bookkeeping only, a single frame sized buffer would be far more
+        assert peak < frame.nbytes // 10, (engine, peak)
+
+
+def test_scratch_follows_frame_shape():
+    plugin = make_plugin(ENGINE_SCIPY)
+    plugin.process_array(make_frame(), {})
+    arr = make_frame('uint8')[:100]
+    plugin.process_array(arr, {})
+    assert plugin.scratch_buffers['out'].shape == arr.shape
+    assert plugin.scratch_buffers['out'].dtype == arr.dtype
+
+
+# lanes of ParallelWorkerHost in thread mode share one instance
+def test_threads_sharing_plugin():
+    frames = [make_frame() + i for i in range(4)]
+    expected = [scipy.ndimage.median_filter(frame, size=5)
+                for frame in frames]
+    for engine in (ENGINE_SCIPY, ENGINE_TILED, ENGINE_SEPARABLE):
+        plugin = make_plugin(engine)
+        if engine == ENGINE_SEPARABLE:
+            expected = [scipy.ndimage.median_filter(
+                scipy.ndimage.median_filter(frame, size=(5, 1)),
+                size=(1, 5)) for frame in frames]
+
+        wrong = []
+
+        def filter_frames(frame, result):
+            for _ in range(8):
+                arr = frame.copy()
+                plugin.process_array(arr, {})
+                if not (arr == result).all():
+                    wrong.append(engine)
+
+        threads = [threading.Thread(target=filter_frames, args=args)
+                   for args in zip(frames, expected)]
+        for thread in threads:
+            thread.start()
+
+        for thread in threads:
+            thread.join()
+
+        assert not wrong, (engine, len(wrong))